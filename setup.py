@@ -67,6 +67,11 @@ setup(
     install_requires=[
         'dhis2.py==2.3.0'
     ],
+    extras_require={
+        'parquet': ['pyarrow'],
+        'numpy': ['numpy'],
+        'async': ['aiohttp']
+    },
     entry_points={
         'console_scripts': [
             'dhis2-pk = src.main:pocketknife_run',  # primary
@@ -1,57 +1,186 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import csv
+import json
+import string
 import time
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 from dhis2 import setup_logger, logger, load_csv, is_valid_uid, RequestException
+from requests import ConnectionError, Timeout
 
 try:
-    from src.common.utils import create_api
+    from src.common.utils import create_api, connection_options, chunks, write_csv, file_timestamp, \
+        retry_idempotent
     from src.common.exceptions import PKClientException
+    from src.common.object_types import attribute_object_types
+    from src.common import stats
 except (SystemError, ImportError):
-    from common.utils import create_api
+    from common.utils import create_api, connection_options, chunks, write_csv, file_timestamp, \
+        retry_idempotent
     from common.exceptions import PKClientException
+    from common.object_types import attribute_object_types
+    from common import stats
 
+# keep id:in:[...] filters well below URL length limits
+GET_BATCH_SIZE = 200
 
-def validate_csv(data):
-    if not data[0].get('uid', None) or not data[0].get('attributeValue', None):
-        raise PKClientException("CSV not valid: CSV must have 'uid' and 'attributeValue' as headers")
+Attribute = namedtuple('Attribute', 'uid name')
 
-    object_uids = [obj['uid'] for obj in data]
-    for uid in object_uids:
+# a validated CSV row: its row number, object type, object UID and dict of attribute UID -> value
+Row = namedtuple('Row', 'number object_type uid values')
+
+UID_ALPHABET = {c: i for i, c in enumerate(string.digits + string.ascii_letters)}
+
+
+def uid_key(uid):
+    """Pack a UID into an integer - a set of ints takes about half the memory of a set of strings"""
+    key = 0
+    for c in uid:
+        key = key * 62 + UID_ALPHABET[c]
+    return key
+
+
+def csv_columns(path):
+    """Return the header of a CSV file"""
+    with open(path, 'r') as f:
+        return next(csv.reader(f), [])
+
+
+def csv_attributes(columns, attribute_uid=None):
+    """
+    Return the Attribute UIDs to set from the CSV columns:
+    either the -a argument for 'uid,attributeValue' files or the Attribute UID columns of wide files
+    """
+    if 'uid' not in columns:
+        raise PKClientException("CSV not valid: CSV must have 'uid' and 'attributeValue' "
+                                "or Attribute UIDs as headers")
+    if 'attributeValue' in columns:
+        if not attribute_uid:
+            raise PKClientException("Argument -a is required for CSV files with an 'attributeValue' column")
+        return [attribute_uid]
+    attribute_uids = [c for c in columns if c not in ('uid', 'type')]
+    invalid = [c for c in attribute_uids if not is_valid_uid(c)]
+    if invalid or not attribute_uids:
+        raise PKClientException("CSV not valid: columns must be 'uid', 'type' or Attribute UIDs, "
+                                "not: {}".format(', '.join(invalid)))
+    return attribute_uids
+
+
+def iter_valid_rows(rows, attribute_uid=None, object_type=None):
+    """
+    Validate CSV rows while streaming them, so the file never has to be held in memory.
+    Only a compact set of seen UIDs is kept to detect duplicates.
+    Rows are either 'uid,attributeValue' (for the Attribute of -a) or 'uid,[type,]<Attribute UID>,...',
+    where empty cells leave the attribute value unchanged and an empty type falls back to `object_type` (-t).
+    :return: generator of Row
+    """
+    seen = set()
+    for i, row in enumerate(rows, 1):
+        if i == 1:
+            if 'attributeValue' in row:
+                if not row.get('uid', None) or not row.get('attributeValue', None):
+                    raise PKClientException("CSV not valid: CSV must have 'uid' and 'attributeValue' as headers")
+                attribute_uids = None
+            else:
+                attribute_uids = csv_attributes(list(row.keys()))
+            has_type = 'type' in row
+
+        uid = row['uid']
         if not is_valid_uid(uid):
-            raise PKClientException("Object '{}' is not a valid UID in the CSV".format(uid))
-    if len(object_uids) != len(set(object_uids)):
-        raise PKClientException("Duplicate Objects (rows) found in the CSV.")
+            raise PKClientException("Object '{}' is not a valid UID in the CSV (row {})".format(uid, i))
+        key = uid_key(uid)
+        if key in seen:
+            raise PKClientException("Duplicate Objects (rows) found in the CSV: {} (row {})".format(uid, i))
+        seen.add(key)
+
+        typ = object_type
+        if has_type:
+            typ = row['type'] or object_type
+            if not typ:
+                raise PKClientException("Object type is empty and argument -t is not set (row {})".format(i))
+            if typ not in attribute_object_types:
+                raise PKClientException("Object type '{}' is not valid (row {})".format(typ, i))
+
+        if attribute_uids is None:
+            values = {attribute_uid: row['attributeValue']}
+        else:
+            values = OrderedDict((a, row[a]) for a in attribute_uids if row[a])
+        yield Row(i, typ, uid, values)
+
+
+def validate_csv(data, attribute_uid=None, object_type=None):
+    """Validate all rows, raise PKClientException on the first invalid one"""
+    for _ in iter_valid_rows(data, attribute_uid, object_type):
+        pass
     return True
 
 
-def create_or_update_attribute_values(obj, attribute_uid, attribute_value):
+def set_attribute_values(obj, values):
+    """Return a copy of obj with the attribute values (dict of Attribute UID -> value) created or updated"""
     obj_copy = deepcopy(obj)
-    updated = {
-        "value": attribute_value,
-        "attribute": {
-            "id": attribute_uid,
-        }
-    }
-    # if no single attribute is set
-    if not obj.get('attributeValues'):
-        obj_copy['attributeValues'] = [updated]
-        return obj_copy
-
-    if len(obj['attributeValues']) == 1 and attribute_uid in [x['attribute']['id'] for x in obj['attributeValues']]:
-        # just one attribute matching to target UID
-        obj_copy['attributeValues'] = [updated]
-        return obj_copy
-    else:
-        # there are more than 1 attribute values.
-        # extract all values except target UID (if existing) and add target value.
-        old = [x for x in obj['attributeValues'] if x['attribute']['id'] != attribute_uid]
-        obj_copy['attributeValues'] = old
-        obj_copy['attributeValues'].append(updated)
-        return obj_copy
+    # keep all values except the ones to set
+    obj_copy['attributeValues'] = [x for x in obj.get('attributeValues', []) if x['attribute']['id'] not in values]
+    for attribute_uid, value in values.items():
+        obj_copy['attributeValues'].append({
+            "value": value,
+            "attribute": {
+                "id": attribute_uid,
+            }
+        })
+    return obj_copy
+
+
+def create_or_update_attribute_values(obj, attribute_uid, attribute_value):
+    return set_attribute_values(obj, {attribute_uid: attribute_value})
+
+
+def changed_values(obj, values):
+    """Return the attribute values (dict of Attribute UID -> value) that differ from the current ones of obj"""
+    current = {x['attribute']['id']: x.get('value') for x in obj.get('attributeValues', [])}
+    return OrderedDict((a, v) for a, v in values.items() if current.get(a) != v)
+
+
+class Journal(object):
+    """Append-only file of completed object UIDs, so interrupted runs can resume without reprocessing them"""
+
+    def __init__(self, path):
+        self.path = path
+        self.skipped = 0
+        self._done = set()
+        try:
+            with open(path, 'r') as f:
+                self._done = {uid_key(line.strip()) for line in f if is_valid_uid(line.strip())}
+        except (IOError, OSError):
+            pass
+        self._file = open(path, 'a')
+
+    def __contains__(self, uid):
+        return uid_key(uid) in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def add(self, uids):
+        """Record UIDs as completed and flush, so they survive an interruption"""
+        for uid in uids:
+            self._done.add(uid_key(uid))
+            self._file.write(uid + '\n')
+        self._file.flush()
+
+    def skip_completed(self, rows):
+        """Skip rows already completed in a previous run"""
+        for row in rows:
+            if row.uid in self:
+                self.skipped += 1
+                continue
+            yield row
+
+    def close(self):
+        self._file.close()
 
 
 def get_attribute_name(api, uid):
@@ -71,31 +200,238 @@ def attribute_is_on_model(api, attribute, typ):
         raise PKClientException("Attribute {} ({}) is not assigned to type {}".format(attribute.name, attribute.uid, typ[:-1]))
 
 
+def check_attributes_on_model(api, rows, attributes):
+    """
+    Check that attributes are assigned to the object types of all rows, once per type and attribute.
+    Reads all rows (which validates them) before the first check, so nothing is written if any of it fails.
+    """
+    used = OrderedDict()
+    for row in rows:
+        for attribute_uid in row.values:
+            used[(attribute_uid, row.object_type)] = True
+    for attribute_uid, typ in used:
+        attribute_is_on_model(api, attributes[attribute_uid], typ)
+
+
+def group_by_type(rows):
+    """Return dict of object type -> rows, keeping the order of rows"""
+    groups = OrderedDict()
+    for row in rows:
+        groups.setdefault(row.object_type, []).append(row)
+    return groups
+
+
+def failure(row, error):
+    """A row of the failure report"""
+    return row.number, row.object_type, row.uid, json.dumps(row.values), error
+
+
+def get_objects(api, typ, uids, fields=':owner'):
+    """GET objects in batched id:in:[...] requests, return dict of UID -> object"""
+    objects = {}
+    for batch in chunks(uids, GET_BATCH_SIZE):
+        params = {'fields': fields, 'filter': 'id:in:[{}]'.format(','.join(batch)), 'paging': False}
+        for obj in api.get(typ, params=params).json()[typ]:
+            objects[obj['id']] = obj
+    return objects
+
+
+def import_report_errors(report):
+    """Return dict of UID -> error messages of a metadata import report"""
+    report = report.get('response', report)
+    errors = {}
+    for type_report in report.get('typeReports', []):
+        for object_report in type_report.get('objectReports', []):
+            messages = [e.get('message') for e in object_report.get('errorReports', [])]
+            if messages:
+                errors[object_report.get('uid')] = messages
+    return errors
+
+
+def import_report_ignored(report):
+    """Return the amount of objects a metadata import report counts as ignored"""
+    report = report.get('response', report)
+    return report.get('stats', {}).get('ignored', 0)
+
+
+def import_metadata(api, typ, objects):
+    """
+    Update objects through the metadata import
+    :return: tuple of dict of UID -> error messages of objects that were not updated,
+    and the amount of objects ignored without error messages
+    """
+    params = {'importStrategy': 'UPDATE', 'atomicMode': 'NONE'}
+    try:
+        report = api.post('metadata', data={typ: objects}, params=params).json()
+    except RequestException as exc:
+        # newer versions respond with 409 Conflict if any object failed
+        if exc.code != 409:
+            raise
+        try:
+            report = json.loads(exc.description)
+        except ValueError:
+            raise exc
+    errors = import_report_errors(report)
+    if report.get('response', report).get('status') == 'ERROR' and not errors:
+        # failed without any object report, e.g. a bad request
+        errors = {obj['id']: [u'{}'.format(report.get('message', 'Import failed'))] for obj in objects}
+    return errors, max(0, import_report_ignored(report) - len(errors))
+
+
+def update_with_metadata_import(api, rows, batch_size, journal=None):
+    """
+    Update objects (from an iterable of Row) in batches:
+    fetch them with id:in:[...] and submit them through metadata imports, per object type.
+    Objects that already have the values are not imported again, so their lastUpdated is not bumped.
+    :param journal: optional Journal to record completed UIDs in
+    :return: tuple of amount updated, amount unchanged, amount ignored without errors, list of failed rows
+    """
+    updated, unchanged, ignored, failures = 0, 0, 0, []
+    for batch in chunks(rows, batch_size):
+        for typ, type_rows in group_by_type(batch).items():
+            objects = get_objects(api, typ, [row.uid for row in type_rows])
+
+            to_import, rows_by_uid, completed = [], {}, []
+            for row in type_rows:
+                obj_old = objects.get(row.uid)
+                if not obj_old:
+                    failures.append(failure(row, 'not found'))
+                    continue
+                values = changed_values(obj_old, row.values)
+                if not values:
+                    unchanged += 1
+                    completed.append(row.uid)
+                    continue
+                to_import.append(set_attribute_values(obj_old, values))
+                rows_by_uid[row.uid] = row
+
+            errors, type_ignored = import_metadata(api, typ, to_import) if to_import else ({}, 0)
+            for obj_uid, messages in errors.items():
+                row = rows_by_uid.get(obj_uid, Row('?', typ, obj_uid, {}))
+                failures.append(failure(row, ' '.join(messages)))
+            updated += len(to_import) - len(errors) - type_ignored
+            ignored += type_ignored
+            if journal is not None:
+                # the report doesn't say which objects were ignored - only journal imported ones if none were
+                imported = [uid for uid in rows_by_uid if uid not in errors] if not type_ignored else []
+                journal.add(completed + imported)
+        logger.info(u"{} rows - Updated {} objects, {} unchanged, {} ignored".format(
+            batch[-1].number, updated, unchanged, ignored))
+    return updated, unchanged, ignored, failures
+
+
+def patch_attribute_values(api, typ, uid, attribute_values, json_patch=True):
+    """
+    Send only the attributeValues of an object,
+    as JSON Patch (2.37+) or as partial update (older versions)
+    """
+    if json_patch:
+        r = api.session.patch(
+            '{}/{}/{}'.format(api.api_url, typ, uid),
+            data=json.dumps([{'op': 'add', 'path': '/attributeValues', 'value': attribute_values}]),
+            headers={'Content-Type': 'application/json-patch+json'}
+        )
+        if not r.ok:
+            raise RequestException(code=r.status_code, url=r.url, description=r.text)
+    else:
+        api.patch('{}/{}'.format(typ, uid), data={'attributeValues': attribute_values})
+
+
+def update_with_patch(api, rows, batch_size, workers, journal=None):
+    """
+    Update objects (from an iterable of Row) concurrently with minimal PATCH requests of their attributeValues only.
+    Objects that already have the values are not patched.
+    :param journal: optional Journal to record completed UIDs in
+    :return: tuple of amount updated, amount unchanged, amount ignored (always 0), list of failed rows
+    """
+    json_patch = (api.version_int or 0) >= 37
+    logger.info(u"Updating with {} requests, {} workers".format('JSON Patch' if json_patch else 'PATCH', workers))
+
+    def update(item):
+        row, obj = item
+        try:
+            attribute_values = set_attribute_values(obj, row.values)['attributeValues']
+            # a transient 429/502/503/504 is retried before the row counts as failed
+            retry_idempotent(api, patch_attribute_values, row.object_type, row.uid, attribute_values, json_patch)
+        except (RequestException, ConnectionError, Timeout) as exc:
+            return row, u'{}'.format(exc)
+        return row, None
+
+    updated, unchanged, failures = 0, 0, []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in chunks(rows, batch_size):
+            items, completed = [], []
+            for typ, type_rows in group_by_type(batch).items():
+                objects = get_objects(api, typ, [row.uid for row in type_rows],
+                                      fields='id,attributeValues[value,attribute[id]]')
+                for row in type_rows:
+                    if row.uid not in objects:
+                        failures.append(failure(row, 'not found'))
+                    elif not changed_values(objects[row.uid], row.values):
+                        unchanged += 1
+                        completed.append(row.uid)
+                    else:
+                        items.append((row, objects[row.uid]))
+
+            for row, error in executor.map(update, items):
+                if error:
+                    failures.append(failure(row, error))
+                else:
+                    updated += 1
+                    completed.append(row.uid)
+            if journal is not None:
+                journal.add(completed)
+            logger.info(u"{} rows - Updated {} objects, {} unchanged".format(batch[-1].number, updated, unchanged))
+    return updated, unchanged, 0, failures
+
+
 def main(args, password):
     setup_logger()
-    api = create_api(server=args.server, username=args.username, password=password)
+    api = create_api(server=args.server, username=args.username, password=password, **connection_options(args))
 
-    Attribute = namedtuple('Attribute', 'uid name')
-    Attribute.uid = args.attribute_uid
-    Attribute.name = get_attribute_name(api, args.attribute_uid)
-    typ = args.object_type
+    columns = csv_columns(args.source_csv)
+    if 'type' not in columns and not args.object_type:
+        raise PKClientException("Argument -t is required for CSV files without a 'type' column")
+    attribute_uids = csv_attributes(columns, args.attribute_uid)
+    attributes = OrderedDict((uid, Attribute(uid, get_attribute_name(api, uid))) for uid in attribute_uids)
 
-    attribute_is_on_model(api, Attribute, typ)
+    # the whole file is validated and the attributes checked for all its types before the first write,
+    # then the file is streamed again and processed in batches
+    with stats.phase('validate'):
+        check_attributes_on_model(api, iter_valid_rows(load_csv(args.source_csv), args.attribute_uid,
+                                                       args.object_type), attributes)
+    rows = iter_valid_rows(load_csv(args.source_csv), args.attribute_uid, args.object_type)
+    journal = Journal(args.journal) if args.journal else None
+    if journal is not None:
+        logger.info(u"Skipping {} objects completed according to journal {}".format(len(journal), args.journal))
+        rows = journal.skip_completed(rows)
 
-    data = list(load_csv(args.source_csv))
-    validate_csv(data)
-
-    logger.info(u"Updating values for Attribute '{}' ({}) on {} {} ...".format(Attribute.name, Attribute.uid, len(data), typ))
+    logger.info(u"Updating values for Attributes {} on {} from {} ...".format(
+        ', '.join([u"'{}' ({})".format(a.name, a.uid) for a in attributes.values()]),
+        args.object_type or 'the types in the CSV',
+        args.source_csv))
     for i in range(3, 0, -1):
         time.sleep(i)
         print('Proceeding in {}...'.format(i))
 
-    for i, obj in enumerate(data, 1):
-        obj_uid = obj['uid']
-        attribute_value = obj['attributeValue']
-
-        obj_old = api.get('{}/{}'.format(args.object_type, obj_uid), params={'fields': ':owner'}).json()
-        obj_updated = create_or_update_attribute_values(obj_old, Attribute.uid, attribute_value)
+    try:
+        with stats.phase('update'):
+            if args.mode == 'patch':
+                updated, unchanged, ignored, failures = update_with_patch(api, rows, args.batch_size, args.workers,
+                                                                          journal)
+            else:
+                updated, unchanged, ignored, failures = update_with_metadata_import(api, rows, args.batch_size,
+                                                                                    journal)
+    finally:
+        if journal is not None:
+            journal.close()
 
-        api.put('{}/{}'.format(typ, obj_uid), data=obj_updated)
-        logger.info(u"{}/{} - Updated AttributeValue: {} - {}: {}".format(i, len(data), attribute_value, typ[:-1], obj_uid))
\ No newline at end of file
+    summary = u"Done - updated: {} - unchanged: {} - ignored: {} - failed: {}".format(
+        updated, unchanged, ignored, len(failures))
+    if journal is not None:
+        summary += u" - skipped (journal): {}".format(journal.skipped)
+    logger.info(summary)
+    if failures:
+        file_name = 'attribute-setter-failures-{}.csv'.format(file_timestamp(api.base_url))
+        write_csv(failures, file_name, ['row', 'type', 'uid', 'attributeValues', 'error'])
+        logger.warning(u"Failed rows exported to {}".format(file_name))
@@ -2,18 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import os
 import textwrap
 import getpass
 import sys
-
+from datetime import datetime
 
 from dhis2 import is_valid_uid
 
 try:
     from src.common.exceptions import PKClientException
+    from src.common.object_types import attribute_object_types
     from .__version__ import __version__ as version
 except ModuleNotFoundError:  # for pytest
     from common.exceptions import PKClientException
+    from common.object_types import attribute_object_types
     from __version__ import __version__ as version
 
 
@@ -24,10 +27,12 @@ def pk_general_help():
         'It is required to select one of these scripts:\n\n' \
         'dhis2-pk attribute-setter --help\n' \
         'dhis2-pk data-integrity --help\n' \
+        'dhis2-pk fake-data --help\n' \
         'dhis2-pk indicator-definitions --help\n' \
         'dhis2-pk post-css --help\n' \
         'dhis2-pk share --help\n' \
         'dhis2-pk userinfo --help\n\n' \
+        'Add --stats (or --stats=FILE.json) to any script for a summary of requests and timings.\n\n' \
         'More info and docs on the website:\n' \
         'https://github.com/davidhuser/dhis2-pk'.format(version)
     sys.exit(s)
@@ -42,17 +47,77 @@ def get_password(args):
     return args, password
 
 
-def standard_arguments(parser):
-    """Add required and optional arguments common to all scripts"""
+def valid_date(value):
+    """argparse type for dates like 2021-12-31 or 2021-12-31T23:59:59"""
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            datetime.strptime(value, fmt)
+            return value
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("not a valid date (YYYY-MM-DD): '{}'".format(value))
+
+
+def positive_int(value):
+    """argparse type for integers of 1 or greater"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be 1 or greater: '{}'".format(value))
+    return number
+
+
+def non_negative_int(value):
+    """argparse type for integers of 0 or greater"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise argparse.ArgumentTypeError("must be 0 or greater: '{}'".format(value))
+    return number
+
+
+def valid_uid(value):
+    """argparse type for DHIS2 UIDs"""
+    if not is_valid_uid(value):
+        raise argparse.ArgumentTypeError("not a valid UID: '{}'".format(value))
+    return value
+
+
+def standard_arguments(parser, server_required=True):
+    """
+    Add required and optional arguments common to all scripts
+    :param server_required: False for scripts that can run without a server, -s and -u are then optional
+    """
     parser._action_groups.pop()
     required = parser.add_argument_group('required arguments')
     optional = parser.add_argument_group('optional arguments')
-    required.add_argument('-s', dest='server', action='store', required=True, help="DHIS2 server URL")
-    required.add_argument('-u', dest='username', action='store', required=True, help='DHIS2 username')
+    server_group = required if server_required else optional
+    server_group.add_argument('-s', dest='server', action='store', required=server_required, help="DHIS2 server URL")
+    server_group.add_argument('-u', dest='username', action='store', required=server_required, help='DHIS2 username')
     optional.add_argument('-p', dest='password', action='store', required=False, help='DHIS2 password')
+    connection_arguments(parser.add_argument_group('connection arguments'))
     return required, optional
 
 
+def connection_arguments(group):
+    """Add the connection options of create_api, see common.utils.connection_options"""
+    group.add_argument('--pool-size', dest='pool_size', action='store', type=positive_int, default=10,
+                       help="Connections to keep open to the server (default: 10)")
+    group.add_argument('--no-keep-alive', dest='keep_alive', action='store_false', default=True,
+                       help="Open a new connection for every request")
+    group.add_argument('--timeout', dest='timeout', action='store', type=positive_int, default=None,
+                       help="Seconds to wait for the server to connect and respond (default: no limit)")
+    group.add_argument('--retries', dest='retries', action='store', type=non_negative_int, default=3,
+                       help="Retries on connection errors and 429, 502, 503 and 504 responses (default: 3)")
+    group.add_argument('--gzip-requests', dest='compress_requests', action='store_true', default=False,
+                       help="Compress request bodies of imports with gzip\n"
+                            "(metadata, dataValueSets, events, trackedEntityInstances)")
+
+
 def parse_args_attributes(argv):
     description = "Set Attribute Values sourced from CSV file."
 
@@ -63,58 +128,44 @@ CSV file structure:
 uid   | attributeValue
 ------|---------------
 UID   | myValue
+
+Or, to set many attributes at once (-a not needed), one column per Attribute UID,
+with an optional type column (then -t is not needed):
+uid   | type              | pt5Ll9bb2oP | n2xYlNbsfko
+------|-------------------|-------------|------------
+UID   | organisationUnits | myValue     | otherValue
 """
 
     parser = argparse.ArgumentParser(usage=usage, description=description,
                                      formatter_class=argparse.RawTextHelpFormatter)
     required, optional = standard_arguments(parser)
 
-    required.add_argument('-t', dest='object_type', action='store', required=True,
-                          help="Object type to set attributeValues to: {organisationUnits, dataElements, ...}")
     required.add_argument('-c', dest='source_csv', action='store', required=True,
                           help="Path to CSV file with Attribute Values")
-    required.add_argument('-a', dest='attribute_uid', action='store', help='Attribute UID', required=True)
+    optional.add_argument('-t', dest='object_type', action='store', required=False,
+                          help="Object type to set attributeValues to: {organisationUnits, dataElements, ...}\n"
+                               "(if the CSV has no type column)")
+    optional.add_argument('-a', dest='attribute_uid', action='store', required=False,
+                          help="Attribute UID (if the CSV has an attributeValue column)")
+    optional.add_argument('--batch-size', dest='batch_size', action='store', type=positive_int, default=500,
+                          help="Number of objects per batch (default: 500)")
+    optional.add_argument('--mode', dest='mode', action='store', default='metadata', choices=['metadata', 'patch'],
+                          help=textwrap.dedent('''\
+                            How to update objects:
+                            - metadata: batched metadata imports (default)
+                            - patch: concurrent PATCH requests of attributeValues only,
+                                     when metadata imports are not allowed'''))
+    optional.add_argument('--workers', dest='workers', action='store', type=positive_int, default=8,
+                          help="Number of concurrent PATCH requests (default: 8)")
+    optional.add_argument('--journal', dest='journal', action='store', metavar='FILE',
+                          help="File to record completed UIDs in - re-run with the same file to resume")
 
     args = parser.parse_args(argv)
 
-    obj_types = {
-        'categories',
-        'categoryOptionCombos',
-        'categoryOptionGroupSets',
-        'categoryOptionGroups',
-        'categoryOptions',
-        'constants',
-        'dataElementGroupSets',
-        'dataElementGroups',
-        'dataElements',
-        'dataSets',
-        'documents',
-        'indicatorGroups',
-        'indicators',
-        'legends',
-        'legendSets',
-        'optionSets',
-        'options',
-        'organisationUnitGroupSets',
-        'organisationUnitGroups',
-        'organisationUnits',
-        'programIndicators',
-        'programStages',
-        'programs',
-        'sections',
-        'sqlViews',
-        'trackedEntityAttributes',
-        'trackedEntityTypes',
-        'trackedEntities',
-        'userGroups',
-        'users',
-        'validationRuleGroups',
-        'validationRules'
-    }
-
-    if args.object_type not in obj_types:
-        raise PKClientException("argument -t must be a valid object_type - one of:\n{}".format(', '.join(sorted(obj_types))))
-    if not is_valid_uid(args.attribute_uid):
+    if args.object_type and args.object_type not in attribute_object_types:
+        raise PKClientException("argument -t must be a valid object_type - one of:\n{}".format(
+            ', '.join(sorted(attribute_object_types))))
+    if args.attribute_uid and not is_valid_uid(args.attribute_uid):
         raise PKClientException("Attribute {} is not a valid UID".format(args.attribute_uid))
 
     return get_password(args)
@@ -143,6 +194,15 @@ def parse_args_indicators(argv):
 
     required.add_argument('-f', dest='indicator_filter', action='store',
                         help="Indicator filter, e.g. -f 'name:like:HIV' - see dhis2-pk-share --help", required=False)
+    optional.add_argument('--no-validate', dest='no_validate', action='store_true', default=False,
+                          help="Do not validate expressions (faster)")
+    optional.add_argument('--workers', dest='workers', action='store', type=positive_int, default=8,
+                          help="Number of concurrent validation requests (default: 8)")
+    optional.add_argument('--format', dest='export_format', action='store', default='csv',
+                          choices=['csv', 'jsonl', 'parquet'],
+                          help="Export format (default: csv) - parquet requires pyarrow")
+    optional.add_argument('--gzip', dest='compress', action='store_true', default=False,
+                          help="Compress the file with gzip")
     args = parser.parse_args(argv)
     return get_password(args)
 
@@ -248,29 +308,94 @@ def parse_args_userinfo(argv):
     parser = argparse.ArgumentParser(usage=usage, description=description)
     required, optional = standard_arguments(parser)
     optional.add_argument('-i', dest='uid_export', action='store_true', required=False, help='Additionally export UIDs')
+    optional.add_argument('--format', dest='export_format', action='store', default='csv',
+                          choices=['csv', 'jsonl', 'parquet'],
+                          help="Export format (default: csv) - parquet requires pyarrow")
+    optional.add_argument('--gzip', dest='compress', action='store_true', default=False,
+                          help="Compress the file with gzip")
+    optional.add_argument('--page-size', dest='page_size', action='store', type=positive_int, default=500,
+                          help="Number of users per page (default: 500)")
+    optional.add_argument('--workers', dest='workers', action='store', type=positive_int, default=4,
+                          help="Number of pages to download concurrently (default: 4)")
+
+    filters = parser.add_argument_group('user filters')
+    filters.add_argument('--user-group', dest='user_group', type=valid_uid, metavar='UID',
+                         help="Only users in this user group")
+    filters.add_argument('--user-role', dest='user_role', type=valid_uid, metavar='UID',
+                         help="Only users with this user role")
+    filters.add_argument('--org-unit', dest='org_unit', type=valid_uid, metavar='UID',
+                         help="Only users assigned to this org unit or its children")
+    filters.add_argument('--updated-since', dest='updated_since', type=valid_date, metavar='DATE',
+                         help="Only users updated since DATE (YYYY-MM-DD)")
+    filters.add_argument('--login-since', dest='login_since', type=valid_date, metavar='DATE',
+                         help="Only users logged in since DATE (YYYY-MM-DD)")
+
+    incremental = parser.add_argument_group('incremental export')
+    incremental.add_argument('--previous', dest='previous', metavar='FILE',
+                             help="Previous CSV or JSON lines export to merge with users changed since then")
+    incremental.add_argument('--since', dest='since', type=valid_date, metavar='DATE',
+                             help="Users changed since DATE (default: a day before the previous export was written)")
+    incremental.add_argument('--remove-deleted', dest='remove_deleted', action='store_true', default=False,
+                             help="Leave out users deleted since the previous export (downloads all user UIDs)")
+
     args = parser.parse_args(argv)
+    if (args.since or args.remove_deleted) and not args.previous:
+        raise PKClientException("--since and --remove-deleted require --previous")
+    if args.previous:
+        if not os.path.isfile(args.previous):
+            raise PKClientException("Previous export not found: {}".format(args.previous))
+        if args.export_format == 'parquet':
+            raise PKClientException("--previous is not supported for parquet exports")
     return get_password(args)
 
 
 def parse_args_fake_data(argv):
-    description = "Import fake data for Event programs or Data Sets"
-    usage = "\nExample: dhis2-pk fake-data -s play.dhis2.org/demo -u admin -p district -i kla3mAPgvCH -n 100"
+    description = "Import fake data for Event programs, Tracker programs or Data Sets"
+    usage = "\nExample: dhis2-pk fake-data -s play.dhis2.org/demo -u admin -p district -i kla3mAPgvCH -n 100" \
+            "\nOffline: dhis2-pk fake-data --metadata program.json -i kla3mAPgvCH -n 100"
 
     parser = argparse.ArgumentParser(usage=usage, description=description)
-    required, optional = standard_arguments(parser)
+    required, optional = standard_arguments(parser, server_required=False)
     required.add_argument(
         '-i',
         dest='uid',
         required=True,
-        help='UID for program or data set to import fake data for. min: 1 - max: 100000'
+        help='UID for program or data set to import fake data for'
     )
     required.add_argument(
         '-n',
         dest='amount',
         required=True,
         type=int,
-        help='Amount of events or dataValueSet templates'
+        help='Amount of events, tracked entity instances or dataValueSet templates. min: 1'
     )
+    optional.add_argument('--seed', dest='seed', action='store', type=int, default=None,
+                          help="Seed for the random generator, to create reproducible data sets")
+    optional.add_argument('--gzip', dest='compress', action='store_true', default=False,
+                          help="Compress the payload files with gzip")
+    optional.add_argument('--chunk-size', dest='chunk_size', action='store', type=positive_int, default=50000,
+                          help="Events or data values per import job (default: 50000)")
+    optional.add_argument('--jobs', dest='jobs', action='store', type=positive_int, default=2,
+                          help="Import jobs to keep in flight while generating the next chunk (default: 2)")
+    optional.add_argument('--keep-files', dest='keep_files', action='store_true', default=False,
+                          help="Keep the payload files after they were imported")
+    optional.add_argument('--enrollments', dest='enrollments', action='store', type=positive_int, default=1,
+                          help="Tracker programs: enrollments per tracked entity instance (default: 1)")
+    optional.add_argument('--events', dest='events', action='store', type=positive_int, default=1,
+                          help="Tracker programs: events per repeatable program stage and enrollment (default: 1)")
+    optional.add_argument('--profile', dest='profile', action='store', metavar='FILE',
+                          help="JSON profile of value distributions, org unit weights, periods and sparsity")
+    optional.add_argument('--processes', dest='processes', action='store', type=positive_int, default=1,
+                          help="Processes to generate chunks with (default: 1)")
+    optional.add_argument('--metadata', dest='metadata', action='store', metavar='FILE',
+                          help="Metadata export (JSON) of the program or data set to use instead of the server's. "
+                               "Without -s and -u the payload files are only written, not imported")
     args = parser.parse_args(argv)
+    if not args.metadata and not (args.server and args.username):
+        raise PKClientException("-s and -u are required, unless payload files are only written with --metadata")
+    if bool(args.server) != bool(args.username):
+        raise PKClientException("-s and -u must be used together")
+    if not args.server:
+        return args, None
     return get_password(args)
 
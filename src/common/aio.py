@@ -0,0 +1,184 @@
+import asyncio
+import base64
+import json
+import time
+
+from dhis2 import RequestException, logger
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None  # commands fall back to the synchronous dhis2.Api
+
+try:
+    from src.common.utils import RETRY_STATUS_CODES
+    from src.common.exceptions import PKClientException
+    from src.common import stats
+except (SystemError, ImportError):
+    from common.utils import RETRY_STATUS_CODES
+    from common.exceptions import PKClientException
+    from common import stats
+
+# methods that are retried on RETRY_STATUS_CODES, like urllib3 does for the synchronous Api
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+
+def run(coroutine):
+    """Run a coroutine to completion from synchronous code, e.g. from a command's main()"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def gather(coroutines, limit=10, return_exceptions=False):
+    """
+    Like asyncio.gather, but with no more than `limit` coroutines running at the same time
+    :return: list of results in the order of `coroutines`
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def limited(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[limited(c) for c in coroutines], return_exceptions=return_exceptions)
+
+
+def query_params(params):
+    """
+    Turn requests-style params (dict or list of tuples, list values repeat the key)
+    into the list of string tuples that aiohttp expects
+    """
+    if not params:
+        return []
+    items = params.items() if isinstance(params, dict) else params
+    query = []
+    for key, value in items:
+        for v in value if isinstance(value, (list, tuple)) else [value]:
+            if v is not None:
+                query.append((key, str(v).lower() if isinstance(v, bool) else str(v)))
+    return query
+
+
+def retry_delay(retry_after, default):
+    """Seconds to wait from a Retry-After header, `default` if there is none or it is a date"""
+    try:
+        return max(0.0, float(retry_after))
+    except (TypeError, ValueError):
+        return default
+
+
+class AsyncApi(object):
+    """
+    asyncio counterpart of dhis2.Api to fan out many requests on a single thread.
+    It uses the server, credentials and connection options of an Api made by create_api:
+
+        async with AsyncApi(api) as aapi:
+            objects = await aapi.gather([aapi.get('identifiableObjects/{}'.format(uid)) for uid in uids])
+
+    Requests return the decoded JSON (instead of a response) and raise RequestException like dhis2.Api.
+    """
+
+    def __init__(self, api, limit=None, timeout=None, retries=None, backoff=0.5):
+        """
+        :param api: the synchronous Api, see create_api
+        :param limit: concurrent requests (default: the pool size of `api`)
+        :param timeout: seconds per request (default: the timeout of `api`)
+        :param retries: retries on connection errors, timeouts and RETRY_STATUS_CODES (default: the retries of `api`)
+        :param backoff: seconds to wait before the first retry, doubling for every retry
+        """
+        if aiohttp is None:
+            raise PKClientException("aiohttp is not installed - pip install dhis2-pocket-knife[async]")
+        adapter = api.session.get_adapter(api.api_url)
+        max_retries = getattr(adapter, 'max_retries', None)
+        self.api_url = api.api_url
+        self.headers = {k: v for k, v in api.session.headers.items() if k.lower() in ('user-agent', 'connection')}
+        self.headers['Authorization'] = 'Basic {}'.format(
+            base64.b64encode('{}:{}'.format(*api.session.auth).encode('utf-8')).decode('ascii'))
+        self.limit = limit or getattr(adapter, '_pool_maxsize', 10)
+        self.timeout = timeout if timeout is not None else getattr(adapter, 'timeout', None)
+        self.retries = max(0, retries if retries is not None else getattr(max_retries, 'total', None) or 0)
+        self.backoff = backoff
+        self._session = None
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession(
+            headers=self.headers,
+            connector=aiohttp.TCPConnector(limit=self.limit),
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._session.close()
+
+    async def request(self, method, endpoint, params=None, data=None):
+        """
+        Send a request, retry it on connection errors and, if idempotent, on timeouts and 429/502/503/504 responses
+        :return: the decoded JSON of the response, None if it has no body
+        """
+        url = '{}/{}'.format(self.api_url, endpoint)
+        idempotent = method in IDEMPOTENT_METHODS
+        reason = None
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2 ** attempt
+            start = time.time()
+            try:
+                async with self._session.request(method, url, params=query_params(params), json=data) as r:
+                    stats.record(method, url, r.status, len(json.dumps(data)) if data is not None else 0,
+                                 r.content_length or 0, start, time.time())
+                    if not (idempotent and r.status in RETRY_STATUS_CODES and attempt < self.retries):
+                        text = await r.text()
+                        if r.status >= 400:
+                            raise RequestException(code=r.status, url=str(r.url), description=text)
+                        return json.loads(text) if text else None
+                    delay = retry_delay(r.headers.get('Retry-After'), delay)
+                    reason = 'HTTP {}'.format(r.status)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                # requests that may have reached the server are only retried if they are idempotent
+                if attempt == self.retries or not (idempotent or isinstance(e, aiohttp.ClientConnectorError)):
+                    raise
+                reason = e
+            logger.debug("{} {} failed ({}) - retrying in {:.1f}s".format(method, endpoint, reason, delay))
+            await asyncio.sleep(delay)
+        raise PKClientException("{} {} failed after {} attempts ({})".format(
+            method, endpoint, self.retries + 1, reason))
+
+    async def get(self, endpoint, params=None):
+        return await self.request('GET', endpoint, params=params)
+
+    async def post(self, endpoint, data=None, params=None):
+        return await self.request('POST', endpoint, params=params, data=data)
+
+    async def put(self, endpoint, data=None, params=None):
+        return await self.request('PUT', endpoint, params=params, data=data)
+
+    async def gather(self, coroutines, limit=None, return_exceptions=False):
+        """See gather(), `limit` defaults to the client's limit"""
+        return await gather(coroutines, limit=limit or self.limit, return_exceptions=return_exceptions)
+
+    async def get_paged(self, endpoint, params=None, page_size=50, merge=False):
+        """
+        GET all pages: the first one, then all others concurrently.
+        Pages are sorted by id unless `params` sets an order, so objects don't move between pages.
+        :return: list of pages OR, with `merge`, a dict like {"organisationUnits": [...]}
+        """
+        query = query_params(params)
+        if any(key == 'paging' for key, _ in query):
+            raise PKClientException("Can't set paging manually in `params` when using `get_paged`")
+        if not any(key == 'order' for key, _ in query):
+            query.append(('order', 'id:asc'))
+
+        def page_params(page):
+            return query + [('pageSize', str(page_size)), ('page', str(page)), ('totalPages', 'true')]
+
+        first = await self.get(endpoint, params=page_params(1))
+        others = await self.gather([self.get(endpoint, params=page_params(page))
+                                    for page in range(2, first['pager']['pageCount'] + 1)])
+        pages = [first] + others
+        if not merge:
+            return pages
+        collection = endpoint.split('/')[0]
+        return {collection: [obj for page in pages for obj in page[collection]]}
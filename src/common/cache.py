@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+import time
+
+from dhis2 import logger
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.dhis2-pk', 'cache')
+
+
+def cache_key(*parts):
+    """Return a stable hash for the given string parts"""
+    return hashlib.sha1(u'\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+class JsonCache(object):
+    """Small persistent key-value cache stored as a JSON file, scoped to a server"""
+
+    def __init__(self, name, server, max_age=None, directory=CACHE_DIR):
+        """
+        :param name: name of the cache, e.g. 'expressions'
+        :param server: server URL the cached values belong to
+        :param max_age: seconds after which entries are considered stale (None: never)
+        :param directory: folder to store the cache file in
+        """
+        slug = server.replace('https://', '').replace('http://', '').replace('.', '-').replace('/', '-')
+        self.filename = os.path.join(directory, '{}_{}.json'.format(name, slug))
+        self.max_age = max_age
+        self._entries = {}
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                self._entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            self._entries = {}
+
+    def save(self):
+        if not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            tmp = '{}.tmp'.format(self.filename)
+            with open(tmp, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp, self.filename)
+            self._dirty = False
+        except (IOError, OSError) as e:
+            logger.warning("Could not write cache {}: {}".format(self.filename, e))
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        if self.max_age is not None and time.time() - entry['t'] > self.max_age:
+            return default
+        return entry['v']
+
+    def set(self, key, value):
+        self._entries[key] = {'v': value, 't': time.time()}
+        self._dirty = True
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,99 @@
+import time
+from collections import namedtuple, OrderedDict
+
+from dhis2 import logger
+
+# a finished job: task type, job UID, data passed to add(), task summary (None if it timed out),
+# error message (None if it succeeded) and duration in seconds
+FinishedJob = namedtuple('FinishedJob', 'task_type uid data summary error seconds')
+
+
+class _JobState(object):
+    def __init__(self, task_type, uid, data, delay):
+        self.task_type = task_type
+        self.uid = uid
+        self.data = data
+        self.delay = delay
+        self.started = time.monotonic()
+        self.next_poll = self.started + delay
+        self.last_seen = None
+
+
+class JobMonitor(object):
+    """
+    Track many async jobs (e.g. imports) through system/tasks.
+    Every job is polled with an exponentially growing delay up to a cap,
+    and only task entries that are new since its last poll are inspected.
+    """
+
+    def __init__(self, api, initial_delay=1.0, max_delay=30.0, factor=2.0, timeout=None):
+        """
+        :param api: the Api instance
+        :param initial_delay: seconds before the first poll of a job
+        :param max_delay: maximum seconds between polls of a job
+        :param factor: delay growth between polls
+        :param timeout: seconds after which a job is given up (None: never)
+        """
+        self.api = api
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.timeout = timeout
+        self._jobs = OrderedDict()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def add(self, task_type, uid, data=None):
+        """Start tracking a job, e.g. add('DATAVALUE_IMPORT', job_uid)"""
+        self._jobs[uid] = _JobState(task_type, uid, data, self.initial_delay)
+
+    def new_entries(self, job):
+        """Return the task entries of a job since the last poll - DHIS2 lists the newest entries first"""
+        entries = self.api.get('system/tasks/{}/{}'.format(job.task_type, job.uid)).json()
+        new = []
+        for entry in entries:
+            if job.last_seen is not None and entry.get('uid') == job.last_seen:
+                break
+            new.append(entry)
+        if entries:
+            job.last_seen = entries[0].get('uid')
+        return new
+
+    def _finish(self, job, error=None, summary=None):
+        del self._jobs[job.uid]
+        return FinishedJob(job.task_type, job.uid, job.data, summary, error, time.monotonic() - job.started)
+
+    def poll(self):
+        """
+        Poll the jobs that are due once
+        :return: list of FinishedJob
+        """
+        finished = []
+        now = time.monotonic()
+        for job in [j for j in self._jobs.values() if j.next_poll <= now]:
+            completed = [e for e in self.new_entries(job) if e.get('completed') is True]
+            if completed:
+                errors = [e.get('message') for e in completed if e.get('level') == 'ERROR']
+                summary = self.api.get('system/taskSummaries/{}/{}'.format(job.task_type, job.uid)).json()
+                finished.append(self._finish(job, error=' '.join(errors) or None, summary=summary))
+            elif self.timeout is not None and time.monotonic() - job.started > self.timeout:
+                logger.warning("Job {} ({}) did not finish within {}s".format(job.uid, job.task_type, self.timeout))
+                finished.append(self._finish(job, error='timed out'))
+            else:
+                job.delay = min(job.delay * self.factor, self.max_delay)
+                job.next_poll = time.monotonic() + job.delay
+        return finished
+
+    def wait(self, max_pending=0):
+        """
+        Poll until no more than `max_pending` jobs are still running
+        :return: generator of FinishedJob, as soon as they finish
+        """
+        while len(self._jobs) > max_pending:
+            finished = self.poll()
+            for job in finished:
+                yield job
+            if not finished and len(self._jobs) > max_pending:
+                next_poll = min(j.next_poll for j in self._jobs.values())
+                time.sleep(max(0.0, next_poll - time.monotonic()))
@@ -0,0 +1,35 @@
+# object types that can have Attribute Values
+attribute_object_types = {
+    'categories',
+    'categoryOptionCombos',
+    'categoryOptionGroupSets',
+    'categoryOptionGroups',
+    'categoryOptions',
+    'constants',
+    'dataElementGroupSets',
+    'dataElementGroups',
+    'dataElements',
+    'dataSets',
+    'documents',
+    'indicatorGroups',
+    'indicators',
+    'legends',
+    'legendSets',
+    'optionSets',
+    'options',
+    'organisationUnitGroupSets',
+    'organisationUnitGroups',
+    'organisationUnits',
+    'programIndicators',
+    'programStages',
+    'programs',
+    'sections',
+    'sqlViews',
+    'trackedEntityAttributes',
+    'trackedEntityTypes',
+    'trackedEntities',
+    'userGroups',
+    'users',
+    'validationRuleGroups',
+    'validationRules'
+}
@@ -0,0 +1,285 @@
+import json
+import math
+import re
+import threading
+import time
+from collections import namedtuple, OrderedDict, Counter
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from dhis2 import is_valid_uid, logger
+
+try:
+    from src.common.utils import API_HOOKS, human_size
+except (SystemError, ImportError):
+    from common.utils import API_HOOKS, human_size
+
+# an HTTP request: start and end are epoch seconds, end is when the response headers arrived
+Request = namedtuple('Request', 'method endpoint status bytes_out bytes_in start end')
+
+# a client phase, e.g. loading metadata
+Phase = namedtuple('Phase', 'name start end')
+
+# the recorder of the current run, None if --stats is not given
+recorder = None
+
+
+def endpoint_name(url):
+    """
+    Normalize a request URL so that requests to the same endpoint are grouped:
+    https://x.org/api/33/dataElements/fbfJHSPpUQD.json?fields=id -> dataElements/{uid}.json
+    """
+    path = urlparse(url).path
+    if '/api/' in path:
+        path = path.split('/api/', 1)[1]
+    segments = path.strip('/').split('/')
+    if segments and segments[0].isdigit():
+        segments = segments[1:]  # API version
+    return '/'.join(normalize_segment(s) for s in segments)
+
+
+def normalize_segment(segment):
+    name, dot, extension = segment.partition('.')
+    # 11 characters like a UID, but not a camelCase word like an endpoint (e.g. programRule)
+    if is_valid_uid(name) and not re.match(r'^[a-z]+(?:[A-Z][a-z]+)*$', name):
+        name = '{uid}'
+    elif name.isdigit():
+        name = '{id}'
+    return name + dot + extension
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+
+def busy_seconds(intervals):
+    """Seconds in which at least one of the (start, end) intervals is running"""
+    total = 0.0
+    current_start, current_end = None, None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    try:
+        return len(body)
+    except TypeError:
+        return 0  # a streamed file
+
+
+class CountingRaw(object):
+    """
+    Proxy of a urllib3 response that reports the bytes received on the wire once its body is read,
+    so that the response itself does not have to be kept to look them up later
+    """
+
+    def __init__(self, raw, callback):
+        self._raw = raw
+        self._callback = callback
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def stream(self, *args, **kwargs):
+        for chunk in self._raw.stream(*args, **kwargs):
+            yield chunk
+        self._report()
+
+    def read(self, *args, **kwargs):
+        data = self._raw.read(*args, **kwargs)
+        if not data:
+            self._report()
+        return data
+
+    def _report(self):
+        if self._callback is not None:
+            try:
+                self._callback(self._raw.tell())
+            except (AttributeError, TypeError, ValueError):
+                pass
+            self._callback = None
+
+
+class Stats(object):
+    """Collect HTTP requests and client phases of a run"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.requests = []
+        self.phases = []
+        self._lock = threading.Lock()
+
+    def record(self, method, url, status, bytes_out, bytes_in, start, end):
+        with self._lock:
+            self.requests.append(Request(method, endpoint_name(url), status, bytes_out, bytes_in, start, end))
+            return len(self.requests) - 1
+
+    def on_response(self, r, *args, **kwargs):
+        """requests response hook"""
+        end = time.time()
+        bytes_out = int(r.request.headers.get('Content-Length') or body_size(r.request.body))
+        index = self.record(r.request.method, r.url, r.status_code, bytes_out,
+                            int(r.headers.get('Content-Length') or 0), end - r.elapsed.total_seconds(), end)
+        # the body is only read after the hook - its size on the wire is counted while it is read
+        if r.raw is not None:
+            r.raw = CountingRaw(r.raw, lambda received: self.received(index, received))
+        return r
+
+    def instrument(self, api):
+        """Record every request of an Api's session"""
+        api.session.hooks['response'].append(self.on_response)
+
+    def add_phase(self, name, start, end):
+        with self._lock:
+            self.phases.append(Phase(name, start, end))
+
+    def received(self, index, bytes_in):
+        """Update the bytes received of a recorded request, e.g. when there was no Content-Length"""
+        with self._lock:
+            request = self.requests[index]
+            self.requests[index] = request._replace(bytes_in=max(request.bytes_in, bytes_in))
+
+    def summary(self, now=None):
+        """
+        :return: dict with totals, per endpoint (method, endpoint, count, errors, p50/p95/max latency, bytes)
+        and phase durations (summed up per phase name)
+        """
+        now = now or time.time()
+        requests = list(self.requests)
+        endpoints = OrderedDict()
+        for r in sorted(requests, key=lambda r: (r.endpoint, r.method)):
+            endpoints.setdefault((r.method, r.endpoint), []).append(r)
+
+        phases = OrderedDict()
+        for p in self.phases:
+            phases[p.name] = phases.get(p.name, 0.0) + p.end - p.start
+
+        wall = now - self.started
+        http = busy_seconds([(r.start, r.end) for r in requests])
+        return {
+            'seconds': round(wall, 3),
+            'requests': len(requests),
+            'bytes_out': sum(r.bytes_out for r in requests),
+            'bytes_in': sum(r.bytes_in for r in requests),
+            'http_seconds': round(http, 3),
+            'local_seconds': round(max(0.0, wall - http), 3),
+            'endpoints': [
+                {
+                    'method': method,
+                    'endpoint': endpoint,
+                    'count': len(group),
+                    'errors': sum(1 for r in group if r.status >= 400),
+                    'statuses': dict(Counter(r.status for r in group)),
+                    'p50_ms': round(percentile([r.end - r.start for r in group], 50) * 1000, 1),
+                    'p95_ms': round(percentile([r.end - r.start for r in group], 95) * 1000, 1),
+                    'max_ms': round(max(r.end - r.start for r in group) * 1000, 1),
+                    'bytes_out': sum(r.bytes_out for r in group),
+                    'bytes_in': sum(r.bytes_in for r in group)
+                }
+                for (method, endpoint), group in endpoints.items()
+            ],
+            'phases': [{'name': name, 'seconds': round(seconds, 3)} for name, seconds in phases.items()]
+        }
+
+
+def enable():
+    """Record the requests of every Api made by create_api from now on"""
+    global recorder
+    recorder = Stats()
+    API_HOOKS.append(recorder.instrument)
+    return recorder
+
+
+def disable():
+    global recorder
+    if recorder is not None and recorder.instrument in API_HOOKS:
+        API_HOOKS.remove(recorder.instrument)
+    recorder = None
+
+
+def record(method, url, status, bytes_out, bytes_in, start, end):
+    """Record a request that was not made with requests, e.g. by AsyncApi"""
+    if recorder is not None:
+        recorder.record(method, url, status, bytes_out, bytes_in, start, end)
+
+
+@contextmanager
+def phase(name):
+    """Time a client phase, e.g. `with stats.phase('load metadata'):` - does nothing without --stats"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        if recorder is not None:
+            recorder.add_phase(name, start, time.time())
+
+
+def timed(iterable, name):
+    """
+    Yield the items of an iterable, timing how long it takes to produce them as the phase `name`,
+    e.g. the generation of chunks that are imported while the next ones are generated
+    """
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def split_argument(argv):
+    """
+    Remove --stats or --stats=FILE from the command line arguments
+    :return: tuple of the remaining arguments, whether stats are enabled and the file to write them to (or None)
+    """
+    remaining, enabled, filename = [], False, None
+    for arg in argv:
+        if arg == '--stats':
+            enabled = True
+        elif arg.startswith('--stats='):
+            enabled, filename = True, arg.split('=', 1)[1]
+        else:
+            remaining.append(arg)
+    return remaining, enabled, filename
+
+
+def report(filename=None):
+    """Log the summary of the recorded run, and write it as JSON to `filename` if given"""
+    if recorder is None:
+        return
+    s = recorder.summary()
+    logger.info("Stats: {} requests in {:.1f}s - sent {}, received {} - "
+                "waiting for the server {:.1f}s, local processing {:.1f}s".format(
+                    s['requests'], s['seconds'], human_size(s['bytes_out']), human_size(s['bytes_in']),
+                    s['http_seconds'], s['local_seconds']))
+    if s['endpoints']:
+        logger.info("{:<7}{:<50}{:>7}{:>7}{:>9}{:>9}{:>9}{:>12}{:>12}".format(
+            'METHOD', 'ENDPOINT', 'COUNT', 'ERRORS', 'P50 ms', 'P95 ms', 'MAX ms', 'SENT', 'RECEIVED'))
+    for e in s['endpoints']:
+        logger.info("{:<7}{:<50}{:>7}{:>7}{:>9.0f}{:>9.0f}{:>9.0f}{:>12}{:>12}".format(
+            e['method'], e['endpoint'][:49], e['count'], e['errors'], e['p50_ms'], e['p95_ms'], e['max_ms'],
+            human_size(e['bytes_out']), human_size(e['bytes_in'])))
+    for p in s['phases']:
+        logger.info("Phase '{}': {:.1f}s".format(p['name'], p['seconds']))
+    if filename:
+        with open(filename, 'w') as f:
+            json.dump(s, f, indent=2)
+        logger.info("Stats written to {}".format(filename))
@@ -1,33 +1,442 @@
 import csv
-import sys
+import gzip
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import islice
+from urllib.parse import urlparse
 
-from dhis2 import Api, logger
+from dhis2 import Api, RequestException, logger
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     from __version__ import __version__
+    from common.exceptions import PKClientException
 except (SystemError, ImportError):
     from src.__version__ import __version__
+    from src.common.exceptions import PKClientException
 
 
-def create_api(server, username, password):
-    """Return a fully configured dhis2.Dhis instance
+# status codes that are retried - 429 and 503 respect a Retry-After header
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+# request bodies smaller than this are not worth compressing
+GZIP_MIN_SIZE = 1024
+
+# import endpoints that decode gzip request bodies - other endpoints don't read Content-Encoding
+GZIP_ENDPOINTS = ('metadata', 'dataValueSets', 'events', 'trackedEntityInstances')
+
+# create_api keyword arguments that can be set on the command line, see cmdline_parser.standard_arguments
+CONNECTION_OPTIONS = ('pool_size', 'keep_alive', 'timeout', 'retries', 'compress_requests')
+
+
+class ApiAdapter(HTTPAdapter):
+    """HTTPAdapter with a default timeout and optional gzip compression of import request bodies"""
+
+    __attrs__ = HTTPAdapter.__attrs__ + ['timeout', 'compress']
+
+    def __init__(self, timeout=None, compress=False, **kwargs):
+        self.timeout = timeout
+        self.compress = compress
+        super(ApiAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        if self.compress and is_import_endpoint(request.url):
+            gzip_body(request)
+        return super(ApiAdapter, self).send(request, **kwargs)
+
+
+def is_import_endpoint(url):
+    """Whether a request URL is one of GZIP_ENDPOINTS, e.g. https://x.org/api/37/dataValueSets?async=true"""
+    path = urlparse(url).path
+    if '/api/' not in path:
+        return False
+    segments = path.split('/api/', 1)[1].strip('/').split('/')
+    if segments[0].isdigit():
+        segments = segments[1:]  # API version
+    return len(segments) == 1 and segments[0].split('.')[0] in GZIP_ENDPOINTS
+
+
+def gzip_body(request):
+    """Compress the body of a prepared request in place, unless it is small, streamed or already encoded"""
+    body = request.body
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if not isinstance(body, bytes) or len(body) < GZIP_MIN_SIZE or 'Content-Encoding' in request.headers:
+        return
+    request.body = gzip.compress(body)
+    request.headers['Content-Encoding'] = 'gzip'
+    request.headers['Content-Length'] = str(len(request.body))
+
+
+# callables that get every Api made by create_api, e.g. to instrument its session (see stats.enable)
+API_HOOKS = []
+
+
+def create_api(server, username, password, pool_size=10, keep_alive=True, timeout=None, retries=3,
+               compress_requests=False):
+    """
+    Return a fully configured dhis2.Api instance
+    :param pool_size: connections to keep per host, should be at least the amount of concurrent requests
+    :param keep_alive: False to open a new connection for every request
+    :param timeout: default seconds to wait for the server to connect and to respond (None: forever)
+    :param retries: retries on connection errors, and of idempotent requests on 429, 502, 503 and 504 responses
+    :param compress_requests: gzip request bodies of imports (GZIP_ENDPOINTS)
+    """
+    api = Api(server=server, username=username, password=password, user_agent='dhis2-pk/{}'.format(__version__))
+    max_retries = Retry(
+        total=retries,
+        status_forcelist=RETRY_STATUS_CODES,
+        backoff_factor=0.5,
+        respect_retry_after_header=True,
+        raise_on_status=False  # the last response is returned so that it raises a RequestException as before
+    )
+    adapter = ApiAdapter(timeout=timeout, compress=compress_requests, pool_connections=pool_size,
+                         pool_maxsize=pool_size, max_retries=max_retries)
+    api.session.mount('https://', adapter)
+    api.session.mount('http://', adapter)
+    if not keep_alive:
+        api.session.headers['Connection'] = 'close'
+    for hook in API_HOOKS:
+        hook(api)
+    return api
+
+
+def connection_options(args):
+    """create_api keyword arguments of the parsed command line arguments"""
+    return {option: getattr(args, option) for option in CONNECTION_OPTIONS if hasattr(args, option)}
+
+
+def retry_idempotent(api, func, *args, **kwargs):
+    """
+    Call func(api, *args, **kwargs) and retry it on RequestException with RETRY_STATUS_CODES,
+    as many times as the Api's adapter retries. urllib3 only retries idempotent methods on these responses,
+    so this is for calls that are idempotent although their method is not, e.g. read-only POSTs or a JSON Patch.
+    Connection errors are already retried by the adapter for all methods.
     """
-    return Api(server=server, username=username, password=password, user_agent='dhis2-pk/{}'.format(__version__))
+    try:
+        max_retries = api.session.get_adapter(api.api_url).max_retries
+    except AttributeError:
+        max_retries = None  # not an Api made by create_api: call once
+    retries = getattr(max_retries, 'total', None) or 0
+    backoff = getattr(max_retries, 'backoff_factor', 0.5)
+    for attempt in range(retries + 1):
+        try:
+            return func(api, *args, **kwargs)
+        except RequestException as e:
+            if e.code not in RETRY_STATUS_CODES or attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            logger.debug("HTTP {} - retrying in {:.1f}s".format(e.code, delay))
+            time.sleep(delay)
+
+
+def chunks(iterable, size):
+    """Yield lists of up to `size` items of any iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_pages(api, endpoint, params=None, page_size=50, workers=1):
+    """
+    GET a collection page by page and yield the pages in order.
+    After the first page, up to `workers` pages are fetched concurrently,
+    and only that many pages are held in memory at once.
+    Pages are sorted by id unless `params` sets an order, so objects don't move between pages.
+    :param api: the Api instance
+    :param endpoint: DHIS2 API endpoint, e.g. 'users'
+    :param params: HTTP parameters (dict), without paging parameters
+    :param page_size: how many objects per page
+    :param workers: how many pages to fetch concurrently
+    :return: generator of pages, e.g. {"pager": {...}, "users": [...]}
+    """
+    params = dict(params or {})
+    params.setdefault('order', 'id:asc')
+    params.update({'pageSize': page_size, 'page': 1, 'totalPages': True})
+
+    def fetch(page):
+        return api.get(endpoint, params=dict(params, page=page)).json()
+
+    first = fetch(1)
+    yield first
+
+    pages = iter(range(2, first['pager']['pageCount'] + 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = deque(executor.submit(fetch, page) for page in islice(pages, workers))
+        while futures:
+            page = futures.popleft().result()
+            for next_page in islice(pages, 1):
+                futures.append(executor.submit(fetch, next_page))
+            yield page
+
+
+class RowWriter(object):
+    """
+    Base class for writing exported rows to a file, one row at a time.
+    Subclasses implement open/write/close and set the file extension.
+    List-valued columns (see `list_fields`) are kept as arrays where the format supports it.
+    """
+    extension = None
+
+    def __init__(self, filename, header_row, compress=False, list_fields=None):
+        """
+        :param filename: file path to write to
+        :param header_row: column names, rows must be ordered like it
+        :param compress: compress the output
+        :param list_fields: dict of list-valued column name -> separator for formats without arrays
+        """
+        self.filename = filename
+        self.header_row = list(header_row)
+        self.compress = compress
+        self.list_fields = list_fields or {}
+        self.count = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self):
+        raise NotImplementedError
+
+    def write(self, row):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write(row)
+            self.count += 1
+        return self.count
+
+
+class CsvWriter(RowWriter):
+    """Write rows to CSV, joining list-valued columns with their separator"""
+    extension = 'csv'
+
+    def open(self):
+        opener = gzip.open if self.compress else open
+        self._fp = opener(self.filename, 'wt', newline='')
+        self._writer = csv.writer(self._fp, delimiter=str(','))
+        self._writer.writerow(self.header_row)
+        self._separators = [self.list_fields.get(column) for column in self.header_row]
+
+    def write(self, row):
+        if self.list_fields:
+            row = [sep.join(value) if sep is not None else value for sep, value in zip(self._separators, row)]
+        self._writer.writerow(row)
+
+    def close(self):
+        self._fp.close()
+
+
+class JsonLinesWriter(RowWriter):
+    """Write rows as one JSON object per line"""
+    extension = 'jsonl'
+
+    def open(self):
+        opener = gzip.open if self.compress else open
+        self._fp = opener(self.filename, 'wt', encoding='utf-8')
+
+    def write(self, row):
+        self._fp.write(json.dumps(dict(zip(self.header_row, row)), ensure_ascii=False))
+        self._fp.write('\n')
+
+    def close(self):
+        self._fp.close()
+
+
+class ParquetWriter(RowWriter):
+    """Write rows to a Parquet file in row groups (requires pyarrow)"""
+    extension = 'parquet'
+    batch_size = 10000
+
+    def open(self):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise PKClientException("Parquet export requires pyarrow: pip install pyarrow")
+        self._pa = pyarrow
+        self._schema = pyarrow.schema([
+            (column, pyarrow.list_(pyarrow.string()) if column in self.list_fields else pyarrow.string())
+            for column in self.header_row
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(
+            self.filename, self._schema, compression='gzip' if self.compress else 'snappy'
+        )
+        self._batch = []
+
+    def write(self, row):
+        self._batch.append(row)
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self._batch:
+            columns = [list(column) for column in zip(*self._batch)]
+            self._writer.write_table(self._pa.Table.from_arrays(columns, schema=self._schema))
+            self._batch = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+row_writers = {
+    'csv': CsvWriter,
+    'jsonl': JsonLinesWriter,
+    'parquet': ParquetWriter
+}
+
+
+def export_filename(name, fmt='csv', compress=False):
+    """Return the file name for an export format, with .gz suffix for compressed text formats"""
+    filename = '{}.{}'.format(name, row_writers[fmt].extension)
+    return '{}.gz'.format(filename) if compress and fmt != 'parquet' else filename
+
+
+def write_rows(rows, filename, header_row, fmt='csv', compress=False, list_fields=None):
+    """Write rows (any iterable, e.g. a generator) in the given format. Returns the amount of rows written."""
+    try:
+        writer_class = row_writers[fmt]
+    except KeyError:
+        raise PKClientException("Export format not supported: {}".format(fmt))
+    with writer_class(filename, header_row, compress=compress, list_fields=list_fields) as writer:
+        return writer.write_rows(rows)
+
+
+def check_columns(filename, header_row):
+    """
+    Raise PKClientException if a CSV or JSON lines export (optionally gzipped) has other columns than `header_row`.
+    Only reads its header or first line, e.g. to check a previous export before a new one is written.
+    """
+    compressed = filename.endswith('.gz')
+    base = filename[:-3] if compressed else filename
+    opener = gzip.open if compressed else open
+
+    if base.endswith('.csv'):
+        with opener(filename, 'rt', newline='') as fp:
+            matches = next(csv.reader(fp, delimiter=str(',')), None) == list(header_row)
+    elif base.endswith('.jsonl'):
+        with opener(filename, 'rt', encoding='utf-8') as fp:
+            line = fp.readline()
+            matches = not line or set(json.loads(line)) == set(header_row)
+    else:
+        raise PKClientException("Can only read CSV or JSON lines exports: {}".format(filename))
+    if not matches:
+        raise PKClientException("Columns of {} do not match the export".format(filename))
+
+
+def read_rows(filename, header_row, list_fields=None):
+    """
+    Read back rows of a CSV or JSON lines export (optionally gzipped), ordered like `header_row`.
+    List-valued columns are split on their separator for CSV files.
+    """
+    list_fields = list_fields or {}
+    compressed = filename.endswith('.gz')
+    base = filename[:-3] if compressed else filename
+    opener = gzip.open if compressed else open
+
+    if base.endswith('.csv'):
+        with opener(filename, 'rt', newline='') as fp:
+            reader = csv.reader(fp, delimiter=str(','))
+            if next(reader, None) != list(header_row):
+                raise PKClientException("Columns of {} do not match the export".format(filename))
+            separators = [list_fields.get(column) for column in header_row]
+            for row in reader:
+                yield [
+                    (value.split(sep) if value else []) if sep is not None else value
+                    for sep, value in zip(separators, row)
+                ]
+
+    elif base.endswith('.jsonl'):
+        with opener(filename, 'rt', encoding='utf-8') as fp:
+            for line in fp:
+                obj = json.loads(line)
+                if set(obj) != set(header_row):
+                    raise PKClientException("Columns of {} do not match the export".format(filename))
+                yield [obj[column] for column in header_row]
+
+    else:
+        raise PKClientException("Can only read CSV or JSON lines exports: {}".format(filename))
+
+
+class JsonPayloadWriter(object):
+    """
+    Write a JSON import payload like {"events": [...]} one object at a time,
+    so the payload never has to be held in memory
+    """
+
+    def __init__(self, filename, key, compress=False):
+        """
+        :param filename: file path to write to
+        :param key: key of the object array, e.g. 'events' or 'dataValues'
+        :param compress: compress the file with gzip
+        """
+        self.filename = filename
+        self.key = key
+        self.compress = compress
+        self.count = 0
+
+    def __enter__(self):
+        opener = gzip.open if self.compress else open
+        self._fp = opener(self.filename, 'wt', encoding='utf-8')
+        self._fp.write('{{{}: ['.format(json.dumps(self.key)))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._fp.write(']}')
+        self._fp.close()
+
+    def write(self, obj):
+        if self.count:
+            self._fp.write(',')
+        self._fp.write(json.dumps(obj, separators=(',', ':')))
+        self.count += 1
+
+    def write_all(self, objects):
+        for obj in objects:
+            self.write(obj)
+        return self.count
+
+
+def post_file(api, endpoint, filename, params=None):
+    """
+    POST a JSON file, streamed from disk instead of loaded into memory.
+    Gzip files are sent as they are - DHIS2 detects the compression
+    """
+    with open(filename, 'rb') as f:
+        r = api.session.post('{}/{}'.format(api.api_url, endpoint), data=f, params=params,
+                             headers={'Content-Type': 'application/json'})
+    if not r.ok:
+        raise RequestException(code=r.status_code, url=r.url, description=r.text)
+    return r
+
 
+def human_size(bytes_num, units=None):
+    """ Returns a human readable string representation of bytes """
+    units = [' bytes', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB'] if not units else units
+    return str(bytes_num) + units[0] if bytes_num < 1024 else human_size(bytes_num >> 10, units[1:])
 
-def write_csv(data, filename, header_row):
-    """Write CSV data for both Python2 and Python3"""
-    kwargs = {'newline': ''}
-    mode = 'w'
-    if sys.version_info < (3, 0):
-        kwargs.pop('newline', None)
-        mode = 'wb'
 
-    with open(filename, mode, **kwargs) as fp:
-        writer = csv.writer(fp, delimiter=str(','))
-        writer.writerow(header_row)
-        writer.writerows(data)
+def write_csv(rows, filename, header_row, compress=False):
+    """Write CSV rows one by one so that rows can be streamed from a generator.
+    Compress with gzip if `compress` is True. Returns the amount of rows written."""
+    return write_rows(rows, filename, header_row, fmt='csv', compress=compress)
 
 
 def file_timestamp(url):
@@ -12,10 +12,10 @@ import os
 from dhis2 import setup_logger, logger
 
 try:
-    from src.common.utils import create_api
+    from src.common.utils import create_api, connection_options
     from src.common.exceptions import PKClientException
 except (SystemError, ImportError):
-    from common.utils import create_api
+    from common.utils import create_api, connection_options
     from common.exceptions import PKClientException
 
 
@@ -34,7 +34,7 @@ def validate_file(filename):
 
 def main(args, password):
     setup_logger(include_caller=False)
-    api = create_api(server=args.server, username=args.username, password=password)
+    api = create_api(server=args.server, username=args.username, password=password, **connection_options(args))
     validate_file(args.css)
     post_file(api, filename=args.css)
     logger.info("{} CSS posted to {}. Clear your Browser cache / use Incognito.".format(args.css, api.api_url))
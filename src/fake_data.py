@@ -2,21 +2,49 @@
 # -*- coding: utf-8 -*-
 import datetime
 import json
+import math
 import os
 import random
 import sys
 import time
-import uuid
+from bisect import bisect
+from collections import namedtuple, Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice, accumulate
 
 from dhis2 import Api, setup_logger, logger, is_valid_uid, RequestException, generate_uid
 
 try:
-    from common.utils import create_api, file_timestamp, write_csv
+    import numpy as np
+except ImportError:
+    np = None  # values are generated with the pure Python fallback
+
+try:
+    from common.utils import create_api, connection_options, file_timestamp, write_csv, JsonPayloadWriter, \
+        post_file, human_size
+    from common.jobs import JobMonitor
+    from common import stats
     from common.exceptions import PKClientException
 except (SystemError, ImportError):
-    from src.common.utils import create_api, file_timestamp, write_csv
+    from src.common.utils import create_api, connection_options, file_timestamp, write_csv, JsonPayloadWriter, \
+        post_file, human_size
+    from src.common.jobs import JobMonitor
+    from src.common import stats
     from src.common.exceptions import PKClientException
 
+# events or template copies to generate values for at once, keeps memory use constant for any amount
+GENERATE_CHUNK_SIZE = 10000
+
+# events or data values per import job
+CHUNK_SIZE = 50000
+
+# async import: API endpoint, key of the payload's object array and system/tasks category
+ImportType = namedtuple('ImportType', 'endpoint key task_type')
+EVENT_IMPORT = ImportType('events', 'events', 'EVENT_IMPORT')
+DATAVALUE_IMPORT = ImportType('dataValueSets', 'dataValues', 'DATAVALUE_IMPORT')
+TEI_IMPORT = ImportType('trackedEntityInstances', 'trackedEntityInstances', 'TEI_IMPORT')
+
 
 def last_years(years: int = -2) -> list:
     """Return a list of years ending with this year"""
@@ -62,7 +90,7 @@ def random_data_value(value_type: str, org_units: list) -> str:
     elif value_type == 'BOOLEAN':
         return str(bool(random.getrandbits(1))).lower()
     elif value_type in ('LONG_TEXT', 'TEXT'):
-        return str(uuid.uuid4())[:8]
+        return f"{random.getrandbits(32):08x}"
     elif value_type == 'TRUE_ONLY':
         return 'true' if bool(random.getrandbits(1)) else None
     elif value_type == 'NEGATIVE_INTEGER':
@@ -74,7 +102,7 @@ def random_data_value(value_type: str, org_units: list) -> str:
     elif value_type == 'ORGANISATION_UNIT':
         return random.choice(org_units)
     elif value_type == 'URL':
-        return f"https://{str(uuid.uuid4())[:8]}.org/"
+        return f"https://{random.getrandbits(32):08x}.org/"
     elif value_type == 'DATE':
         return str(random_date().strftime('%Y-%m-%d'))
     elif value_type == 'DATETIME':
@@ -98,13 +126,387 @@ def random_period(period_type: str) -> str:
         year = random.choice(last_years())
         return f"{year}Q{quarter}"
     else:
-        raise ValueError(f"Not yet supported period: {period_type}")
+        today = datetime.date.today()
+        return random.choice(enumerate_periods(period_type, datetime.date(today.year - 1, 1, 1), today))[0]
+
+
+# week start (Monday: 0) and period ID infix of weekly period types
+WEEKLY_PERIOD_TYPES = {
+    'Weekly': (0, 'W'),
+    'WeeklyWednesday': (2, 'WedW'),
+    'WeeklyThursday': (3, 'ThuW'),
+    'WeeklySaturday': (5, 'SatW'),
+    'WeeklySunday': (6, 'SunW'),
+    'BiWeekly': (0, 'BiW')
+}
+
+# months per period and a month any period starts with
+MONTHLY_PERIOD_TYPES = {
+    'Monthly': (1, 1),
+    'BiMonthly': (2, 1),
+    'Quarterly': (3, 1),
+    'SixMonthly': (6, 1),
+    'SixMonthlyApril': (6, 4),
+    'SixMonthlyNov': (6, 11),
+    'Yearly': (12, 1),
+    'FinancialApril': (12, 4),
+    'FinancialJuly': (12, 7),
+    'FinancialOct': (12, 10),
+    'FinancialNov': (12, 11)
+}
+
+
+def _monthly_period_id(period_type: str, year: int, month: int) -> str:
+    if period_type == 'Monthly':
+        return f"{year}{month:02d}"
+    elif period_type == 'BiMonthly':
+        return f"{year}{(month + 1) // 2:02d}B"
+    elif period_type == 'Quarterly':
+        return f"{year}Q{(month + 2) // 3}"
+    elif period_type == 'SixMonthly':
+        return f"{year}S{(month + 5) // 6}"
+    elif period_type == 'SixMonthlyApril':
+        return f"{year}AprilS{1 if month == 4 else 2}"
+    elif period_type == 'SixMonthlyNov':
+        # S1 starts in November of the year before
+        return f"{year + 1}NovS1" if month == 11 else f"{year}NovS2"
+    elif period_type == 'Yearly':
+        return str(year)
+    else:
+        return f"{year}{period_type[len('Financial'):]}"
+
+
+def _week_one(year: int, weekday: int) -> datetime.date:
+    """Return the start of week 1 of a year: the week starting on `weekday` that contains January 4"""
+    jan4 = datetime.date(year, 1, 4)
+    return jan4 - datetime.timedelta(days=(jan4.weekday() - weekday) % 7)
+
+
+def enumerate_periods(period_type: str, start: datetime.date, end: datetime.date) -> list:
+    """Return a list of (period ID, start date) of all periods of a DHIS2 period type starting between start and end"""
+    periods = []
+    if period_type == 'Daily':
+        day = start
+        while day <= end:
+            periods.append((day.strftime('%Y%m%d'), day))
+            day += datetime.timedelta(days=1)
+    elif period_type in WEEKLY_PERIOD_TYPES:
+        weekday, infix = WEEKLY_PERIOD_TYPES[period_type]
+        day = start + datetime.timedelta(days=(weekday - start.weekday()) % 7)
+        while day <= end:
+            # a week belongs to the year it has at least 4 days in
+            year = (day + datetime.timedelta(days=3)).year
+            week = (day - _week_one(year, weekday)).days // 7 + 1
+            if period_type != 'BiWeekly':
+                periods.append((f"{year}{infix}{week}", day))
+            elif week % 2 == 1:
+                periods.append((f"{year}{infix}{(week + 1) // 2}", day))
+            day += datetime.timedelta(days=7)
+    elif period_type in MONTHLY_PERIOD_TYPES:
+        months, first_month = MONTHLY_PERIOD_TYPES[period_type]
+        year, month = start.year, start.month
+        while datetime.date(year, month, 1) <= end:
+            if (month - first_month) % months == 0 and datetime.date(year, month, 1) >= start:
+                periods.append((_monthly_period_id(period_type, year, month), datetime.date(year, month, 1)))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    else:
+        raise ValueError(f"Not supported period type: {period_type}")
+    return periods
+
+
+def create_rng(seed: int = None):
+    """
+    Seed Python's random module and return a NumPy random Generator with the same seed,
+    or None if NumPy is not installed (then the pure Python functions are used)
+    """
+    random.seed(seed)
+    return np.random.default_rng(seed) if np is not None else None
+
+
+def random_choices(population: list, amount: int, rng=None, weights: list = None) -> list:
+    """Return a column of random choices, e.g. of option codes or org units, optionally weighted"""
+    if rng is None:
+        if weights:
+            return random.choices(population, weights=weights, k=amount)
+        return [random.choice(population) for _ in range(amount)]
+    if weights:
+        p = np.asarray(weights, dtype=float)
+        return np.asarray(population)[rng.choice(len(population), amount, p=p / p.sum())].tolist()
+    return np.asarray(population)[rng.integers(0, len(population), amount)].tolist()
+
+
+# profile of distributions, weights and coverage, see load_profile
+Profile = namedtuple('Profile', 'value_types org_unit_skew org_unit_weights start end seasonality sparsity')
+
+# distributions and their parameters with defaults
+DISTRIBUTIONS = {
+    'gauss': {'mu': 100, 'sigma': 49},
+    'uniform': {'low': 0, 'high': 100},
+    'lognormal': {'mu': 4, 'sigma': 1},
+    'poisson': {'lam': 10}
+}
+
+# lower and upper bounds of numeric valueTypes
+NUMERIC_VALUE_TYPES = {
+    'INTEGER': (None, None),
+    'NUMBER': (None, None),
+    'INTEGER_POSITIVE': (1, None),
+    'INTEGER_ZERO_OR_POSITIVE': (0, None),
+    'NEGATIVE_INTEGER': (None, -1),
+    'PERCENTAGE': (0, 100),
+    'UNIT_INTERVAL': (0, 1)
+}
+
+
+def load_profile(path: str) -> Profile:
+    """
+    Load a JSON profile file, e.g.
+    {
+      "valueTypes": {"INTEGER": {"distribution": "lognormal", "mu": 4, "sigma": 1}},
+      "orgUnits": {"skew": 1.1, "weights": {"DiszpKrYNg8": 50}},
+      "periods": {"start": "2020-01-01", "end": "2021-12-31", "seasonality": [1, 1, 2, 3, 5, 5, 3, 2, 1, 1, 1, 1]},
+      "sparsity": 0.2
+    }
+    """
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        raise PKClientException(f"Could not read profile {path}: {e}")
+
+    value_types = {}
+    for value_type, spec in data.get('valueTypes', {}).items():
+        distribution = spec.get('distribution', 'gauss')
+        if value_type not in NUMERIC_VALUE_TYPES:
+            raise PKClientException(f"Profile: distributions are only supported for {', '.join(NUMERIC_VALUE_TYPES)}")
+        if distribution not in DISTRIBUTIONS:
+            raise PKClientException(f"Profile: distribution must be one of {', '.join(DISTRIBUTIONS)}")
+        value_types[value_type] = dict(DISTRIBUTIONS[distribution])
+        value_types[value_type].update(spec, distribution=distribution)
+
+    today = datetime.date.today()
+    periods = data.get('periods', {})
+    try:
+        start = datetime.datetime.strptime(periods['start'], '%Y-%m-%d').date() if 'start' in periods \
+            else datetime.date(today.year - 1, 1, 1)
+        end = datetime.datetime.strptime(periods['end'], '%Y-%m-%d').date() if 'end' in periods else today
+    except ValueError:
+        raise PKClientException("Profile: period start and end must be dates like 2020-12-31")
+    seasonality = periods.get('seasonality')
+    if seasonality is not None and (len(seasonality) != 12 or min(seasonality) < 0 or not sum(seasonality)):
+        raise PKClientException("Profile: seasonality must be 12 monthly weights")
+    sparsity = data.get('sparsity', 0)
+    if not 0 <= sparsity < 1:
+        raise PKClientException("Profile: sparsity must be between 0 and 1")
+    if end < start:
+        raise PKClientException("Profile: period end is before start")
+
+    org_units = data.get('orgUnits', {})
+    return Profile(value_types, org_units.get('skew'), org_units.get('weights', {}), start, end, seasonality, sparsity)
+
+
+def org_unit_weights(profile: Profile, org_units: list):
+    """
+    Return weights for the org units: explicit weights of the profile,
+    or for the others a Zipf-like weight by their position if the profile has a skew
+    """
+    if profile is None or not (profile.org_unit_skew or profile.org_unit_weights):
+        return None
+    skew = profile.org_unit_skew or 0
+    return [profile.org_unit_weights.get(ou, 1 / (i + 1) ** skew) for i, ou in enumerate(org_units)]
+
+
+def seasonal_weights(profile: Profile, dates: list):
+    """Return the weights of dates by the profile's monthly seasonality"""
+    if profile is None or profile.seasonality is None:
+        return None
+    return [profile.seasonality[d.month - 1] for d in dates]
+
+
+def _poisson(lam: float) -> int:
+    if lam > 100:
+        return max(0, int(round(random.gauss(lam, lam ** 0.5))))
+    limit, k, p = math.exp(-lam), 0, random.random()
+    while p > limit:
+        k += 1
+        p *= random.random()
+    return k
+
+
+def random_numbers(value_type: str, spec: dict, amount: int, rng=None) -> list:
+    """Return a column of numbers of a numeric valueType drawn from a profile distribution"""
+    distribution = spec['distribution']
+    low, high = NUMERIC_VALUE_TYPES[value_type]
+    if rng is None:
+        draw = {
+            'gauss': lambda: random.gauss(spec['mu'], spec['sigma']),
+            'uniform': lambda: random.uniform(spec['low'], spec['high']),
+            'lognormal': lambda: random.lognormvariate(spec['mu'], spec['sigma']),
+            'poisson': lambda: _poisson(spec['lam'])
+        }[distribution]
+        numbers = [draw() for _ in range(amount)]
+        if low is not None:
+            numbers = [max(x, low) for x in numbers]
+        if high is not None:
+            numbers = [min(x, high) for x in numbers]
+        if value_type == 'UNIT_INTERVAL':
+            return [str(round(x, 4)) for x in numbers]
+        return [str(int(round(x))) for x in numbers]
+
+    if distribution == 'gauss':
+        numbers = rng.normal(spec['mu'], spec['sigma'], amount)
+    elif distribution == 'uniform':
+        numbers = rng.uniform(spec['low'], spec['high'], amount)
+    elif distribution == 'lognormal':
+        numbers = rng.lognormal(spec['mu'], spec['sigma'], amount)
+    else:
+        numbers = rng.poisson(spec['lam'], amount).astype(float)
+    if low is not None:
+        numbers = np.maximum(numbers, low)
+    if high is not None:
+        numbers = np.minimum(numbers, high)
+    if value_type == 'UNIT_INTERVAL':
+        return np.round(numbers, 4).astype(str).tolist()
+    return np.rint(numbers).astype(np.int64).astype(str).tolist()
+
+
+def random_profile_dates(amount: int, profile: Profile, rng=None) -> list:
+    """Return a column of dates (YYYY-MM-DD) between the profile's start and end, weighted by its seasonality"""
+    days = [profile.start + datetime.timedelta(days=d) for d in range((profile.end - profile.start).days + 1)]
+    return random_choices([d.strftime('%Y-%m-%d') for d in days], amount, rng, seasonal_weights(profile, days))
+
+
+def sparse(values: list, sparsity: float, rng=None) -> list:
+    """Leave out (set to None) a share of `sparsity` values"""
+    if not sparsity:
+        return values
+    if rng is None:
+        return [v if random.random() >= sparsity else None for v in values]
+    keep = (rng.random(len(values)) >= sparsity).tolist()
+    return [v if k else None for v, k in zip(values, keep)]
 
 
-def human_size(bytes_num: int, units=None) -> str:
-    """ Returns a human readable string representation of bytes """
-    units = [' bytes', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB'] if not units else units
-    return str(bytes_num) + units[0] if bytes_num < 1024 else human_size(bytes_num >> 10, units[1:])
+def _hex_strings(amount: int, rng):
+    return np.char.mod('%08x', rng.integers(0, 2 ** 32, amount, dtype=np.uint64))
+
+
+def random_dates(amount: int, rng=None):
+    """Return a NumPy array of random dates between January 1 of last year and today"""
+    today = datetime.date.today()
+    start_date = datetime.date(today.year - 1, 1, 1)
+    days = rng.integers(0, (today - start_date).days, amount)
+    return np.datetime64(start_date, 'D') + days
+
+
+def random_data_values(value_type: str, amount: int, org_units: list, rng=None, profile: Profile = None) -> list:
+    """
+    Return a column of random data values for a DHIS2 data element valueType,
+    vectorized with NumPy if a Generator is given (see create_rng)
+    and drawn from the distributions and date coverage of a profile, if given
+    """
+    if profile is not None:
+        if value_type in profile.value_types:
+            return random_numbers(value_type, profile.value_types[value_type], amount, rng)
+        if value_type == 'DATE':
+            return random_profile_dates(amount, profile, rng)
+        if value_type == 'ORGANISATION_UNIT':
+            return random_choices(org_units, amount, rng, org_unit_weights(profile, org_units))
+    if rng is None:
+        return [random_data_value(value_type, org_units) for _ in range(amount)]
+
+    if value_type in ('INTEGER_POSITIVE', 'INTEGER'):
+        values = np.abs(rng.normal(100, 49, amount).astype(np.int64)).astype(str)
+    elif value_type == 'INTEGER_ZERO_OR_POSITIVE':
+        values = np.abs(rng.normal(200, 49, amount).astype(np.int64)).astype(str)
+    elif value_type == 'NUMBER':
+        values = rng.normal(100, 49, amount).astype(np.int64).astype(str)
+    elif value_type == 'BOOLEAN':
+        values = np.where(rng.integers(0, 2, amount).astype(bool), 'true', 'false')
+    elif value_type in ('LONG_TEXT', 'TEXT'):
+        values = _hex_strings(amount, rng)
+    elif value_type == 'TRUE_ONLY':
+        return [('true' if b else None) for b in rng.integers(0, 2, amount).astype(bool).tolist()]
+    elif value_type == 'NEGATIVE_INTEGER':
+        values = rng.integers(-1000, 0, amount).astype(str)
+    elif value_type == 'PERCENTAGE':
+        values = rng.integers(0, 101, amount).astype(str)
+    elif value_type == 'UNIT_INTERVAL':
+        values = np.round(rng.uniform(0, 1, amount), 4).astype(str)
+    elif value_type == 'ORGANISATION_UNIT':
+        return random_choices(org_units, amount, rng)
+    elif value_type == 'URL':
+        values = np.char.add(np.char.add('https://', _hex_strings(amount, rng)), '.org/')
+    elif value_type == 'DATE':
+        values = random_dates(amount, rng).astype(str)
+    elif value_type == 'DATETIME':
+        # like random_time(): up to 101 days ago
+        seconds = (rng.integers(1, 101, amount) * 86400 + rng.integers(1, 25, amount) * 3600
+                   + rng.integers(1, 61, amount) * 60 + rng.integers(1, 61, amount))
+        times = np.datetime64(datetime.datetime.now().replace(microsecond=0), 's') - seconds
+        values = np.char.add(times.astype(str), '.000000')
+    elif value_type == 'TIME':
+        values = np.char.add(np.char.mod('%02d:', rng.integers(0, 60, amount)),
+                             np.char.mod('%02d', rng.integers(0, 60, amount)))
+    elif value_type == 'EMAIL':
+        return ["mail@example.org"] * amount
+    else:
+        logger.warning(f"Not supported valueType: {value_type}")
+        return [None] * amount
+    return values.tolist()
+
+
+def random_column(value_type: str, options: list, amount: int, org_units: list, rng=None,
+                  profile: Profile = None) -> list:
+    """
+    Return a column of random option codes if there are options, else of random values for the valueType.
+    Values are left out according to the profile's sparsity.
+    """
+    if options:
+        values = random_choices(options, amount, rng)
+    else:
+        values = random_data_values(value_type, amount, org_units, rng, profile)
+    return sparse(values, profile.sparsity, rng) if profile is not None else values
+
+
+def period_population(period_type: str, profile: Profile = None) -> tuple:
+    """
+    Return the periods random periods are chosen from and their weights (None: uniform):
+    the periods between the profile's start and end weighted by its seasonality, or without a profile
+    the periods random_period() returns
+    """
+    today = datetime.date.today()
+    if profile is None and period_type == 'Yearly':
+        return [str(y) for y in last_years()], None
+    if profile is None and period_type == 'Quarterly':
+        return [f"{y}Q{q}" for y in last_years() for q in range(1, 5)], None
+    start, end = (profile.start, profile.end) if profile is not None \
+        else (datetime.date(today.year - 1, 1, 1), today)
+    periods = enumerate_periods(period_type, start, end)
+    if not periods:
+        raise PKClientException(f"No {period_type} periods start between {start} and {end}")
+    return [p[0] for p in periods], seasonal_weights(profile, [p[1] for p in periods])
+
+
+def random_periods(period_type: str, amount: int, rng=None, profile: Profile = None) -> list:
+    """
+    Return a column of random periods for a DHIS2 period type, vectorized with NumPy if a Generator is given.
+    With a profile, periods are chosen between its start and end, weighted by its seasonality.
+    """
+    if profile is not None or period_type not in ('Yearly', 'Monthly', 'Quarterly'):
+        periods, weights = period_population(period_type, profile)
+        return random_choices(periods, amount, rng, weights)
+
+    if rng is None:
+        return [random_period(period_type) for _ in range(amount)]
+
+    if period_type == 'Yearly':
+        return random_choices([str(y) for y in last_years()], amount, rng)
+    elif period_type == 'Monthly':
+        months = random_dates(amount, rng).astype('datetime64[M]').astype(str)
+        return np.char.replace(months, '-', '').tolist()
+    elif period_type == 'Quarterly':
+        years = np.asarray(last_years())[rng.integers(0, len(last_years()), amount)]
+        return np.char.add(np.char.add(years.astype(str), 'Q'), rng.integers(1, 5, amount).astype(str)).tolist()
 
 
 def get_today() -> str:
@@ -112,258 +514,694 @@ def get_today() -> str:
     return datetime.datetime.today().strftime('%Y-%m-%d')
 
 
-def fake_data_program(uid: str, amount: int, api: Api):
-    """Import fake events"""
+def chunk_sizes(amount: int, chunk_size: int) -> list:
+    """Split an amount into chunks of at most chunk_size"""
+    return [min(chunk_size, amount - start) for start in range(0, amount, chunk_size)]
 
-    # load program metadata
-    metadata = api.get(f'programs/{uid}', params={
-        'fields': 'id,name,organisationUnits,'
-                  'programStages[programStageDataElements[dataElement[id,valueType,optionSet[options[code]]]]]'}).json()
 
-    logger.info("Generating random fake data.")
-    logger.info(f"Event program: name='{metadata['name']}' uid='{metadata['id']}'")
+def payload_filename(name: str, number: int, compress: bool = False) -> str:
+    """Return the file name of a payload chunk"""
+    return f"{name}_{get_today()}_{number}.json{'.gz' if compress else ''}"
 
-    # map data element to its valueType
-    de_valuetype_map = {
-        de['dataElement']['id']: de['dataElement']['valueType']
-        for de in metadata['programStages'][0]['programStageDataElements']
-    }
 
-    # map data elements to available options
-    data_elements_options = {}
-    for de in metadata['programStages'][0]['programStageDataElements']:
-        if 'optionSet' in de['dataElement']:
-            data_element_uid = de['dataElement']['id']
-            data_elements_options[data_element_uid] = [o['code'] for o in de['dataElement']['optionSet']['options']]
-
-    # load the program's assigned metadata
-    org_units = [ou['id'] for ou in metadata['organisationUnits']]
-    if not org_units:
-        logger.error("Data set is not assigned to any org unit")
-        sys.exit(1)
+def import_counts(summary: dict) -> Counter:
+    """Return the imported/updated/ignored/deleted counts of an event or data value import summary"""
+    counts = summary.get('importCount', summary)
+    return Counter({k: counts.get(k, 0) for k in ('imported', 'updated', 'ignored', 'deleted')})
 
-    # load the program's category combo > attribute options
-    attribute_options = [
-        coc['categoryOptions'][0]['id'] for coc
-        in api.get(
-            f'programs/{uid}',
-            params={'fields': 'id,name,categoryCombo[categoryOptionCombos[categoryOptions]]'}
-        ).json()['categoryCombo']['categoryOptionCombos']
+
+def write_chunk(generate, size: int, seed: int, filename: str, key: str, compress: bool = False) -> tuple:
+    """
+    Generate a chunk of objects with its own random seed and write it to a payload file.
+    Runs in worker processes, so `generate` must be picklable, e.g. a partial of a module function
+    :return: tuple of file name, amount of objects
+    """
+    rng = create_rng(seed)
+    with JsonPayloadWriter(filename, key, compress) as writer:
+        writer.write_all(generate(amount=size, rng=rng))
+    return filename, writer.count
+
+
+def chunk_tasks(generate, key: str, name: str, sizes: list, seed: int = None, compress: bool = False,
+                chunk_args: list = None) -> list:
+    """
+    Return write_chunk arguments for each chunk size.
+    Each chunk gets an independent seed derived from `seed`,
+    so the generated data does not depend on the amount of processes
+    :param chunk_args: optional dict of keyword arguments for `generate` per chunk
+    """
+    seeds = random.Random(seed)
+    return [
+        (partial(generate, **chunk_args[number - 1]) if chunk_args else generate,
+         size, seeds.getrandbits(63), payload_filename(name, number, compress), key, compress)
+        for number, size in enumerate(sizes, 1)
     ]
 
-    # create events (without data values yet)
-    payload = {"events": []}
-    for _ in range(amount):
-        event = {
-            "event": generate_uid(),
-            "program": uid,
-            "orgUnit": random.choice(org_units),
-            "eventDate": random_date().strftime('%Y-%m-%d'),
-            "status": "COMPLETED",
-            "storedBy": "fake-data",
-            "completedDate": get_today(),
-            "dataValues": [],
-            "attributeCategoryOptions": random.choice(attribute_options),
-            "geometry": {
-                "type": "Point",
-                "coordinates": [
-                    str(round(random.uniform(4, 13), 3)),
-                    str(round(random.uniform(2.7, 14.5), 3))
-                ]
+
+def write_chunks(tasks: list, processes: int = 1):
+    """
+    Generate and write payload chunks with up to `processes` worker processes and yield them in order.
+    Only `processes` chunks are generated ahead of the chunk being imported.
+    :param tasks: write_chunk arguments, see chunk_tasks
+    :return: generator of (file name, amount of objects)
+    """
+    if processes == 1:
+        for task in tasks:
+            yield write_chunk(*task)
+        return
+    tasks = iter(tasks)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = deque(executor.submit(write_chunk, *task) for task in islice(tasks, processes))
+        while futures:
+            result = futures.popleft().result()
+            for task in islice(tasks, 1):
+                futures.append(executor.submit(write_chunk, *task))
+            yield result
+
+
+def import_in_chunks(api: Api, import_type: ImportType, chunk_files, params: dict,
+                     jobs: int = 2, keep_files: bool = False, timeout: int = None) -> Counter:
+    """
+    Start an async import job for each payload file as soon as it is written,
+    keeping up to `jobs` import jobs in flight while the next chunks are generated
+    :param chunk_files: iterable of (file name, amount of objects), see write_chunks
+    :param timeout: seconds after which an import job is given up
+    :return: Counter of imported/updated/ignored/deleted objects
+    """
+    start = time.time()
+    totals = Counter()
+    sent = 0
+    monitor = JobMonitor(api, timeout=timeout)
+
+    def finish(job):
+        if job.error:
+            logger.error(f"Import job {job.uid} failed: {job.error} - payload file: {job.data}")
+            if job.summary is None:
+                return
+        counts = import_counts(job.summary)
+        totals.update(counts)
+        elapsed = max(time.time() - start, 0.001)
+        logger.info(f"Import job {job.uid} {job.summary.get('status', 'done')} in {job.seconds:.0f}s - "
+                    f"{dict(counts)} - total: {totals['imported'] + totals['updated']} {import_type.key} "
+                    f"in {elapsed:.0f}s ({(totals['imported'] + totals['updated']) / elapsed:.0f}/s)")
+        if not keep_files and not job.error:
+            os.remove(job.data)
+
+    for filename, count in chunk_files:
+        sent += count
+        with stats.phase('import'):
+            job_uid = post_file(api, import_type.endpoint, filename, params=params).json()['response']['id']
+            logger.info(f"{filename}: {count} {import_type.key} ({human_size(os.path.getsize(filename))}) "
+                        f"- import job {job_uid} started")
+            monitor.add(import_type.task_type, job_uid, data=filename)
+            for job in monitor.wait(max_pending=jobs - 1):
+                finish(job)
+    with stats.phase('import'):
+        for job in monitor.wait():
+            finish(job)
+
+    elapsed = max(time.time() - start, 0.001)
+    logger.info(f"Done - sent {sent} {import_type.key} in {elapsed:.0f}s ({sent / elapsed:.0f}/s) - "
+                f"imported: {totals['imported']}, updated: {totals['updated']}, ignored: {totals['ignored']}")
+    return totals
+
+
+def write_payload_files(import_type: ImportType, chunk_files) -> list:
+    """
+    Only write the payload files, e.g. to import them later (offline mode)
+    :param chunk_files: iterable of (file name, amount of objects), see write_chunks
+    :return: list of file names
+    """
+    start = time.time()
+    filenames = []
+    total = 0
+    for filename, count in chunk_files:
+        total += count
+        filenames.append(filename)
+        logger.info(f"{filename}: {count} {import_type.key} ({human_size(os.path.getsize(filename))})")
+    elapsed = max(time.time() - start, 0.001)
+    logger.info(f"Done - wrote {total} {import_type.key} to {len(filenames)} file(s) in {elapsed:.0f}s "
+                f"({total / elapsed:.0f}/s) - import them with POST /api/{import_type.endpoint}")
+    return filenames
+
+
+def generate_events(program_uid: str, amount: int, de_valuetype_map: dict, data_elements_options: dict,
+                    org_units: list, attribute_options: list, rng=None, profile: Profile = None):
+    """Yield random events, generating whole columns of values for GENERATE_CHUNK_SIZE events at once"""
+    completed_date = get_today()
+    ou_weights = org_unit_weights(profile, org_units)
+    for start in range(0, amount, GENERATE_CHUNK_SIZE):
+        size = min(GENERATE_CHUNK_SIZE, amount - start)
+        event_org_units = random_choices(org_units, size, rng, ou_weights)
+        event_dates = random_data_values('DATE', size, org_units, rng, profile)
+        event_attribute_options = random_choices(attribute_options, size, rng)
+        longitudes = [str(round(random.uniform(4, 13), 3)) for _ in range(size)]
+        latitudes = [str(round(random.uniform(2.7, 14.5), 3)) for _ in range(size)]
+        de_values = {
+            # if DE has a optionSet, choose a random option
+            de_uid: random_column(de_value_type, data_elements_options.get(de_uid), size, org_units, rng, profile)
+            for de_uid, de_value_type in de_valuetype_map.items()
+        }
+
+        for i in range(size):
+            yield {
+                "event": generate_uid(),
+                "program": program_uid,
+                "orgUnit": event_org_units[i],
+                "eventDate": event_dates[i],
+                "status": "COMPLETED",
+                "storedBy": "fake-data",
+                "completedDate": completed_date,
+                "dataValues": [
+                    {"dataElement": de_uid, "value": values[i]} for de_uid, values in de_values.items() if values[i]
+                ],
+                "attributeCategoryOptions": event_attribute_options[i],
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [longitudes[i], latitudes[i]]
+                }
             }
+
+
+def generate_teis(program_uid: str, amount: int, tracked_entity_type: str, attributes: dict, stages: list,
+                  org_units: list, attribute_options: list, enrollments: int = 1, events: int = 1, rng=None,
+                  profile: Profile = None):
+    """
+    Yield random tracked entity instances with attribute values and `enrollments` enrollments each.
+    Every enrollment has one event per program stage, or `events` events for repeatable stages.
+    Columns of values are generated for GENERATE_CHUNK_SIZE tracked entity instances at once.
+    :param attributes: dict of attribute UID -> (valueType, option codes or None, unique)
+    :param stages: list of dicts with 'id', 'repeatable', 'value_types' (DE UID -> valueType)
+                   and 'options' (DE UID -> option codes)
+    """
+    completed_date = get_today()
+    ou_weights = org_unit_weights(profile, org_units)
+    for start in range(0, amount, GENERATE_CHUNK_SIZE):
+        size = min(GENERATE_CHUNK_SIZE, amount - start)
+        tei_org_units = random_choices(org_units, size, rng, ou_weights)
+        attribute_values = {
+            # UIDs keep unique text attributes unique
+            uid: [generate_uid() for _ in range(size)] if unique and value_type == 'TEXT'
+            else random_column(value_type, options, size, org_units, rng, profile)
+            for uid, (value_type, options, unique) in attributes.items()
         }
+        enrollment_dates = random_data_values('DATE', size * enrollments, org_units, rng, profile)
 
-        # create the event's data values
-        for de_uid, de_value_type in de_valuetype_map.items():
-            if de_uid in data_elements_options:
-                # if DE has a optionSet, choose a random option
-                dv_value = random.choice(data_elements_options[de_uid])
+        # per stage: events per enrollment, event dates, attribute options, DE UID -> values
+        stage_columns = []
+        for stage in stages:
+            per_enrollment = events if stage['repeatable'] else 1
+            n = size * enrollments * per_enrollment
+            stage_columns.append((
+                stage['id'],
+                per_enrollment,
+                random_data_values('DATE', n, org_units, rng, profile),
+                random_choices(attribute_options, n, rng),
+                {
+                    de_uid: random_column(value_type, stage['options'].get(de_uid), n, org_units, rng, profile)
+                    for de_uid, value_type in stage['value_types'].items()
+                }
+            ))
+
+        for i in range(size):
+            org_unit = tei_org_units[i]
+            tei_enrollments = []
+            for e in range(enrollments):
+                k = i * enrollments + e
+                enrollment_events = []
+                for stage_uid, per_enrollment, event_dates, event_attribute_options, de_values in stage_columns:
+                    for x in range(per_enrollment):
+                        m = k * per_enrollment + x
+                        enrollment_events.append({
+                            "event": generate_uid(),
+                            "program": program_uid,
+                            "programStage": stage_uid,
+                            "orgUnit": org_unit,
+                            "eventDate": event_dates[m],
+                            "status": "COMPLETED",
+                            "storedBy": "fake-data",
+                            "completedDate": completed_date,
+                            "attributeCategoryOptions": event_attribute_options[m],
+                            "dataValues": [
+                                {"dataElement": de_uid, "value": values[m]}
+                                for de_uid, values in de_values.items() if values[m]
+                            ]
+                        })
+                tei_enrollments.append({
+                    "enrollment": generate_uid(),
+                    "program": program_uid,
+                    "orgUnit": org_unit,
+                    "enrollmentDate": enrollment_dates[k],
+                    "incidentDate": enrollment_dates[k],
+                    # only one enrollment per program can be active
+                    "status": "ACTIVE" if e == enrollments - 1 else "COMPLETED",
+                    "events": enrollment_events
+                })
+            yield {
+                "trackedEntityInstance": generate_uid(),
+                "trackedEntityType": tracked_entity_type,
+                "orgUnit": org_unit,
+                "attributes": [
+                    {"attribute": uid, "value": values[i]} for uid, values in attribute_values.items() if values[i]
+                ],
+                "enrollments": tei_enrollments
+            }
+
+
+def sample_keys(amount: int, dimensions: list, weights: list = None, seed: int = None) -> list:
+    """
+    Sample `amount` distinct keys from the product of dimensions, e.g. (periods, org units, attribute option combos).
+    Keys are indexes into the key space: decode them with decode_key.
+    Without weights, all keys are equally likely: random.sample picks indexes without building the key space.
+    With weights (one list or None per dimension), keys are drawn by their weights and duplicates are drawn again.
+    The keys are returned as a list, as they are split across chunks: memory grows with `amount`
+    (about 40 bytes per key, e.g. 40 MB for 1 million keys), not with the key space.
+    :return: list of key indexes
+    """
+    chooser = random.Random(seed)
+    key_space = 1
+    for dimension in dimensions:
+        key_space *= len(dimension)
+    if amount > key_space:
+        raise ValueError(f"Cannot sample {amount} distinct keys from {key_space} keys")
+
+    # keys with weight 0 cannot be drawn, weighted draws of the last keys take long,
+    # and weights hardly matter when most keys are taken
+    weighted_space = 1
+    for dimension, w in zip(dimensions, weights or [None] * len(dimensions)):
+        weighted_space *= sum(1 for x in w if x > 0) if w else len(dimension)
+    if not weights or not any(weights) or amount > weighted_space // 2:
+        return chooser.sample(range(key_space), amount)
+
+    # cumulative weights once per dimension, so each draw is a binary search instead of a pass over the weights
+    cum_weights = [list(accumulate(w)) if w else None for w in weights]
+    keys, seen = [], set()
+    while len(keys) < amount:
+        key = 0
+        for dimension, cw in zip(dimensions, cum_weights):
+            if cw:
+                index = bisect(cw, chooser.random() * cw[-1], 0, len(cw) - 1)
             else:
-                dv_value = random_data_value(de_value_type, org_units)
-            if dv_value:
-                event['dataValues'].append({"dataElement": de_uid, "value": dv_value})
-        payload["events"].append(event)
-
-    filename = f'fake_data_events_{uid}_{get_today()}.json'
-    with open(filename, 'w') as f:
-        json.dump(payload, f)
-
-    file_size = os.path.getsize(filename)
-    logger.info(f"Event count: {len(payload['events'])}")
-    logger.info(f"Event file: {filename}")
-    logger.info(f"Event file size: {human_size(file_size)}")
-
-    if file_size > 20 ** 7:
-        logger.warning("File size exceeds 20MB. Consider reducing the amount.")
-
-    time.sleep(3)
-
-    # async event import
-    job_uid = api.post(
-        'events',
-        data=payload,
-        params={'async': 'true', 'payloadFormat': 'json'}
-    ).json()['response']['id']
-    logger.info(f"Event import job started: {job_uid} - waiting...")
-    while True:
-        ping = api.get(f'system/tasks/EVENT_IMPORT/{job_uid}')
-        ping.raise_for_status()
-        done = [item for item in ping.json() if item['completed'] is True and 'Import done' in item['message']]
-        if done:
-            break
-        time.sleep(1)
-    summary = api.get(f'system/taskSummaries/EVENT_IMPORT/{job_uid}').json()
-    summary.pop('responseType', None)
-    summary.pop('importSummaries', None)
-    summary.pop('total', None)
-    status = summary.get('status', 'unknown')
-    summary.pop('status', None)
-    logger.info(f"{status.capitalize()} - {summary}")
-
-
-def fake_data_dataset(uid: str, amount: int, api: Api):
-    """Import fake data value sets"""
-
-    # load the data set name and periodType
-    metadata = api.get(f'dataSets/{uid}', params={'fields': 'id,name,periodType'}).json()
-    logger.info("Generating random fake data")
-    logger.info(f"Data Set: name='{metadata['name']}' uid='{metadata['id']}'")
+                index = chooser.randrange(len(dimension))
+            key = key * len(dimension) + index
+        if key not in seen:
+            seen.add(key)
+            keys.append(key)
+    return keys
+
+
+def decode_key(key: int, dimensions: list) -> list:
+    """Return the items of a key index of sample_keys, one of each dimension"""
+    items = []
+    for dimension in reversed(dimensions):
+        key, i = divmod(key, len(dimension))
+        items.append(dimension[i])
+    return items[::-1]
 
-    # load the DataValueSet template
-    dvs_template = api.get(f'dataSets/{uid}/dataValueSet').json()
-
-    # load DE.uid : DE.valueType dict
-    de_valuetype_map = {
-        de['id']: de['valueType']
-        for de in api.get_paged(
-            'dataElements',
-            params={'fields': 'id,name,valueType', 'filter': 'domainType:eq:AGGREGATE'},
-            merge=True,
-            page_size=300
-        ).get('dataElements')
+
+def generate_data_values(template: list, amount: int, de_valuetype_map: dict, keys: list, dimensions: list,
+                         org_units: list, rng=None, profile: Profile = None):
+    """
+    Yield random data values for `amount` copies of the data value set template,
+    generating whole columns of values for GENERATE_CHUNK_SIZE copies at once.
+    Every copy gets its own (period, org unit, attribute option combo) so no data values overwrite each other.
+    Empty values (e.g. left out for the profile's sparsity) are skipped.
+    :param keys: a distinct key index per copy, see sample_keys
+    :param dimensions: periods, org units and attribute option combos the keys index
+    """
+    for start in range(0, amount, GENERATE_CHUNK_SIZE):
+        size = min(GENERATE_CHUNK_SIZE, amount - start)
+        # one column per template data value
+        values = [
+            random_column(de_valuetype_map[dv['dataElement']], None, size, org_units, rng, profile)
+            for dv in template
+        ]
+
+        for i in range(size):
+            period, org_unit, attribute_option_combo = decode_key(keys[start + i], dimensions)
+            for j, dv in enumerate(template):
+                if values[j][i] is None:
+                    continue
+                yield {
+                    "dataElement": dv['dataElement'],
+                    "categoryOptionCombo": dv['categoryOptionCombo'],
+                    "period": period,
+                    "value": values[j][i],
+                    "storedBy": "fake-data",
+                    "orgUnit": org_unit,
+                    "attributeOptionCombo": attribute_option_combo
+                }
+
+
+def export_index(export: dict) -> dict:
+    """Map every object of a metadata export (lists of objects by type) by its UID"""
+    return {
+        obj['id']: obj
+        for objects in export.values() if isinstance(objects, list)
+        for obj in objects if isinstance(obj, dict) and 'id' in obj
     }
 
-    # load the data set's org units
-    org_units = [
-        ou['id'] for ou in
-        api.get(
-            f'dataSets/{uid}',
-            params={'fields': 'id,name,organisationUnits[id]'}
-        ).json().get('organisationUnits', [])
+
+def resolve(index: dict, ref: dict) -> dict:
+    """
+    Complete a reference like {'id': 'abc'} with the object of the same UID in the export.
+    Nested fields (as returned by the API with `fields`) win over the exported object.
+    """
+    if not ref:
+        return {}
+    return dict(index.get(ref.get('id'), {}), **ref)
+
+
+def option_codes(export: dict, index: dict, obj: dict):
+    """Option codes of a data element's or attribute's optionSet, None if it has none"""
+    if not obj.get('optionSet'):
+        return None
+    option_set = resolve(index, obj['optionSet'])
+    if 'options' in option_set:
+        options = [resolve(index, o) for o in option_set['options']]
+    else:
+        options = [o for o in export.get('options', []) if o.get('optionSet', {}).get('id') == option_set.get('id')]
+    return [o['code'] for o in options if 'code' in o]
+
+
+def category_option_combos(export: dict, index: dict, ref: dict) -> list:
+    """Category option combos of a category combo, either nested or listed in the export"""
+    category_combo = resolve(index, ref)
+    if 'categoryOptionCombos' in category_combo:
+        return [resolve(index, coc) for coc in category_combo['categoryOptionCombos']]
+    return [
+        coc for coc in export.get('categoryOptionCombos', [])
+        if coc.get('categoryCombo', {}).get('id') == category_combo.get('id')
     ]
-    if not org_units:
-        logger.error("Data set is not assigned to any org unit")
-        sys.exit(1)
 
-    payload = {"dataValues": []}
 
-    # load the data set's category combo > attribute options
+def find_object(export: dict, object_type: str, uid: str):
+    """Return the object of type `object_type` with `uid` in the export, None if it is not there"""
+    return next((obj for obj in export.get(object_type, []) if obj.get('id') == uid), None)
+
+
+def program_metadata(export: dict, uid: str) -> dict:
+    """
+    Read what is needed to generate events or tracked entity instances
+    from a program export, e.g. api/programs/{uid}/metadata.json
+    """
+    index = export_index(export)
+    program = find_object(export, 'programs', uid)
+    if program is None:
+        raise PKClientException(f"Program '{uid}' not found in metadata")
+
+    attribute_options = [
+        coc['categoryOptions'][0]['id']
+        for coc in category_option_combos(export, index, program.get('categoryCombo'))
+        if coc.get('categoryOptions')
+    ]
+    if not attribute_options:
+        raise PKClientException(f"No category option combos found for the category combo of program '{uid}'")
+
+    attributes = OrderedDict()
+    for a in program.get('programTrackedEntityAttributes', []):
+        attribute = resolve(index, a['trackedEntityAttribute'])
+        attributes[attribute['id']] = (attribute['valueType'], option_codes(export, index, attribute),
+                                       attribute.get('unique', False))
+
+    stages = []
+    for ref in program.get('programStages', []):
+        stage = resolve(index, ref)
+        data_elements = [resolve(index, psde['dataElement']) for psde in stage.get('programStageDataElements', [])]
+        stages.append({
+            'id': stage['id'],
+            'repeatable': stage.get('repeatable', False),
+            'value_types': OrderedDict((de['id'], de['valueType']) for de in data_elements),
+            'options': {de['id']: option_codes(export, index, de) for de in data_elements if de.get('optionSet')}
+        })
+
+    return {
+        'id': program['id'],
+        'name': program.get('name'),
+        'program_type': program.get('programType', 'WITHOUT_REGISTRATION'),
+        'tracked_entity_type': program.get('trackedEntityType', {}).get('id'),
+        'org_units': [ou['id'] for ou in program.get('organisationUnits', [])],
+        'attribute_options': attribute_options,
+        'attributes': attributes,
+        'stages': stages
+    }
+
+
+def dataset_metadata(export: dict, uid: str) -> dict:
+    """
+    Read what is needed to generate data values
+    from a data set export, e.g. api/dataSets/{uid}/metadata.json
+    """
+    index = export_index(export)
+    data_set = find_object(export, 'dataSets', uid)
+    if data_set is None:
+        raise PKClientException(f"Data set '{uid}' not found in metadata")
+
+    # the DataValueSet template: every data element with every option combo of its (data set) category combo
+    template = []
+    de_valuetype_map = {}
+    for dse in data_set.get('dataSetElements', []):
+        data_element = resolve(index, dse['dataElement'])
+        de_valuetype_map[data_element['id']] = data_element['valueType']
+        category_combo = dse.get('categoryCombo') or data_element.get('categoryCombo')
+        for coc in category_option_combos(export, index, category_combo):
+            template.append({'dataElement': data_element['id'], 'categoryOptionCombo': coc['id']})
+
     attribute_option_combos = [
-        coc['id'] for coc in api.get(
-            f'dataSets/{uid}',
-            params={'fields': 'id,name,categoryCombo[categoryOptionCombos]'}
-        ).json()['categoryCombo']['categoryOptionCombos']
+        coc['id'] for coc in category_option_combos(export, index, data_set.get('categoryCombo'))
     ]
+    if not attribute_option_combos:
+        raise PKClientException(f"No category option combos found for the category combo of data set '{uid}'")
+
+    return {
+        'id': data_set['id'],
+        'name': data_set.get('name'),
+        'period_type': data_set['periodType'],
+        'org_units': [ou['id'] for ou in data_set.get('organisationUnits', [])],
+        'attribute_option_combos': attribute_option_combos,
+        'template': template,
+        'de_valuetype_map': de_valuetype_map
+    }
+
+
+def load_program_metadata(api: Api, uid: str) -> dict:
+    """Load a program's metadata from the server, see program_metadata"""
+    option_fields = 'optionSet[id,options[code]]'
+    program = api.get(f'programs/{uid}', params={
+        'fields': 'id,name,programType,organisationUnits[id],trackedEntityType[id],'
+                  'categoryCombo[id,categoryOptionCombos[id,categoryOptions[id]]],'
+                  f'programTrackedEntityAttributes[trackedEntityAttribute[id,valueType,unique,{option_fields}]],'
+                  f'programStages[id,repeatable,programStageDataElements[dataElement[id,valueType,{option_fields}]]]'
+    }).json()
+    return program_metadata({'programs': [program]}, uid)
+
+
+def load_dataset_metadata(api: Api, uid: str) -> dict:
+    """Load a data set's metadata from the server, see dataset_metadata"""
+    category_combo_fields = 'categoryCombo[id,categoryOptionCombos[id]]'
+    data_set = api.get(f'dataSets/{uid}', params={
+        'fields': f'id,name,periodType,organisationUnits[id],{category_combo_fields},'
+                  f'dataSetElements[{category_combo_fields},dataElement[id,valueType,{category_combo_fields}]]'
+    }).json()
+    return dataset_metadata({'dataSets': [data_set]}, uid)
+
+
+def read_metadata_file(path: str, uid: str):
+    """
+    Read a program or data set from a metadata export file
+    :return: tuple of data type ('events', 'trackedEntityInstances' or 'dataSets') and its metadata
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            export = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        raise PKClientException(f"Could not read metadata {path}: {e}")
+    if find_object(export, 'dataSets', uid):
+        return 'dataSets', dataset_metadata(export, uid)
+    if find_object(export, 'programs', uid):
+        metadata = program_metadata(export, uid)
+        return program_data_type(metadata), metadata
+    raise PKClientException(f"Could not find dataSet or program with UID '{uid}' in {path}")
+
+
+def program_data_type(metadata: dict) -> str:
+    """Tracker programs get tracked entity instances, event programs get events"""
+    return 'trackedEntityInstances' if metadata['program_type'] == 'WITH_REGISTRATION' else 'events'
+
+
+def check_org_units(metadata: dict, object_name: str):
+    if not metadata['org_units']:
+        logger.error(f"{object_name} is not assigned to any org unit")
+        sys.exit(1)
+
+
+def import_or_write(api, import_type: ImportType, chunk_files, params: dict, jobs: int = 2, keep_files: bool = False):
+    """Import the payload files if there is a server, otherwise only write them (offline mode)"""
+    # chunks are generated while earlier ones are imported: both phases are timed separately
+    chunk_files = stats.timed(chunk_files, 'generate')
+    if api is not None:
+        return import_in_chunks(api, import_type, chunk_files, params=params, jobs=jobs, keep_files=keep_files)
+    return write_payload_files(import_type, chunk_files)
+
+
+def fake_data_program(uid: str, amount: int, metadata: dict, api: Api = None, seed: int = None,
+                      compress: bool = False, chunk_size: int = CHUNK_SIZE, jobs: int = 2, keep_files: bool = False,
+                      processes: int = 1, profile: Profile = None):
+    """Import fake events - or only write the payload files if there is no api"""
+    logger.info("Generating random fake data.")
+    logger.info(f"Event program: name='{metadata['name']}' uid='{metadata['id']}'")
+    check_org_units(metadata, "Program")
+
+    if not metadata['stages']:
+        raise PKClientException(f"Program '{uid}' has no program stage")
+    stage = metadata['stages'][0]
+
+    generate = partial(generate_events, program_uid=uid, de_valuetype_map=stage['value_types'],
+                       data_elements_options=stage['options'], org_units=metadata['org_units'],
+                       attribute_options=metadata['attribute_options'], profile=profile)
+    tasks = chunk_tasks(generate, EVENT_IMPORT.key, f'fake_data_events_{uid}', chunk_sizes(amount, chunk_size),
+                        seed, compress)
+    import_or_write(api, EVENT_IMPORT, write_chunks(tasks, processes),
+                    params={'async': 'true', 'payloadFormat': 'json'}, jobs=jobs, keep_files=keep_files)
+
+
+def fake_data_tracker(uid: str, amount: int, metadata: dict, api: Api = None, enrollments: int = 1, events: int = 1,
+                      seed: int = None, compress: bool = False, chunk_size: int = CHUNK_SIZE, jobs: int = 2,
+                      keep_files: bool = False, processes: int = 1, profile: Profile = None):
+    """Import fake tracked entity instances with enrollments and events - or only write the payload files"""
+    logger.info("Generating random fake data.")
+    logger.info(f"Tracker program: name='{metadata['name']}' uid='{metadata['id']}'")
+    check_org_units(metadata, "Program")
+
+    # chunk size is in objects (tracked entity instances, enrollments and events), but chunks are made of whole TEIs
+    stages = metadata['stages']
+    events_per_enrollment = sum(events if stage['repeatable'] else 1 for stage in stages)
+    objects_per_tei = 1 + enrollments * (1 + events_per_enrollment)
+    logger.info(f"{amount} tracked entity instances with {enrollments} enrollment(s) and "
+                f"{events_per_enrollment} event(s) per enrollment: {amount * objects_per_tei} objects")
+
+    generate = partial(generate_teis, program_uid=uid, tracked_entity_type=metadata['tracked_entity_type'],
+                       attributes=metadata['attributes'], stages=stages, org_units=metadata['org_units'],
+                       attribute_options=metadata['attribute_options'], enrollments=enrollments, events=events,
+                       profile=profile)
+    tasks = chunk_tasks(generate, TEI_IMPORT.key, f'fake_data_tracker_{uid}',
+                        chunk_sizes(amount, max(1, chunk_size // objects_per_tei)), seed, compress)
+    import_or_write(api, TEI_IMPORT, write_chunks(tasks, processes), params={'async': 'true'},
+                    jobs=jobs, keep_files=keep_files)
+
+
+def fake_data_dataset(uid: str, amount: int, metadata: dict, api: Api = None, seed: int = None,
+                      compress: bool = False, chunk_size: int = CHUNK_SIZE, jobs: int = 2, keep_files: bool = False,
+                      processes: int = 1, profile: Profile = None):
+    """Import fake data value sets - or only write the payload files if there is no api"""
+    logger.info("Generating random fake data")
+    logger.info(f"Data Set: name='{metadata['name']}' uid='{metadata['id']}'")
+    check_org_units(metadata, "Data set")
+    org_units = metadata['org_units']
+    attribute_option_combos = metadata['attribute_option_combos']
+
+    # every template copy gets a distinct period, org unit and attribute option combo
+    periods, period_weights = period_population(metadata['period_type'], profile)
+    ou_weights = org_unit_weights(profile, org_units)
+    if period_weights:
+        # leave out periods that cannot be chosen, e.g. of months without season
+        weighted = [(p, w) for p, w in zip(periods, period_weights) if w > 0]
+        if not weighted:
+            raise PKClientException("No periods with a seasonality weight above 0 in the profile's period range")
+        periods, period_weights = [p for p, _ in weighted], [w for _, w in weighted]
+    dimensions = [periods, org_units, attribute_option_combos]
+    key_space = len(periods) * len(org_units) * len(attribute_option_combos)
+    if amount > key_space:
+        logger.warning(f"Only {key_space} combinations of {len(periods)} periods, {len(org_units)} org units and "
+                       f"{len(attribute_option_combos)} attribute option combos - reducing the amount to {key_space}")
+        amount = key_space
+    keys = sample_keys(amount, dimensions, [period_weights, ou_weights, None], seed)
 
     # log a warning in case of huge amount of data values
-    possible_data_values = amount * len(dvs_template['dataValues'])
-    if possible_data_values > 10000:
-        logger.warning(f"Lots of data values: {possible_data_values}. Consider reducing the amount.")
+    template = metadata['template']
+    possible_data_values = amount * len(template)
+    if possible_data_values > 10000 and api is not None:
+        logger.warning(f"Lots of data values: {possible_data_values} - importing in chunks of {chunk_size}.")
         time.sleep(6)
 
-    # create as many data value set templates as given as argument
-    for _ in range(amount):
-        for dv in dvs_template['dataValues']:
-            de_uid = dv['dataElement']
-            de_value_type = de_valuetype_map[de_uid]
-            payload['dataValues'].append(
-                {
-                    "dataElement": de_uid,
-                    "categoryOptionCombo": dv['categoryOptionCombo'],
-                    "period": random_period(metadata['periodType']),
-                    "value": random_data_value(de_value_type, org_units),
-                    "storedBy": "fake-data",
-                    "orgUnit": random.choice(org_units),
-                    "attributeOptionCombo": random.choice(attribute_option_combos)
-                }
-            )
-
-    filename = f'fake_data_dataset_{uid}_{get_today()}.json'
-    with open(filename, 'w') as f:
-        json.dump(payload, f)
-
-    dv_amount = len(payload['dataValues'])
-    file_size = os.path.getsize(filename)
-    logger.info(f"Amount (-n): {amount}")
-    logger.info(f"Data value count: {dv_amount}")
-    logger.info(f"Data file: {filename}")
-    logger.info(f"Data file size: {human_size(file_size)}")
-
-    if file_size > 20**7:
-        logger.warning("File size exceeds 20MB. Consider reducing the amount.")
-
-    time.sleep(3)
-
-    preheat_cache = dv_amount > 3000
-    # async data import
-    job_uid = api.post(
-        'dataValueSets', data=payload,
-        params={'skipAudit': 'true', 'async': 'true', 'preheatCache': str(preheat_cache).lower()}
-    ).json()['response']['id']
-    logger.info(f"Data import job started: {job_uid} - waiting...")
-    while True:
-        ping = api.get(f'system/tasks/DATAVALUE_IMPORT/{job_uid}')
-        ping.raise_for_status()
-        done = [item for item in ping.json() if item['completed'] is True and item['message'] == 'Import done']
-        if done:
-            break
-        time.sleep(1)
-    summary = api.get(f'system/taskSummaries/DATAVALUE_IMPORT/{job_uid}').json()
-    logger.info(f"{summary.get('description')} - {summary.get('importCount')}")
+    # chunk size is in data values, but chunks are made of whole template copies
+    copies_per_chunk = max(1, chunk_size // max(1, len(template)))
+    sizes = chunk_sizes(amount, copies_per_chunk)
+    generate = partial(generate_data_values, template=template, de_valuetype_map=metadata['de_valuetype_map'],
+                       dimensions=dimensions, org_units=org_units, profile=profile)
+    # each chunk gets its share of the keys
+    offsets = accumulate([0] + sizes)
+    chunk_args = [{'keys': keys[offset:offset + size]} for offset, size in zip(offsets, sizes)]
+    tasks = chunk_tasks(generate, DATAVALUE_IMPORT.key, f'fake_data_dataset_{uid}', sizes, seed, compress, chunk_args)
+    preheat_cache = min(possible_data_values, copies_per_chunk * len(template)) > 3000
+    params = {'skipAudit': 'true', 'async': 'true', 'preheatCache': str(preheat_cache).lower()}
+    import_or_write(api, DATAVALUE_IMPORT, write_chunks(tasks, processes), params=params,
+                    jobs=jobs, keep_files=keep_files)
 
 
 def main(args, password):
     setup_logger(include_caller=False)
 
-    api = create_api(server=args.server, username=args.username, password=password)
-
     if not is_valid_uid(args.uid):
         logger.error(f"Not a valid UID: '{args.uid}'. Must be a UID of an event program or data set.")
         sys.exit(1)
 
-    if not 0 < args.amount <= 100000:
-        logger.error(f"Amount must be between 1 and 100000")
+    if args.amount < 1:
+        logger.error("Amount must be 1 or greater")
         sys.exit(1)
 
-    logger.warning(f"URL: {api.base_url}")
+    profile = load_profile(args.profile) if args.profile else None
+
+    if np is None:
+        logger.info("NumPy not installed - generating values with Python (pip install numpy for speed)")
 
     uid = args.uid
-    data_type = None
+    api = None
+    if args.server:
+        api = create_api(server=args.server, username=args.username, password=password, **connection_options(args))
+        logger.warning(f"URL: {api.base_url}")
 
-    try:
-        api.get(f'dataSets/{uid}', params={'fields': 'id,name'})
-        data_type = 'dataSets'
-    except RequestException as e:
-        if e.code == 404:
+    with stats.phase('load metadata'):
+        if args.metadata:
+            data_type, metadata = read_metadata_file(args.metadata, uid)
+            if api is None:
+                logger.info(f"No server - only writing the payload files, using the metadata in {args.metadata}")
+        else:
+            data_type = None
+            metadata = None
             try:
-                program_info = api.get(f'programs/{uid}', params={'fields': 'id,name,programType'}).json()
-                if program_info['programType'] != 'WITHOUT_REGISTRATION':
-                    logger.error("Cannot support Tracker programs yet.")
-                    sys.exit(1)
-                data_type = 'events'
+                metadata = load_dataset_metadata(api, uid)
+                data_type = 'dataSets'
             except RequestException as e:
                 if e.code == 404:
-                    logger.error(f"Could not find dataSet or program with UID '{uid}'")
+                    try:
+                        metadata = load_program_metadata(api, uid)
+                        data_type = program_data_type(metadata)
+                    except RequestException as e:
+                        if e.code == 404:
+                            logger.error(f"Could not find dataSet or program with UID '{uid}'")
+                        else:
+                            logger.error(e)
+                            sys.exit(1)
                 else:
                     logger.error(e)
                     sys.exit(1)
-        else:
-            logger.error(e)
-            sys.exit(1)
 
+    options = {
+        'seed': args.seed,
+        'compress': args.compress,
+        'chunk_size': args.chunk_size,
+        'jobs': args.jobs,
+        'keep_files': args.keep_files,
+        'processes': args.processes,
+        'profile': profile
+    }
     if data_type == 'events':
-        fake_data_program(uid=args.uid, api=api, amount=args.amount)
+        fake_data_program(uid=uid, amount=args.amount, metadata=metadata, api=api, **options)
+    elif data_type == 'trackedEntityInstances':
+        fake_data_tracker(uid=uid, amount=args.amount, metadata=metadata, api=api,
+                          enrollments=args.enrollments, events=args.events, **options)
     elif data_type == 'dataSets':
-        fake_data_dataset(uid=args.uid, api=api, amount=args.amount)
+        fake_data_dataset(uid=uid, amount=args.amount, metadata=metadata, api=api, **options)
     else:
-        raise ValueError("Not supported data type")
\ No newline at end of file
+        raise ValueError("Not supported data type")
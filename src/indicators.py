@@ -7,16 +7,31 @@ indicator-definitions
 Creates a CSV with indicator definitions (names of dataelement.catoptioncombo, constants, orgunitgroups)
 """
 
+import re
 from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from dhis2 import setup_logger, logger
+from dhis2 import setup_logger, logger, RequestException
 
 try:
-    from src.common.utils import create_api, write_csv, file_timestamp
+    from src.common.utils import create_api, connection_options, write_rows, export_filename, file_timestamp, \
+        retry_idempotent
+    from src.common.cache import JsonCache, cache_key
     from src.common.exceptions import PKClientException
+    from src.common import stats
 except (SystemError, ImportError):
-    from common.utils import create_api, write_csv, file_timestamp
+    from common.utils import create_api, connection_options, write_rows, export_filename, file_timestamp, \
+        retry_idempotent
+    from common.cache import JsonCache, cache_key
     from common.exceptions import PKClientException
+    from common import stats
+
+NOT_VALIDATED = 'not-validated'
+
+UID_PATTERN = re.compile(r'[A-Za-z][A-Za-z0-9]{10}')
+
+# validation results may change when referenced metadata changes
+VALIDATION_CACHE_MAX_AGE = 24 * 60 * 60
 
 
 indicator_fields = OrderedDict([
@@ -58,9 +73,10 @@ ProgramIndicator = namedtuple('ProgramIndicator', ' '.join(program_indicator_fie
 
 def replace_definitions(definition, obj_map):
     """replace numerator/denominators with readable objects"""
-    for i, j in obj_map.items():
-        definition = definition.replace(i, u'{}'.format(obj_map[i]['desc']))
-    return definition
+    def replace(match):
+        obj = obj_map.get(match.group())
+        return u'{}'.format(obj['desc']) if obj else match.group()
+    return UID_PATTERN.sub(replace, definition)
 
 
 def object_map(api):
@@ -144,113 +160,165 @@ def analyze_result(typ, indicators, indicator_filter):
 
 def validate_expression(api, expression):
     r = api.session.post('{}/programIndicators/expression/description'.format(api.api_url), data=expression)
+    if not r.ok:
+        raise RequestException(code=r.status_code, url=r.url, description=r.text)
     return r.json()['message']
 
+
 def validate_filter(api, filter):
     r = api.session.post('{}/programIndicators/filter/description'.format(api.api_url), data=filter)
+    if not r.ok:
+        raise RequestException(code=r.status_code, url=r.url, description=r.text)
     return r.json()['message']
 
+
 def validate_nominator_denominator(api, expr):
     r = api.get('expressions/description', params={'expression': expr})
     return r.json()['message']
 
-def format_indicator(api, typ, data, object_mapping):
-    if typ == 'indicators':
-        for ind in data[typ]:
-            Indicator.type = typ
-            Indicator.uid = u'{}'.format(ind['id'])
-            Indicator.name = u'{}'.format(ind['name'])
-            Indicator.short_name = u'{}'.format(ind['shortName'])
-            Indicator.numerator = replace_definitions(ind['numerator'], object_mapping)
-            Indicator.numerator_description = u'{}'.format(ind.get('numeratorDescription'))
-            Indicator.denominator = replace_definitions(ind['denominator'], object_mapping)
-            Indicator.denominator_description = u'{}'.format(ind.get('denominatorDescription'))
-            Indicator.annualized = u'{}'.format(ind.get('annualized', False))
-            Indicator.indicator_type = u'{}'.format(object_mapping[ind['indicatorType']['id']].get('desc'))
-            Indicator.decimals = u'{}'.format(ind.get('decimals', 'default'))
-            Indicator.last_updated = u'{}'.format(ind['lastUpdated'])
-            Indicator.numerator_valid = validate_nominator_denominator(api, ind['numerator'])
-            Indicator.denominator_valid = validate_nominator_denominator(api, ind['denominator'])
-            yield Indicator
 
-    elif typ == 'programIndicators':
-        for ind in data[typ]:
-            ProgramIndicator.type = typ
-            ProgramIndicator.uid = u'{}'.format(ind['id'])
-            ProgramIndicator.name = u'{}'.format(ind['name'])
-            ProgramIndicator.short_name = u'{}'.format(ind['shortName'])
-            ProgramIndicator.expression = replace_definitions(ind['expression'], object_mapping)
-            ProgramIndicator.filter = replace_definitions(ind['filter'], object_mapping) if ind.get(
-                'filter') else 'no-filter'
-            ProgramIndicator.aggregation_type = u'{}'.format(ind['aggregationType'])
-            ProgramIndicator.analytics_type = u'{}'.format(ind['analyticsType'])
-            ProgramIndicator.program = u'{}'.format(ind['program']['id'])
-            ProgramIndicator.program_name = u'{}'.format(ind['program']['name'])
-            ProgramIndicator.last_updated = u'{}'.format(ind['lastUpdated'])
-            ProgramIndicator.expression_valid = validate_expression(api, ind['expression'])
-            if ind.get('filter'):
-                ProgramIndicator.filter_valid = validate_filter(api, ind['filter'])
-            else:
-                ProgramIndicator.filter_valid = 'no-filter'
-            yield ProgramIndicator
+validators = {
+    'indicator': validate_nominator_denominator,
+    'expression': validate_expression,
+    'filter': validate_filter
+}
 
 
-def write_to_csv(api, typ, indicators, object_mapping, file_name):
-    data = []
+def collect_expressions(typ, data):
+    """Return the distinct (kind, expression) pairs that need to be validated"""
+    expressions = set()
+    for ind in data[typ]:
+        if typ == 'indicators':
+            expressions.add(('indicator', ind['numerator']))
+            expressions.add(('indicator', ind['denominator']))
+        elif typ == 'programIndicators':
+            expressions.add(('expression', ind['expression']))
+            if ind.get('filter'):
+                expressions.add(('filter', ind['filter']))
+    return expressions
+
+
+def validate_all(api, typ, data, workers=8, cache=None):
+    """
+    Validate all distinct expressions of the indicators concurrently
+    :param api: the Api instance
+    :param typ: indicators or programIndicators
+    :param data: the indicators response
+    :param workers: maximum number of concurrent validation requests
+    :param cache: optional JsonCache to look up and store results
+    :return: dict of (kind, expression) -> validation message
+    """
+    expressions = collect_expressions(typ, data)
+    results = {}
+    pending = []
+    for kind, expression in expressions:
+        cached = cache.get(cache_key(kind, expression)) if cache is not None else None
+        if cached is not None:
+            results[(kind, expression)] = cached
+        else:
+            pending.append((kind, expression))
+
+    logger.info("Validating {} distinct expressions ({} cached)...".format(
+        len(expressions), len(expressions) - len(pending)))
+
+    def validate(item):
+        kind, expression = item
+        return item, retry_idempotent(api, validators[kind], expression)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for item, message in executor.map(validate, pending):
+                results[item] = message
+                if cache is not None:
+                    cache.set(cache_key(*item), message)
+    finally:
+        # keep what was validated, also if a request failed
+        if cache is not None:
+            cache.save()
+    return results
+
+
+def validation_message(validations, kind, expression):
+    if validations is None:
+        return NOT_VALIDATED
+    return validations[(kind, expression)]
+
+
+def indicator_record(ind, object_mapping, validations=None):
+    """Create an immutable Indicator row from an indicator dict"""
+    return Indicator(
+        type='indicators',
+        uid=u'{}'.format(ind['id']),
+        name=u'{}'.format(ind['name']),
+        short_name=u'{}'.format(ind['shortName']),
+        numerator=replace_definitions(ind['numerator'], object_mapping),
+        numerator_description=u'{}'.format(ind.get('numeratorDescription')),
+        denominator=replace_definitions(ind['denominator'], object_mapping),
+        denominator_description=u'{}'.format(ind.get('denominatorDescription')),
+        annualized=u'{}'.format(ind.get('annualized', False)),
+        indicator_type=u'{}'.format(object_mapping[ind['indicatorType']['id']].get('desc')),
+        decimals=u'{}'.format(ind.get('decimals', 'default')),
+        last_updated=u'{}'.format(ind['lastUpdated']),
+        numerator_valid=validation_message(validations, 'indicator', ind['numerator']),
+        denominator_valid=validation_message(validations, 'indicator', ind['denominator'])
+    )
+
+
+def program_indicator_record(ind, object_mapping, validations=None):
+    """Create an immutable ProgramIndicator row from a program indicator dict"""
+    return ProgramIndicator(
+        type='programIndicators',
+        uid=u'{}'.format(ind['id']),
+        name=u'{}'.format(ind['name']),
+        short_name=u'{}'.format(ind['shortName']),
+        expression=replace_definitions(ind['expression'], object_mapping),
+        filter=replace_definitions(ind['filter'], object_mapping) if ind.get('filter') else 'no-filter',
+        aggregation_type=u'{}'.format(ind['aggregationType']),
+        analytics_type=u'{}'.format(ind['analyticsType']),
+        program=u'{}'.format(ind['program']['id']),
+        program_name=u'{}'.format(ind['program']['name']),
+        last_updated=u'{}'.format(ind['lastUpdated']),
+        expression_valid=validation_message(validations, 'expression', ind['expression']),
+        filter_valid=validation_message(validations, 'filter', ind['filter']) if ind.get('filter') else 'no-filter'
+    )
+
+
+def format_indicator(typ, data, object_mapping, validations=None):
+    """Yield one immutable record per indicator. Records do not share state,
+    so they can be buffered, reordered or created in parallel."""
     if typ == 'indicators':
-        header_row = indicator_fields.keys()
+        record = indicator_record
+    elif typ == 'programIndicators':
+        record = program_indicator_record
+    else:
+        raise PKClientException('Cannot format indicator type {}'.format(typ))
+
+    for ind in data[typ]:
+        yield record(ind, object_mapping, validations)
 
-        for indicator in format_indicator(api, typ, indicators, object_mapping):
-            data.append([
-                indicator.type,
-                indicator.uid,
-                indicator.name,
-                indicator.short_name,
-                indicator.numerator,
-                indicator.numerator_description,
-                indicator.denominator,
-                indicator.denominator_description,
-                indicator.annualized,
-                indicator.indicator_type,
-                indicator.decimals,
-                indicator.last_updated,
-                indicator.numerator_valid,
-                indicator.denominator_valid
-            ])
-
-        write_csv(data, file_name, header_row)
-        logger.info("Success! CSV file exported to {}".format(file_name))
 
+def write_to_file(typ, indicators, object_mapping, file_name, validations=None, fmt='csv', compress=False):
+    if typ == 'indicators':
+        header_row = indicator_fields.keys()
     elif typ == 'programIndicators':
         header_row = program_indicator_fields.keys()
+    else:
+        raise PKClientException('Cannot write indicator type {}'.format(typ))
 
-        for program_indicator in format_indicator(api, typ, indicators, object_mapping):
-            data.append([
-                program_indicator.type,
-                program_indicator.uid,
-                program_indicator.name,
-                program_indicator.short_name,
-                program_indicator.expression,
-                program_indicator.filter,
-                program_indicator.aggregation_type,
-                program_indicator.analytics_type,
-                program_indicator.program,
-                program_indicator.program_name,
-                program_indicator.last_updated,
-                program_indicator.filter_valid,
-                program_indicator.expression_valid
-            ])
-
-        write_csv(data, file_name, header_row)
-        logger.info("Success! CSV file exported to {}".format(file_name))
+    # records are tuples ordered like the header row
+    records = format_indicator(typ, indicators, object_mapping, validations)
+    write_rows(records, file_name, header_row, fmt=fmt, compress=compress)
+    logger.info("Success! {} file exported to {}".format(fmt.upper(), file_name))
 
 
 def main(args, password):
     setup_logger(include_caller=False)
 
-    api = create_api(server=args.server, username=args.username, password=password)
+    api = create_api(server=args.server, username=args.username, password=password, **connection_options(args))
 
-    file_name = '{}-{}.csv'.format(args.indicator_type, file_timestamp(api.api_url))
+    file_name = export_filename(
+        '{}-{}'.format(args.indicator_type, file_timestamp(api.api_url)), args.export_format, args.compress
+    )
 
     if args.indicator_type == 'indicators':
         fields = ','.join([x for x in indicator_fields.values() if x != 'type'])
@@ -261,11 +329,21 @@ def main(args, password):
     else:
         raise SystemExit('Cannot process argument -t {}'.format(args.indicator_type))
 
-    indicators = api.get(endpoint=args.indicator_type, params=get_params(args.indicator_filter, fields)).json()
+    with stats.phase('download indicators'):
+        indicators = api.get(endpoint=args.indicator_type, params=get_params(args.indicator_filter, fields)).json()
     message = analyze_result(args.indicator_type, indicators, args.indicator_filter)
     logger.info(message)
 
     logger.info("Analyzing metadata...")
-    object_mapping = object_map(api)
-
-    write_to_csv(api, args.indicator_type, indicators, object_mapping, file_name)
\ No newline at end of file
+    with stats.phase('load metadata'):
+        object_mapping = object_map(api)
+
+    validations = None
+    if not args.no_validate:
+        cache = JsonCache('expressions', api.base_url, max_age=VALIDATION_CACHE_MAX_AGE)
+        with stats.phase('validate expressions'):
+            validations = validate_all(api, args.indicator_type, indicators, workers=args.workers, cache=cache)
+
+    with stats.phase('write'):
+        write_to_file(args.indicator_type, indicators, object_mapping, file_name, validations,
+                      fmt=args.export_format, compress=args.compress)
@@ -3,15 +3,18 @@
 
 import json
 import re
+from collections import OrderedDict
 
 from dhis2 import setup_logger, logger, RequestException
 
 try:
-    from src.common.utils import create_api, file_timestamp, write_csv
+    from src.common.utils import create_api, connection_options, file_timestamp, write_csv
     from src.common.exceptions import PKClientException
+    from src.common import aio, stats
 except (SystemError, ImportError):
-    from common.utils import create_api, file_timestamp, write_csv
+    from common.utils import create_api, connection_options, file_timestamp, write_csv
     from common.exceptions import PKClientException
+    from common import aio, stats
 
 
 def extract_uids(rule):
@@ -22,29 +25,59 @@ def extract_uids(rule):
     return list_of_uids
 
 
+def missing_uids(api, uids):
+    """
+    Return the UIDs that do not identify any object.
+    They are looked up concurrently if aiohttp is installed, one by one otherwise.
+    """
+    uids = list(OrderedDict.fromkeys(uids))
+    if aio.aiohttp is not None:
+        return aio.run(missing_uids_async(api, uids))
+    missing = set()
+    for uid in uids:
+        try:
+            api.get('identifiableObjects/{}'.format(uid), params={'fields': 'id'})
+        except RequestException as exc:
+            if exc.code == 404:
+                missing.add(uid)
+            else:
+                logger.error(exc)
+    return missing
+
+
+async def missing_uids_async(api, uids):
+    async with aio.AsyncApi(api) as aapi:
+        results = await aapi.gather(
+            [aapi.get('identifiableObjects/{}'.format(uid), params={'fields': 'id'}) for uid in uids],
+            return_exceptions=True
+        )
+    missing = set()
+    for uid, result in zip(uids, results):
+        if isinstance(result, RequestException):
+            if result.code == 404:
+                missing.add(uid)
+            else:
+                logger.error(result)
+        elif isinstance(result, Exception):
+            raise result
+    return missing
+
+
 def check_validation_rules(api):
     p = {'fields': 'id,name,description,leftSide[expression],rightSide[expression]', 'paging': False}
     data = api.get('validationRules', params=p).json()
 
     logger.info("*** CHECKING {} VALIDATION RULES... ***".format(len(data['validationRules'])))
 
-    for rule in data['validationRules']:
-        uid_cache = set()
-
-        uids_in_expressions = extract_uids(rule)
-        for uid in uids_in_expressions:
-            if uid not in uid_cache:
-                try:
-                    api.get('identifiableObjects/{}'.format(uid)).json()
-                except RequestException as exc:
-                    if exc.code == 404:
-                        logger.warn("Validation Rule '{}' ({}) - "
-                                    "UID in expression not identified: {}".format(rule['name'], rule['id'], uid))
-                        uid_cache.add(uid)
-                    else:
-                        logger.error(exc)
-                else:
-                    uid_cache.add(uid)
+    # every UID is looked up once, even if it is in many rules
+    uids_in_rules = [(rule, extract_uids(rule)) for rule in data['validationRules']]
+    missing = missing_uids(api, [uid for _, uids in uids_in_rules for uid in uids])
+
+    for rule, uids in uids_in_rules:
+        for uid in OrderedDict.fromkeys(uids):
+            if uid in missing:
+                logger.warn("Validation Rule '{}' ({}) - "
+                            "UID in expression not identified: {}".format(rule['name'], rule['id'], uid))
 
 
 def check_option_sets(api):
@@ -180,11 +213,9 @@ def check_program_rules(api):
 def main(args, password):
     setup_logger(include_caller=False)
 
-    api = create_api(server=args.server, username=args.username, password=password)
+    api = create_api(server=args.server, username=args.username, password=password, **connection_options(args))
 
-    check_validation_rules(api)
-    check_option_sets(api)
-    check_category_options(api)
-    check_categories(api)
-    check_category_combos(api)
-    check_program_rules(api)
+    for check in (check_validation_rules, check_option_sets, check_category_options, check_categories,
+                  check_category_combos, check_program_rules):
+        with stats.phase(check.__name__):
+            check(api)
@@ -21,6 +21,7 @@ try:
         parse_args_fake_data,
         pk_general_help
     )
+    from src.common import stats
 except ImportError:
     from attributes import main as attributes_main
     from css import main as css_main
@@ -39,18 +40,19 @@ except ImportError:
         parse_args_fake_data,
         pk_general_help
     )
+    from common import stats
 
 from dhis2 import RequestException, logger
 
-# valid scripts
+# valid scripts: argument parser and main function
 scripts = {
-    'attribute-setter',
-    'data-integrity',
-    'indicator-definitions',
-    'post-css',
-    'share',
-    'userinfo',
-    'fake-data'
+    'attribute-setter': (parse_args_attributes, attributes_main),
+    'data-integrity': (parse_args_integrity, integrity_main),
+    'indicator-definitions': (parse_args_indicators, indicators_main),
+    'post-css': (parse_args_css, css_main),
+    'share': (parse_args_share, share_main),
+    'userinfo': (parse_args_userinfo, userinfo_main),
+    'fake-data': (parse_args_fake_data, fake_data_main)
 }
 
 
@@ -65,34 +67,21 @@ def pocketknife_run():
     Entry point.
     First, verify that pocket-knife is called with arguments and the script called is valid
     Then get the arguments and call the script's main function.
+    With --stats[=FILE] (any script), requests and timings are summarized at the end.
     """
     python2_notice()
-    if not sys.argv or len(sys.argv) < 2 or sys.argv[1] not in scripts:
+    argv, stats_enabled, stats_file = stats.split_argument(sys.argv)
+    if not argv or len(argv) < 2 or argv[1] not in scripts:
         pk_general_help()
     else:
-        args = sys.argv
-        script_name = args[1]
-        if script_name == 'attribute-setter':
-            args, password = parse_args_attributes(args[2:])
-            attributes_main(args, password)
-        if script_name == 'data-integrity':
-            args, password = parse_args_integrity(args[2:])
-            integrity_main(args, password)
-        if script_name == 'indicator-definitions':
-            args, password = parse_args_indicators(args[2:])
-            indicators_main(args, password)
-        if script_name == 'post-css':
-            args, password = parse_args_css(args[2:])
-            css_main(args, password)
-        if script_name == 'share':
-            args, password = parse_args_share(args[2:])
-            share_main(args, password)
-        if script_name == 'userinfo':
-            args, password = parse_args_userinfo(args[2:])
-            userinfo_main(args, password)
-        if script_name == 'fake-data':
-            args, password = parse_args_fake_data(args[2:])
-            fake_data_main(args, password)
+        parse_args, script_main = scripts[argv[1]]
+        args, password = parse_args(argv[2:])
+        if stats_enabled:
+            stats.enable()
+        try:
+            script_main(args, password)
+        finally:
+            stats.report(stats_file)
 
 
 if __name__ == '__main__':
@@ -17,13 +17,15 @@ from logging import DEBUG
 from dhis2 import setup_logger, logger
 
 try:
-    from src.common.utils import create_api
+    from src.common.utils import create_api, connection_options
     from src.cmdline_parser import parse_args_share
     from src.common.exceptions import PKClientException
+    from src.common import stats
 except (SystemError, ImportError):
-    from common.utils import create_api
+    from common.utils import create_api, connection_options
     from cmdline_parser import parse_args_share
     from common.exceptions import PKClientException
+    from common import stats
 
 access = {
     'none': u'--',
@@ -602,12 +604,13 @@ def main(args, password):
     elif args.debug:
         setup_logger(log_level=DEBUG, include_caller=True)
 
-    api = create_api(server=args.server, username=args.username, password=password)
+    api = create_api(server=args.server, username=args.username, password=password, **connection_options(args))
     validate_args(args, api.version_int)
 
     public_access_permission = Permission.from_public_args(args.public_access)
-    collection = ShareableObjectCollection(api, args.object_type, args.filter)
-    usergroups = UserGroupsCollection(api, args.groups)
+    with stats.phase('load objects'):
+        collection = ShareableObjectCollection(api, args.object_type, args.filter)
+        usergroups = UserGroupsCollection(api, args.groups)
     validate_data_access(public_access_permission, collection, usergroups, api.version_int)
 
     # sort by name
@@ -654,7 +657,8 @@ def main(args, password):
 
         if not skip(args.overwrite, element, update):
             logger.info(u"{0} {1}".format(pointer, element.log_identifier))
-            share(api, update)
+            with stats.phase('share'):
+                share(api, update)
 
         else:
             logger.warning(u'Skipping (already shared): {0} {1}'.format(pointer, element.log_identifier))
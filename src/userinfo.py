@@ -1,169 +1,301 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import re
+import os
 from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import chain
 
 from dhis2 import setup_logger, logger
 
 try:
-    from common.utils import create_api, file_timestamp, write_csv
+    from common.utils import create_api, connection_options, file_timestamp, write_rows, export_filename, \
+        get_pages, chunks, read_rows, check_columns
+    from common.cache import JsonCache
     from common.exceptions import PKClientException
+    from common import stats
 except (SystemError, ImportError):
-    from src.common.utils import create_api, file_timestamp, write_csv
+    from src.common.utils import create_api, connection_options, file_timestamp, write_rows, export_filename, \
+        get_pages, chunks, read_rows, check_columns
+    from src.common.cache import JsonCache
     from src.common.exceptions import PKClientException
+    from src.common import stats
 
+# org unit names rarely change, but do not keep them forever
+ORG_UNIT_CACHE_MAX_AGE = 24 * 60 * 60
 
-def replace_path(oumap, path):
-    """ Replace path UIDs with readable OU names"""
-    pattern = re.compile(r'\b(' + '|'.join(oumap.keys()) + r')\b')
-    result = pattern.sub(lambda x: oumap[x.group()], path)
-    return u'{}'.format(result)
+# keep id:in:[...] filters well below URL length limits
+ORG_UNIT_BATCH_SIZE = 200
+
+
+# export readable names
+User = namedtuple('User', 'uid name first_name surname username phone_number email last_login '
+                          'user_groups user_roles org_units dv_org_units search_org_units')
+
+# export readable names PLUS UIDs
+UserWithUids = namedtuple('UserWithUids', 'uid name first_name surname username phone_number email last_login '
+                                          'user_groups user_groups_uid '
+                                          'user_roles user_roles_uid '
+                                          'org_units org_units_uid '
+                                          'dv_org_units dv_org_units_uid '
+                                          'search_org_units search_org_units_uid')
+
+header_row = ['uid', 'name', 'firstName', 'surname', 'username', 'phoneNumber', 'email', 'lastLogin',
+              'userGroups',
+              'userRoles', 'orgunitPaths', 'dataViewOrgunitPaths', 'teiSearchOrganisationUnits']
+
+header_row_with_uids = ['uid', 'name', 'firstName', 'surname', 'username', 'phoneNumber', 'email', 'lastLogin',
+                        'userGroups', 'userGroups_uid',
+                        'userRoles', 'userRoles_uid',
+                        'orgunitPaths', 'orgunitPaths_uid',
+                        'dataViewOrgunitPaths', 'dataViewOrgunitPaths_uid',
+                        'teiSearchOrganisationUnits', 'teiSearchOrganisationUnits_uid']
+
+user_fields = 'id,name,email,' \
+              'userCredentials[username,lastLogin,userRoles[id,name],userInfo[phoneNumber,firstName,surname]],' \
+              'organisationUnits[path],userGroups[id,name],' \
+              'dataViewOrganisationUnits[path],teiSearchOrganisationUnits[path]'
+
+# list-valued columns and their separator in CSV exports
+list_fields = {
+    'userGroups': u', ',
+    'userGroups_uid': u',',
+    'userRoles': u', ',
+    'userRoles_uid': u',',
+    'orgunitPaths': u'\n',
+    'orgunitPaths_uid': u'\n',
+    'dataViewOrgunitPaths': u'\n',
+    'dataViewOrgunitPaths_uid': u'\n',
+    'teiSearchOrganisationUnits': u'\n',
+    'teiSearchOrganisationUnits_uid': u'\n'
+}
+
+
+def replace_path(oumap, path, memo=None):
+    """ Replace path UIDs with readable OU names, optionally memoized in `memo` dict"""
+    if memo is not None and path in memo:
+        return memo[path]
+    result = u'/'.join([oumap.get(uid, uid) for uid in path.split('/')])
+    if memo is not None:
+        memo[path] = result
+    return result
+
+
+def user_record(user, ou_map, memo=None):
+    """Create an immutable User row with readable names"""
+    return User(
+        uid=u'{}'.format(user['id']),
+        name=u'{}'.format(user['name']),
+        first_name=u'{}'.format(user['userCredentials']['userInfo']['firstName']),
+        surname=u'{}'.format(user['userCredentials']['userInfo']['surname']),
+        username=u'{}'.format(user['userCredentials']['username']),
+        phone_number=u'{}'.format(user['userCredentials']['userInfo'].get('phoneNumber', '-')),
+        email=u'{}'.format(user.get('email', '-')),
+        last_login=u'{}'.format(user['userCredentials'].get('lastLogin', '-')),
+        user_groups=[ug['name'] for ug in user['userGroups']],
+        user_roles=[ur['name'] for ur in user['userCredentials']['userRoles']],
+        org_units=[replace_path(ou_map, ou['path'], memo) for ou in user['organisationUnits']],
+        dv_org_units=[replace_path(ou_map, ou['path'], memo) for ou in user['dataViewOrganisationUnits']],
+        search_org_units=[replace_path(ou_map, ou['path'], memo) for ou in user['teiSearchOrganisationUnits']]
+    )
+
+
+def user_record_with_uids(user, ou_map, memo=None):
+    """Create an immutable UserWithUids row with readable names PLUS UIDs"""
+    u = user_record(user, ou_map, memo)
+    return UserWithUids(
+        uid=u.uid,
+        name=u.name,
+        first_name=u.first_name,
+        surname=u.surname,
+        username=u.username,
+        phone_number=u.phone_number,
+        email=u.email,
+        last_login=u.last_login,
+        user_groups=u.user_groups,
+        user_groups_uid=[ug['id'] for ug in user['userGroups']],
+        user_roles=u.user_roles,
+        user_roles_uid=[ur['id'] for ur in user['userCredentials']['userRoles']],
+        org_units=u.org_units,
+        org_units_uid=[ou['path'] for ou in user['organisationUnits']],
+        dv_org_units=u.dv_org_units,
+        dv_org_units_uid=[ou['path'] for ou in user['dataViewOrganisationUnits']],
+        search_org_units=u.search_org_units,
+        search_org_units_uid=[ou['path'] for ou in user['teiSearchOrganisationUnits']]
+    )
 
 
 def format_user(users, ou_map, uid_export=False):
-    if not uid_export:
-        # export readable names
-        User = namedtuple('User', 'uid name first_name surname username phone_number email last_login '
-                                  'user_groups user_roles org_units dv_org_units search_org_units')
-        logger.info('Exporting {} users...'.format(len(users['users'])))
-
-        for user in users['users']:
-            User.uid = u'{}'.format(user['id'])
-            User.name = u'{}'.format(user['name'])
-            User.first_name = u'{}'.format(user['userCredentials']['userInfo']['firstName'])
-            User.surname = u'{}'.format(user['userCredentials']['userInfo']['surname'])
-            User.username = u'{}'.format(user['userCredentials']['username'])
-            User.phone_number = u'{}'.format(user['userCredentials']['userInfo'].get('phoneNumber', '-'))
-            User.email = u'{}'.format(user.get('email', '-'))
-            User.last_login = u'{}'.format(user['userCredentials'].get('lastLogin', '-'))
-            User.user_groups = u", ".join([ug['name'] for ug in user['userGroups']])
-            User.user_roles = u", ".join([ur['name'] for ur in user['userCredentials']['userRoles']])
-            User.org_units = u"\n".join(
-                [replace_path(ou_map, elem) for elem in [ou['path'] for ou in user['organisationUnits']]])
-            User.dv_org_units = u"\n".join(
-                [replace_path(ou_map, elem) for elem in [ou['path'] for ou in user['dataViewOrganisationUnits']]])
-            User.search_org_units = u"\n".join(
-                [replace_path(ou_map, elem) for elem in [ou['path'] for ou in user['teiSearchOrganisationUnits']]])
-            yield User
+    """Yield one immutable record per user (from an iterable of user dicts).
+    Records do not share state, so they can be buffered, reordered or created in parallel."""
+    record = user_record_with_uids if uid_export else user_record
 
-    else:
-        # export readable names PLUS UIDs
-        User = namedtuple('User', 'uid name first_name surname username phone_number email last_login '
-                                  'user_groups user_groups_uid '
-                                  'user_roles user_roles_uid '
-                                  'org_units org_units_uid '
-                                  'dv_org_units dv_org_units_uid '
-                                  'search_org_units search_org_units_uid')
-        logger.info('Exporting {} users including UIDs'.format(len(users['users'])))
-
-        for user in users['users']:
-            User.uid = u'{}'.format(user['id'])
-            User.name = u'{}'.format(user['name'])
-            User.first_name = u'{}'.format(user['userCredentials']['userInfo']['firstName'])
-            User.surname = u'{}'.format(user['userCredentials']['userInfo']['surname'])
-            User.username = u'{}'.format(user['userCredentials']['username'])
-            User.phone_number = u'{}'.format(user['userCredentials']['userInfo'].get('phoneNumber', '-'))
-            User.email = u'{}'.format(user.get('email', '-'))
-            User.last_login = u'{}'.format(user['userCredentials'].get('lastLogin', '-'))
-            User.user_groups = u", ".join([ug['name'] for ug in user['userGroups']])
-            User.user_groups_uid = u",".join([ug['id'] for ug in user['userGroups']])
-            User.user_roles = u", ".join([ur['name'] for ur in user['userCredentials']['userRoles']])
-            User.user_roles_uid = u",".join([ur['id'] for ur in user['userCredentials']['userRoles']])
-            User.org_units = u"\n".join(
-                [replace_path(ou_map, elem) for elem in [ou['path'] for ou in user['organisationUnits']]])
-            User.org_units_uid = u"\n".join([ou['path'] for ou in user['organisationUnits']])
-            User.dv_org_units = u"\n".join(
-                [replace_path(ou_map, elem) for elem in [ou['path'] for ou in user['dataViewOrganisationUnits']]])
-            User.dv_org_units_uid = u"\n".join([ou['path'] for ou in user['dataViewOrganisationUnits']])
-            User.search_org_units = u"\n".join(
-                [replace_path(ou_map, elem) for elem in [ou['path'] for ou in user['teiSearchOrganisationUnits']]])
-            User.search_org_units_uid = u"\n".join([ou['path'] for ou in user['teiSearchOrganisationUnits']])
-            yield User
+    # many users share the same org unit assignments
+    memo = {}
+    for user in users:
+        yield record(user, ou_map, memo)
+
+
+def path_uids(users):
+    """Return the distinct org unit UIDs in the org unit paths of users"""
+    uids = set()
+    for user in users:
+        for key in ('organisationUnits', 'dataViewOrganisationUnits', 'teiSearchOrganisationUnits'):
+            for ou in user[key]:
+                uids.update(ou['path'].split('/'))
+    uids.discard('')
+    return uids
+
+
+def resolve_org_unit_names(api, uids, ou_map, cache=None):
+    """
+    Add the names of org units that are not yet in ou_map,
+    looked up in the cache first and then in batched id:in:[...] requests
+    :param api: the Api instance
+    :param uids: org unit UIDs to resolve
+    :param ou_map: dict of org unit UID -> name, updated in place
+    :param cache: optional JsonCache for org unit names
+    """
+    missing = []
+    for uid in uids:
+        if uid in ou_map:
+            continue
+        name = cache.get(uid) if cache is not None else None
+        if name is not None:
+            ou_map[uid] = name
+        else:
+            missing.append(uid)
+
+    for batch in chunks(missing, ORG_UNIT_BATCH_SIZE):
+        params = {'fields': 'id,name', 'filter': 'id:in:[{}]'.format(','.join(batch)), 'paging': False}
+        for ou in api.get('organisationUnits', params=params).json()['organisationUnits']:
+            ou_map[ou['id']] = ou['name']
+            if cache is not None:
+                cache.set(ou['id'], ou['name'])
+        for uid in batch:
+            # not found or not accessible: keep the UID
+            ou_map.setdefault(uid, uid)
+
+
+def iter_users(pages, api, ou_map, cache=None, uid_export=False):
+    """Yield the users of all pages, after resolving the org unit names the page refers to"""
+    for page in pages:
+        if page['pager']['page'] == 1:
+            logger.info('Exporting {} users{}...'.format(
+                page['pager']['total'], ' including UIDs' if uid_export else ''
+            ))
+        with stats.phase('resolve org units'):
+            resolve_org_unit_names(api, path_uids(page['users']), ou_map, cache)
+        for user in page['users']:
+            yield user
+
+
+def user_params(args):
+    """Build the users request parameters from the user filter arguments"""
+    params = {'fields': user_fields}
+    filters = []
+    if args.user_group:
+        filters.append('userGroups.id:eq:{}'.format(args.user_group))
+    if args.user_role:
+        filters.append('userCredentials.userRoles.id:eq:{}'.format(args.user_role))
+    if args.updated_since:
+        filters.append('lastUpdated:ge:{}'.format(args.updated_since))
+    if filters:
+        params['filter'] = filters
+    if args.org_unit:
+        params['ou'] = args.org_unit
+        params['includeChildren'] = 'true'
+    if args.login_since:
+        params['lastLogin'] = args.login_since
+    return params
+
+
+def previous_export_date(filename):
+    """Return the date a previous export was written, minus one day of overlap"""
+    written = datetime.fromtimestamp(os.path.getmtime(filename)) - timedelta(days=1)
+    return written.strftime('%Y-%m-%d')
+
+
+def changed_users(api, params, since, page_size, workers):
+    """Return dict of user UID -> user for users updated or logged in since a date"""
+    updated = dict(params, filter=list(params.get('filter', [])) + ['lastUpdated:ge:{}'.format(since)])
+    logged_in = dict(params, lastLogin=since)
+    users = {}
+    for p in (updated, logged_in):
+        for page in get_pages(api, 'users', params=p, page_size=page_size, workers=workers):
+            for user in page['users']:
+                users[user['id']] = user
+    return users
+
+
+def existing_user_uids(api, params, workers):
+    """Return the set of all user UIDs (matching the filters), one request per 10000 users"""
+    id_params = dict(params, fields='id')
+    return {
+        user['id']
+        for page in get_pages(api, 'users', params=id_params, page_size=10000, workers=workers)
+        for user in page['users']
+    }
+
+
+def incremental_records(api, args, params, header, ou_map, cache):
+    """
+    Merge the rows of a previous export with the users that changed since then.
+    Users deleted since the previous export are only left out with --remove-deleted,
+    which downloads the UIDs of all users.
+    """
+    # before anything is downloaded or written
+    check_columns(args.previous, header)
+
+    since = args.since or previous_export_date(args.previous)
+    with stats.phase('download changed users'):
+        changed = changed_users(api, params, since, args.page_size, args.workers)
+    logger.info('Found {} users updated or logged in since {}'.format(len(changed), since))
+    with stats.phase('resolve org units'):
+        resolve_org_unit_names(api, path_uids(changed.values()), ou_map, cache)
+
+    existing = None
+    if args.remove_deleted:
+        with stats.phase('download all user UIDs'):
+            existing = existing_user_uids(api, params, args.workers)
+    previous = (
+        row for row in read_rows(args.previous, header, list_fields)
+        if row[0] not in changed and (existing is None or row[0] in existing)
+    )
+    return chain(previous, format_user(changed.values(), ou_map, uid_export=args.uid_export))
 
 
 def main(args, password):
     setup_logger()
 
-    api = create_api(server=args.server, username=args.username, password=password)
+    api = create_api(server=args.server, username=args.username, password=password, **connection_options(args))
 
-    params1 = {
-        'fields':
-            'id,name,email,'
-            'userCredentials[username,lastLogin,userRoles[id,name],userInfo[phoneNumber,firstName,surname]],'
-            'organisationUnits[path],userGroups[id,name],dataViewOrganisationUnits[path],teiSearchOrganisationUnits[path]',
-        'paging': False
-    }
-    users = api.get(endpoint='users', params=params1).json()
+    params = user_params(args)
+    header = header_row_with_uids if args.uid_export else header_row
 
-    params2 = {
-        'fields': 'id,name',
-        'paging': False
-    }
+    # org unit names are resolved lazily, only for UIDs referenced in user paths
+    ou_map = {}
+    cache = JsonCache('orgunit-names', api.base_url, max_age=ORG_UNIT_CACHE_MAX_AGE)
 
-    ou_map = {
-        ou['id']: ou['name']
-        for ou in api.get_paged(
-            endpoint='organisationUnits',
-            params={'fields': 'id,name'},
-            page_size=1000,
-            merge=True
-        ).get('organisationUnits')
-    }
+    file_name = export_filename("userinfo-{}".format(file_timestamp(api.base_url)), args.export_format, args.compress)
 
-    file_name = "userinfo-{}.csv".format(file_timestamp(api.base_url))
-    data = []
-
-    if not args.uid_export:
-        header_row = ['uid', 'name', 'firstName', 'surname', 'username', 'phoneNumber', 'email', 'lastLogin',
-                      'userGroups',
-                      'userRoles', 'orgunitPaths', 'dataViewOrgunitPaths', 'teiSearchOrganisationUnits']
-
-        for user in format_user(users, ou_map, uid_export=args.uid_export):
-            data.append([
-                user.uid,
-                user.name,
-                user.first_name,
-                user.surname,
-                user.username,
-                user.phone_number,
-                user.email,
-                user.last_login,
-                user.user_groups,
-                user.user_roles,
-                user.org_units,
-                user.dv_org_units,
-                user.search_org_units
-            ])
+    if args.previous:
+        records = incremental_records(api, args, params, header, ou_map, cache)
     else:
-        header_row = ['uid', 'name', 'firstName', 'surname', 'username', 'phoneNumber', 'email', 'lastLogin',
-                      'userGroups', 'userGroups_uid',
-                      'userRoles', 'userRoles_uid',
-                      'orgunitPaths', 'orgunitPaths_uid',
-                      'dataViewOrgunitPaths', 'dataViewOrgunitPaths_uid',
-                      'teiSearchOrganisationUnits', 'teiSearchOrganisationUnits_uid']
-
-        for user in format_user(users, ou_map, uid_export=args.uid_export):
-            data.append([
-                user.uid,
-                user.name,
-                user.first_name,
-                user.surname,
-                user.username,
-                user.phone_number,
-                user.email,
-                user.last_login,
-                user.user_groups,
-                user.user_groups_uid,
-                user.user_roles,
-                user.user_roles_uid,
-                user.org_units,
-                user.org_units_uid,
-                user.dv_org_units,
-                user.dv_org_units_uid,
-                user.search_org_units,
-                user.search_org_units_uid
-            ])
-
-    write_csv(data, file_name, header_row)
-    logger.info("Success! CSV file exported to {}".format(file_name))
+        # users are downloaded page by page and streamed to the file
+        pages = stats.timed(get_pages(api, 'users', params=params, page_size=args.page_size, workers=args.workers),
+                            'download users')
+        users = iter_users(pages, api, ou_map, cache, uid_export=args.uid_export)
+        records = format_user(users, ou_map, uid_export=args.uid_export)
+
+    # records are tuples ordered like the header row
+    write_rows(
+        records,
+        file_name,
+        header,
+        fmt=args.export_format,
+        compress=args.compress,
+        list_fields=list_fields
+    )
+    cache.save()
+    logger.info("Success! {} file exported to {}".format(args.export_format.upper(), file_name))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Micro benchmarks with synthetic data, no server needed.
+
+Run from Repo root:
+python -m tests.benchmark
+"""
+
+import time
+
+from dhis2 import generate_uid
+
+from src.fake_data import create_rng, random_data_values, random_periods
+from src.indicators import format_indicator
+from src.userinfo import format_user
+
+
+def report(name, amount, seconds, unit='rows'):
+    print('{:<40} {:>10} {} in {:.2f}s - {:>10.0f} {}/s'.format(name, amount, unit, seconds, amount / seconds, unit))
+
+
+def timed(name, amount, func, unit='rows'):
+    start = time.perf_counter()
+    func()
+    report(name, amount, time.perf_counter() - start, unit)
+
+
+def bench_format_indicator(amount=20000, objects=100000):
+    uids = [generate_uid() for _ in range(objects)]
+    object_mapping = {uid: {'desc': 'Name of {}'.format(uid)} for uid in uids}
+    data = {'indicators': [
+        {
+            'id': generate_uid(),
+            'name': 'Indicator {}'.format(i),
+            'shortName': 'Ind {}'.format(i),
+            'numerator': '#{{{}.{}}}+#{{{}}}'.format(
+                uids[i % objects], uids[(i + 1) % objects], uids[(i + 2) % objects]
+            ),
+            'denominator': 'OUG{{{}}}'.format(uids[(i + 3) % objects]),
+            'indicatorType': {'id': uids[0]},
+            'lastUpdated': '2020-01-01T00:00:00.000'
+        } for i in range(amount)
+    ]}
+    timed('format_indicator', amount, lambda: list(format_indicator('indicators', data, object_mapping)))
+
+
+def bench_format_user(amount=20000, org_units=20000):
+    ou_map = {generate_uid(): 'Org unit {}'.format(i) for i in range(org_units)}
+    ou_uids = list(ou_map.keys())
+    users = [
+        {
+            'id': generate_uid(),
+            'name': 'User {}'.format(i),
+            'userCredentials': {
+                'username': 'user{}'.format(i),
+                'userInfo': {'firstName': 'First', 'surname': 'Last'},
+                'userRoles': [{'id': generate_uid(), 'name': 'Role'}]
+            },
+            'userGroups': [{'id': generate_uid(), 'name': 'Group'}],
+            'organisationUnits': [{'path': '/{}/{}'.format(ou_uids[0], ou_uids[i % org_units])}],
+            'dataViewOrganisationUnits': [{'path': '/{}'.format(ou_uids[0])}],
+            'teiSearchOrganisationUnits': []
+        } for i in range(amount)
+    ]
+    timed('format_user', amount, lambda: list(format_user(users, ou_map)))
+    timed('format_user (uid_export)', amount, lambda: list(format_user(users, ou_map, uid_export=True)))
+
+
+def bench_fake_data_values(amount=200000):
+    org_units = [generate_uid() for _ in range(1000)]
+    value_types = ['INTEGER', 'BOOLEAN', 'TEXT', 'DATE', 'ORGANISATION_UNIT']
+    rngs = [('python', None)]
+    rng = create_rng(42)
+    if rng is not None:
+        rngs.append(('numpy', rng))
+    for name, rng in rngs:
+        for value_type in value_types:
+            timed('fake-data {} ({})'.format(value_type, name), amount,
+                  lambda: random_data_values(value_type, amount, org_units, rng), unit='values')
+        timed('fake-data Monthly periods ({})'.format(name), amount,
+              lambda: random_periods('Monthly', amount, rng), unit='values')
+
+
+if __name__ == '__main__':
+    bench_format_indicator()
+    bench_format_user()
+    bench_fake_data_values()
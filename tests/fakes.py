@@ -0,0 +1,59 @@
+"""Fake dhis2.Api and requests.Response objects shared by the tests"""
+
+
+class Response(object):
+    """requests.Response stand-in: `data` is the JSON body, a status code >= 400 is not ok"""
+
+    def __init__(self, data=None, status_code=200, url='https://play.dhis2.org/demo/api', text=''):
+        self.data = data
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.url = url
+        self.text = text
+
+    def json(self):
+        if self.data is None:
+            raise ValueError('No JSON object could be decoded')
+        return self.data
+
+
+class Api(object):
+    """
+    dhis2.Api stand-in: every request is recorded in `requests` and answered by the handler of its method,
+    called with the endpoint (the full URL for `api.session` calls) and the keyword arguments of the request.
+    A handler returns a Response or the JSON body of a successful one.
+    """
+    api_url = 'https://play.dhis2.org/demo/api'
+    version_int = 38
+
+    def __init__(self, get=None, post=None, patch=None):
+        self.handlers = {'get': get, 'post': post, 'patch': patch}
+        self.requests = []
+        self.session = Session(self)
+
+    def request(self, method, endpoint, **kwargs):
+        self.requests.append((method, endpoint, kwargs))
+        result = self.handlers[method](endpoint, **kwargs)
+        return result if isinstance(result, Response) else Response(result)
+
+    def get(self, endpoint, params=None):
+        return self.request('get', endpoint, params=params)
+
+    def post(self, endpoint, data=None, params=None):
+        return self.request('post', endpoint, data=data, params=params)
+
+    def patch(self, endpoint, data=None, params=None):
+        return self.request('patch', endpoint, data=data, params=params)
+
+
+class Session(object):
+    """Raw `api.session` calls, answered by the handlers of the Api"""
+
+    def __init__(self, api):
+        self.api = api
+
+    def post(self, url, data=None, **kwargs):
+        return self.api.request('post', url, data=data, **kwargs)
+
+    def patch(self, url, data=None, **kwargs):
+        return self.api.request('patch', url, data=data, **kwargs)
@@ -0,0 +1,174 @@
+import asyncio
+
+import pytest
+from dhis2 import RequestException
+
+from src import integrity
+from src.common import aio
+from src.common.aio import AsyncApi, gather, query_params, run
+from src.common.utils import create_api
+
+requires_aiohttp = pytest.mark.skipif(aio.aiohttp is None, reason="aiohttp not installed")
+
+
+def serve(handler, test, **options):
+    """Run `test(api)` against a local server answering every request with `handler`"""
+    from aiohttp import web
+
+    async def main():
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        api = create_api('http://127.0.0.1:{}'.format(port), 'admin', 'district', **options)
+        try:
+            return await test(api)
+        finally:
+            await runner.cleanup()
+
+    return run(main())
+
+
+def test_query_params():
+    assert query_params(None) == []
+    assert query_params({'fields': 'id', 'paging': False, 'filter': ['a:eq:1', 'b:eq:2'], 'x': None}) == [
+        ('fields', 'id'), ('paging', 'false'), ('filter', 'a:eq:1'), ('filter', 'b:eq:2')
+    ]
+
+
+def test_gather_limit():
+    running = []
+    peak = []
+
+    async def call(i):
+        running.append(i)
+        peak.append(len(running))
+        await asyncio.sleep(0.001)
+        running.remove(i)
+        return i
+
+    assert run(gather([call(i) for i in range(20)], limit=3)) == list(range(20))
+    assert max(peak) == 3
+
+
+@requires_aiohttp
+def test_async_api_get_and_errors():
+    from aiohttp import web
+    seen = []
+
+    async def handler(request):
+        seen.append((request.path, request.query.getall('filter', []), request.headers.get('Authorization')))
+        if request.path.endswith('missing'):
+            return web.Response(status=404, text='not found')
+        return web.json_response({'id': 'abc'})
+
+    async def test(api):
+        async with AsyncApi(api) as aapi:
+            assert await aapi.get('dataElements/abc', params={'filter': ['a', 'b']}) == {'id': 'abc'}
+            with pytest.raises(RequestException) as e:
+                await aapi.get('dataElements/missing')
+            assert e.value.code == 404
+
+    serve(handler, test)
+    assert seen[0][0] == '/api/dataElements/abc'
+    assert seen[0][1] == ['a', 'b']
+    assert seen[0][2].startswith('Basic ')
+
+
+@requires_aiohttp
+def test_async_api_retries_idempotent_requests():
+    from aiohttp import web
+    calls = []
+
+    async def handler(request):
+        calls.append(request.method)
+        if len(calls) in (1, 3):
+            return web.Response(status=503, headers={'Retry-After': '0'})
+        return web.json_response({'status': 'OK'})
+
+    async def test(api):
+        async with AsyncApi(api, backoff=0) as aapi:
+            assert await aapi.get('system/info') == {'status': 'OK'}
+            with pytest.raises(RequestException) as e:
+                await aapi.post('metadata', data={})
+            assert e.value.code == 503
+
+    serve(handler, test, retries=2)
+    assert calls == ['GET', 'GET', 'POST']
+
+
+@requires_aiohttp
+def test_async_api_retries_timeouts():
+    from aiohttp import web
+    calls = []
+
+    async def handler(request):
+        calls.append(request.method)
+        if len(calls) == 1:
+            await asyncio.sleep(0.5)
+        return web.json_response({'status': 'OK'})
+
+    async def test(api):
+        async with AsyncApi(api, timeout=0.2, backoff=0) as aapi:
+            assert await aapi.get('system/info') == {'status': 'OK'}
+        # negative retries still send the request once
+        async with AsyncApi(api, retries=-1) as aapi:
+            assert aapi.retries == 0
+            assert await aapi.get('system/info') == {'status': 'OK'}
+
+    serve(handler, test, retries=1)
+    assert calls == ['GET', 'GET', 'GET']
+
+
+@requires_aiohttp
+def test_async_api_get_paged():
+    from aiohttp import web
+
+    async def handler(request):
+        assert request.query['order'] == 'id:asc'
+        page = int(request.query['page'])
+        return web.json_response({'pager': {'page': page, 'pageCount': 3},
+                                  'dataElements': [{'id': '{}{}'.format(page, i)} for i in range(2)]})
+
+    async def test(api):
+        async with AsyncApi(api) as aapi:
+            return await aapi.get_paged('dataElements', params={'fields': 'id'}, page_size=2, merge=True)
+
+    o = serve(handler, test)
+    assert [de['id'] for de in o['dataElements']] == ['10', '11', '20', '21', '30', '31']
+
+
+@requires_aiohttp
+def test_missing_uids_async():
+    from aiohttp import web
+
+    async def handler(request):
+        if request.path.endswith('Xb9QEjKRSJa'):
+            return web.Response(status=404)
+        return web.json_response({'id': request.path.split('/')[-1]})
+
+    async def test(api):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, integrity.missing_uids, api, ['fbfJHSPpUQD', 'Xb9QEjKRSJa'] * 3)
+
+    assert serve(handler, test) == {'Xb9QEjKRSJa'}
+
+
+def test_missing_uids_without_aiohttp(monkeypatch):
+    monkeypatch.setattr(aio, 'aiohttp', None)
+
+    class Api(object):
+        def __init__(self):
+            self.calls = []
+
+        def get(self, endpoint, params=None):
+            self.calls.append(endpoint)
+            if endpoint.endswith('Xb9QEjKRSJa'):
+                raise RequestException(404, endpoint, 'not found')
+
+    api = Api()
+    assert integrity.missing_uids(api, ['fbfJHSPpUQD', 'Xb9QEjKRSJa', 'fbfJHSPpUQD']) == {'Xb9QEjKRSJa'}
+    assert len(api.calls) == 2
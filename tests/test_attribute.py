@@ -1,10 +1,19 @@
+import json
 import os
+from argparse import Namespace
 
 import pytest
-
+import requests
 from dhis2 import load_csv
+from requests.adapters import HTTPAdapter
 
-from src.attributes import validate_csv, create_or_update_attribute_values
+from fakes import Api, Response
+from src import attributes
+from src.cmdline_parser import parse_args_attributes
+from src.attributes import validate_csv, create_or_update_attribute_values, import_report_errors, get_objects, \
+    update_with_patch, update_with_metadata_import, iter_valid_rows, uid_key, set_attribute_values, Row, \
+    changed_values, Journal, Attribute, check_attributes_on_model
+from src.common import utils
 from src.common.exceptions import PKClientException
 
 TEST_ATTRIBUTE_UID = 'M8fCOxtkURr'
@@ -35,6 +44,63 @@ def test_csv_no_valid_headers():
         validate_csv(f)
 
 
+def test_csv_rows_validated_while_streaming():
+    rows = iter_valid_rows(iter([
+        {'uid': 'DiszpKrYNg8', 'attributeValue': 'a'},
+        {'uid': 'YuQRtpLP10I', 'attributeValue': 'b'},
+        {'uid': 'DiszpKrYNg8', 'attributeValue': 'c'}
+    ]))
+    assert next(rows).uid == 'DiszpKrYNg8'
+    assert next(rows).uid == 'YuQRtpLP10I'
+    with pytest.raises(PKClientException):
+        next(rows)
+
+
+def test_csv_wide_format():
+    rows = list(iter_valid_rows([
+        {'uid': 'DiszpKrYNg8', 'type': 'organisationUnits', 'M8fCOxtkURr': 'a', 'n2xYlNbsfko': ''},
+        {'uid': 'fbfJHSPpUQD', 'type': 'dataElements', 'M8fCOxtkURr': 'b', 'n2xYlNbsfko': 'c'}
+    ]))
+    assert rows[0] == Row(1, 'organisationUnits', 'DiszpKrYNg8', {'M8fCOxtkURr': 'a'})
+    assert rows[1] == Row(2, 'dataElements', 'fbfJHSPpUQD', {'M8fCOxtkURr': 'b', 'n2xYlNbsfko': 'c'})
+
+
+def test_csv_wide_format_invalid_type():
+    with pytest.raises(PKClientException):
+        list(iter_valid_rows([{'uid': 'DiszpKrYNg8', 'type': 'organisationUnit', 'M8fCOxtkURr': 'a'}]))
+
+
+def test_csv_wide_format_empty_type():
+    row = {'uid': 'DiszpKrYNg8', 'type': '', 'M8fCOxtkURr': 'a'}
+    assert next(iter_valid_rows([row], object_type='dataElements')).object_type == 'dataElements'
+    with pytest.raises(PKClientException):
+        list(iter_valid_rows([row]))
+
+
+def test_check_attributes_on_model_before_writing(monkeypatch):
+    checked = []
+    monkeypatch.setattr(attributes, 'attribute_is_on_model', lambda api, attribute, typ: checked.append(typ))
+    rows = [
+        Row(1, 'organisationUnits', 'DiszpKrYNg8', {TEST_ATTRIBUTE_UID: 'a'}),
+        Row(2, 'organisationUnits', 'YuQRtpLP10I', {TEST_ATTRIBUTE_UID: 'b'}),
+        Row(3, 'dataElements', 'fbfJHSPpUQD', {TEST_ATTRIBUTE_UID: 'c'})
+    ]
+    check_attributes_on_model(None, iter(rows), {TEST_ATTRIBUTE_UID: Attribute(TEST_ATTRIBUTE_UID, 'name')})
+    assert checked == ['organisationUnits', 'dataElements']
+
+
+@pytest.mark.parametrize('option', ['--batch-size', '--workers'])
+def test_parse_args_attributes_positive_options(option):
+    with pytest.raises(SystemExit):
+        parse_args_attributes(['-s', 'play.dhis2.org/demo', '-u', 'admin', '-p', 'district', '-c', 'file.csv',
+                               '-t', 'organisationUnits', option, '0'])
+
+
+def test_uid_key():
+    assert uid_key('DiszpKrYNg8') != uid_key('DiszpKrYNg9')
+    assert uid_key('a0000000000') != uid_key('A0000000000')
+
+
 @pytest.fixture
 def user_with_attributevalue():
     u = {
@@ -157,3 +223,157 @@ def test_attribute_added_value(user_added_attributevalues):
     assert len(updated['attributeValues']) == 2
     assert set([x['attribute']['id'] for x in updated['attributeValues']]) == {TEST_ATTRIBUTE_UID, 'DiszpKrYNg6'}
     assert new_value in [x['value'] for x in updated['attributeValues'] if x['attribute']['id'] == TEST_ATTRIBUTE_UID]
+
+
+def test_set_many_attribute_values(user_added_attributevalues):
+    updated = set_attribute_values(user_added_attributevalues, {TEST_ATTRIBUTE_UID: 'x', 'n2xYlNbsfko': 'y'})
+    assert {av['attribute']['id']: av['value'] for av in updated['attributeValues']} == {
+        TEST_ATTRIBUTE_UID: 'x', 'DiszpKrYNg6': 'somethingother', 'n2xYlNbsfko': 'y'
+    }
+    assert len(user_added_attributevalues['attributeValues']) == 2
+
+
+def test_import_report_errors():
+    report = {
+        'status': 'WARNING',
+        'typeReports': [{
+            'klass': 'org.hisp.dhis.organisationunit.OrganisationUnit',
+            'objectReports': [
+                {'uid': 'DiszpKrYNg8', 'index': 0, 'errorReports': []},
+                {'uid': 'YuQRtpLP10I', 'index': 1, 'errorReports': [{'message': 'Value is not unique'}]}
+            ]
+        }]
+    }
+    assert import_report_errors(report) == {'YuQRtpLP10I': ['Value is not unique']}
+    # 2.38+ wraps the import report
+    assert import_report_errors({'response': report}) == {'YuQRtpLP10I': ['Value is not unique']}
+
+
+def get_objects_in(endpoint, params):
+    """Answer an id:in:[...] filter with all requested objects"""
+    uids = params['filter'][len('id:in:['):-1].split(',')
+    return {endpoint: [{'id': uid} for uid in uids]}
+
+
+def test_get_objects_batched():
+    api = Api(get=get_objects_in)
+    uids = ['a{:010d}'.format(i) for i in range(450)]
+    objects = get_objects(api, 'organisationUnits', uids)
+    assert len(api.requests) == 3
+    assert sorted(objects) == uids
+
+
+def test_update_with_patch():
+    patched = {}
+
+    def get(endpoint, params):
+        return {endpoint: [
+            {'id': 'DiszpKrYNg8', 'attributeValues': [{'value': 'x', 'attribute': {'id': 'DiszpKrYNg6'}}]},
+            {'id': 'YuQRtpLP10I'}
+        ]}
+
+    def patch(url, data=None, headers=None):
+        assert headers['Content-Type'] == 'application/json-patch+json'
+        uid = url.split('/')[-1]
+        if uid == 'YuQRtpLP10I':
+            return Response(status_code=409)
+        patched[uid] = json.loads(data)
+        return Response()
+
+    api = Api(get=get, patch=patch)
+    rows = [
+        Row(1, 'organisationUnits', 'DiszpKrYNg8', {TEST_ATTRIBUTE_UID: 'new'}),
+        Row(2, 'organisationUnits', 'YuQRtpLP10I', {TEST_ATTRIBUTE_UID: 'new'}),
+        Row(3, 'organisationUnits', 'fdc6uOvgoji', {TEST_ATTRIBUTE_UID: 'new'}),
+        Row(4, 'organisationUnits', 'DiszpKrYNg8', {'DiszpKrYNg6': 'x'})
+    ]
+    updated, unchanged, ignored, failures = update_with_patch(api, rows, batch_size=2, workers=2)
+    assert updated == 1
+    assert unchanged == 1
+    assert ignored == 0
+    assert sorted((f[0], f[2]) for f in failures) == [(2, 'YuQRtpLP10I'), (3, 'fdc6uOvgoji')]
+    op = patched['DiszpKrYNg8'][0]
+    assert op['path'] == '/attributeValues'
+    assert {av['attribute']['id']: av['value'] for av in op['value']} == {'DiszpKrYNg6': 'x', TEST_ATTRIBUTE_UID: 'new'}
+
+
+def test_update_with_metadata_import_counts_ignored(tmpdir):
+    def post(endpoint, data=None, params=None):
+        return {'response': {
+            'status': 'WARNING',
+            'stats': {'created': 0, 'updated': 1, 'deleted': 0, 'ignored': 2, 'total': 3},
+            'typeReports': [{'objectReports': [
+                {'uid': 'YuQRtpLP10I', 'errorReports': [{'message': 'Value is not unique'}]}
+            ]}]
+        }}
+
+    rows = [Row(i, 'organisationUnits', uid, {TEST_ATTRIBUTE_UID: 'new'})
+            for i, uid in enumerate(['DiszpKrYNg8', 'YuQRtpLP10I', 'fdc6uOvgoji'], 1)]
+    journal = Journal(str(tmpdir.join('journal.txt')))
+    api = Api(get=get_objects_in, post=post)
+    updated, unchanged, ignored, failures = update_with_metadata_import(api, rows, batch_size=3, journal=journal)
+    assert (updated, unchanged, ignored) == (1, 0, 1)
+    assert [f[2] for f in failures] == ['YuQRtpLP10I']
+    # which object was ignored is unknown, so none of the batch is journaled
+    assert len(journal) == 0
+    journal.close()
+
+
+def test_update_with_patch_retries_gateway_errors(monkeypatch):
+    patches = []
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.url = request.url
+        response.request = request
+        if request.method == 'PATCH':
+            patches.append(request.url)
+            response.status_code = 502 if len(patches) == 1 else 200
+            response._content = b''
+        else:
+            response.status_code = 200
+            response._content = json.dumps({'organisationUnits': [{'id': 'DiszpKrYNg8'}]}).encode('utf-8')
+        return response
+
+    monkeypatch.setattr(HTTPAdapter, 'send', send)
+    monkeypatch.setattr(utils.time, 'sleep', lambda seconds: None)
+    api = utils.create_api('play.dhis2.org/demo', 'admin', 'district')
+    api._version_int = 38
+    rows = [Row(1, 'organisationUnits', 'DiszpKrYNg8', {TEST_ATTRIBUTE_UID: 'new'})]
+    updated, unchanged, ignored, failures = update_with_patch(api, rows, batch_size=10, workers=1)
+    assert (updated, failures) == (1, [])
+    assert len(patches) == 2
+
+
+def test_changed_values(user_added_attributevalues):
+    current = {av['attribute']['id']: av['value'] for av in user_added_attributevalues['attributeValues']}
+    assert changed_values(user_added_attributevalues, current) == {}
+    assert changed_values(user_added_attributevalues, {'n2xYlNbsfko': 'y'}) == {'n2xYlNbsfko': 'y'}
+
+
+def test_journal_resume(tmpdir):
+    path = str(tmpdir.join('journal.txt'))
+    journal = Journal(path)
+    journal.add(['DiszpKrYNg8'])
+    journal.close()
+
+    journal = Journal(path)
+    rows = [Row(1, 'organisationUnits', 'DiszpKrYNg8', {}), Row(2, 'organisationUnits', 'YuQRtpLP10I', {})]
+    assert [row.uid for row in journal.skip_completed(rows)] == ['YuQRtpLP10I']
+    assert journal.skipped == 1
+    journal.close()
+
+
+def test_main_validates_whole_csv_before_writing(monkeypatch, tmpdir):
+    path = str(tmpdir.join('values.csv'))
+    with open(path, 'w') as f:
+        f.write('uid,attributeValue\nDiszpKrYNg8,a\nYuQRtpLP10I,b\nDiszpKrYNg8,c\n')
+    written = []
+    monkeypatch.setattr(attributes, 'create_api', lambda **kwargs: None)
+    monkeypatch.setattr(attributes, 'get_attribute_name', lambda api, uid: 'name')
+    monkeypatch.setattr(attributes, 'update_with_metadata_import', lambda api, rows, *a: written.extend(rows))
+    args = Namespace(server=None, username=None, source_csv=path, object_type='organisationUnits',
+                     attribute_uid=TEST_ATTRIBUTE_UID, journal=None, mode='metadata', batch_size=1)
+    with pytest.raises(PKClientException):
+        attributes.main(args, None)
+    assert not written
@@ -1,14 +1,57 @@
 import pytest
 
 import datetime
+import json
+from collections import Counter
+from functools import partial
 
+from fakes import Response
 from src.fake_data import (
     random_date,
     random_data_value,
     random_time,
     random_period,
-    last_years
+    last_years,
+    create_rng,
+    random_data_values,
+    random_periods,
+    random_choices,
+    generate_data_values,
+    generate_events,
+    generate_teis,
+    enumerate_periods,
+    sample_keys,
+    decode_key,
+    load_profile,
+    random_numbers,
+    sparse,
+    org_unit_weights,
+    chunk_sizes,
+    chunk_tasks,
+    write_chunks,
+    import_in_chunks,
+    program_metadata,
+    read_metadata_file,
+    fake_data_dataset,
+    DATAVALUE_IMPORT
 )
+from src import fake_data
+from src.common.jobs import JobMonitor
+from src.common.exceptions import PKClientException
+from src.cmdline_parser import parse_args_fake_data
+
+VALUE_TYPES = [
+    'INTEGER', 'INTEGER_POSITIVE', 'INTEGER_ZERO_OR_POSITIVE', 'NUMBER', 'BOOLEAN', 'TEXT', 'TRUE_ONLY',
+    'NEGATIVE_INTEGER', 'PERCENTAGE', 'UNIT_INTERVAL', 'ORGANISATION_UNIT', 'URL', 'DATE', 'DATETIME', 'TIME', 'EMAIL'
+]
+
+
+@pytest.fixture(params=['python', 'numpy'])
+def rng(request):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+        return create_rng(42)
+    return None
 
 
 def test_random_date():
@@ -49,4 +92,333 @@ def test_random_period_monthly():
 def test_last_years():
     o = last_years(years=-3)
     assert all(isinstance(y, int) for y in o)
-    assert all(2000 < y < 2050 for y in o)
\ No newline at end of file
+    assert all(2000 < y < 2050 for y in o)
+
+
+@pytest.mark.parametrize('value_type', VALUE_TYPES)
+def test_random_data_values(rng, value_type):
+    o = random_data_values(value_type, 50, ['ImspTQPwCqd'], rng)
+    assert len(o) == 50
+    assert all(isinstance(v, str) or (value_type == 'TRUE_ONLY' and v is None) for v in o)
+
+
+def test_random_data_values_formats(rng):
+    assert set(random_data_values('BOOLEAN', 50, [], rng)) == {'true', 'false'}
+    assert set(random_data_values('TRUE_ONLY', 50, [], rng)) == {'true', None}
+    assert all(-1000 <= int(v) <= -1 for v in random_data_values('NEGATIVE_INTEGER', 50, [], rng))
+    assert all(0 <= float(v) <= 1 for v in random_data_values('UNIT_INTERVAL', 50, [], rng))
+    assert all(datetime.datetime.strptime(v, '%Y-%m-%d').date() <= datetime.date.today()
+               for v in random_data_values('DATE', 50, [], rng))
+    assert all(datetime.datetime.strptime(v, '%Y-%m-%dT%H:%M:%S.000000') < datetime.datetime.now()
+               for v in random_data_values('DATETIME', 50, [], rng))
+    assert all(len(v) == 5 and v[2] == ':' for v in random_data_values('TIME', 50, [], rng))
+
+
+@pytest.mark.parametrize('period_type', ['Yearly', 'Quarterly', 'Monthly'])
+def test_random_periods(rng, period_type):
+    o = random_periods(period_type, 20, rng)
+    assert len(o) == 20
+    assert all(isinstance(p, str) and len(p) == len(random_period(period_type)) for p in o)
+
+
+@pytest.mark.parametrize('vectorized', [False, True])
+def test_seed_reproducible(vectorized):
+    if vectorized:
+        pytest.importorskip('numpy')
+
+    def generate():
+        rng = create_rng(7)
+        if not vectorized:
+            rng = None  # Python fallback, seeded through the random module
+        return random_data_values('INTEGER', 10, [], rng), random_choices(['a', 'b', 'c'], 10, rng)
+
+    assert generate() == generate()
+
+
+def test_generate_data_values_chunked(monkeypatch, rng):
+    monkeypatch.setattr(fake_data, 'GENERATE_CHUNK_SIZE', 3)
+    template = [{'dataElement': 'fbfJHSPpUQD', 'categoryOptionCombo': 'Prlt0C1RF0s'},
+                {'dataElement': 'cYeuwXTCPkU', 'categoryOptionCombo': 'Prlt0C1RF0s'}]
+    dimensions = [['202001', '202002', '202003'], ['ImspTQPwCqd', 'DiszpKrYNg8'], ['HllvX50cXC0']]
+    keys = sample_keys(6, dimensions)
+    o = list(generate_data_values(template, 6, {'fbfJHSPpUQD': 'INTEGER', 'cYeuwXTCPkU': 'NUMBER'}, keys, dimensions,
+                                  ['ImspTQPwCqd'], rng))
+    assert len(o) == 12
+    assert [dv['dataElement'] for dv in o[:4]] == ['fbfJHSPpUQD', 'cYeuwXTCPkU'] * 2
+    # every data value has a distinct key: the whole key space is used
+    assert len({(dv['dataElement'], dv['period'], dv['orgUnit']) for dv in o}) == 12
+
+
+def test_generate_events(rng):
+    o = list(generate_events('eBAyeGv0exc', 5, {'qrur9Dvnyt5': 'INTEGER', 'oZg33kd9taw': 'TEXT'},
+                             {'oZg33kd9taw': ['Male', 'Female']}, ['ImspTQPwCqd'], ['xYerKDKCefk'], rng))
+    assert len(o) == 5
+    assert len({e['event'] for e in o}) == 5
+    assert all(e['dataValues'][1]['value'] in ('Male', 'Female') for e in o)
+
+
+def test_chunk_sizes():
+    assert chunk_sizes(7, 3) == [3, 3, 1]
+    assert chunk_sizes(2, 5) == [2]
+
+
+def test_import_in_chunks(tmpdir, monkeypatch):
+    monkeypatch.setattr(fake_data, 'JobMonitor', partial(JobMonitor, initial_delay=0, max_delay=0))
+
+    class Session(object):
+        posted = []
+
+        def post(self, url, data=None, params=None, headers=None):
+            self.posted.append(data.read())
+            return Response({'response': {'id': 'job{}'.format(len(self.posted))}})
+
+    class Api(object):
+        api_url = 'https://play.dhis2.org/demo/api'
+        session = Session()
+        polls = {}
+
+        def get(self, endpoint, params=None):
+            job_uid = endpoint.split('/')[-1]
+            if endpoint.startswith('system/tasks'):
+                # every job completes on its second poll
+                self.polls[job_uid] = self.polls.get(job_uid, 0) + 1
+                return Response([{'uid': str(self.polls[job_uid]), 'completed': self.polls[job_uid] > 1,
+                                  'message': 'Import done'}])
+            return Response({'status': 'SUCCESS', 'importCount': {'imported': 2, 'updated': 0, 'ignored': 1}})
+
+    api = Api()
+    chunk_files = []
+    for n in range(3):
+        filename = str(tmpdir.join('chunk_{}.json'.format(n)))
+        with open(filename, 'w') as f:
+            f.write('{"dataValues": []}')
+        chunk_files.append((filename, 3))
+    totals = import_in_chunks(api, DATAVALUE_IMPORT, chunk_files, params={}, jobs=2)
+    assert len(api.session.posted) == 3
+    assert totals['imported'] == 6 and totals['ignored'] == 3
+    assert sorted(api.polls) == ['job1', 'job2', 'job3']
+    assert not tmpdir.listdir()
+
+
+def test_write_chunks_independent_of_processes(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    generate = partial(generate_events, program_uid='eBAyeGv0exc', de_valuetype_map={'qrur9Dvnyt5': 'INTEGER'},
+                       data_elements_options={}, org_units=['ImspTQPwCqd', 'DiszpKrYNg8'],
+                       attribute_options=['xYerKDKCefk'])
+
+    def generated(processes):
+        tasks = chunk_tasks(generate, 'events', 'events_{}'.format(processes), [3, 3, 2], seed=1)
+        events = []
+        for filename, count in write_chunks(tasks, processes):
+            with open(filename) as f:
+                chunk = json.load(f)['events']
+            assert len(chunk) == count
+            events.extend(chunk)
+        return events
+
+    sequential, parallel = generated(1), generated(2)
+    assert len(sequential) == 8
+    assert sequential == parallel
+
+
+def test_generate_teis(rng):
+    stages = [
+        {'id': 'A03MvHHogjR', 'repeatable': False, 'value_types': {'UXz7xuGCEhU': 'INTEGER'}, 'options': {}},
+        {'id': 'ZzYYXq4fJie', 'repeatable': True, 'value_types': {'GQY2lXrypjO': 'TEXT'},
+         'options': {'GQY2lXrypjO': ['A', 'B']}}
+    ]
+    attributes = {'w75KJ2mc4zz': ('TEXT', None, True), 'cejWyOfXge6': ('TEXT', ['Male', 'Female'], False)}
+    o = list(generate_teis('IpHINAT79UW', 3, 'nEenWmSyUEp', attributes, stages, ['DiszpKrYNg8'], ['xYerKDKCefk'],
+                           enrollments=2, events=3, rng=rng))
+    assert len(o) == 3
+    assert len({tei['attributes'][0]['value'] for tei in o}) == 3
+    assert all(tei['attributes'][1]['value'] in ('Male', 'Female') for tei in o)
+    enrollments = o[0]['enrollments']
+    assert [e['status'] for e in enrollments] == ['COMPLETED', 'ACTIVE']
+    assert [event['programStage'] for event in enrollments[0]['events']] == ['A03MvHHogjR'] + ['ZzYYXq4fJie'] * 3
+    assert all(event['dataValues'][0]['value'] in ('A', 'B') for event in enrollments[1]['events'][1:])
+
+
+@pytest.mark.parametrize('period_type,start,end,expected', [
+    ('Daily', '2020-02-28', '2020-03-01', ['20200228', '20200229', '20200301']),
+    ('Weekly', '2020-01-01', '2020-01-14', ['2020W2', '2020W3']),
+    ('Weekly', '2020-12-28', '2021-01-04', ['2020W53', '2021W1']),
+    ('WeeklyWednesday', '2020-01-01', '2020-01-08', ['2020WedW1', '2020WedW2']),
+    ('WeeklySunday', '2020-12-27', '2021-01-03', ['2020SunW53', '2021SunW1']),
+    ('BiWeekly', '2020-01-01', '2020-01-31', ['2020BiW2', '2020BiW3']),
+    ('BiMonthly', '2020-01-01', '2020-06-30', ['202001B', '202002B', '202003B']),
+    ('SixMonthly', '2020-01-01', '2020-12-31', ['2020S1', '2020S2']),
+    ('SixMonthlyApril', '2020-01-01', '2020-12-31', ['2020AprilS1', '2020AprilS2']),
+    ('SixMonthlyNov', '2020-01-01', '2020-12-31', ['2020NovS2', '2021NovS1']),
+    ('FinancialJuly', '2019-01-01', '2020-12-31', ['2019July', '2020July']),
+    ('Quarterly', '2020-02-01', '2020-12-31', ['2020Q2', '2020Q3', '2020Q4'])
+])
+def test_enumerate_periods(period_type, start, end, expected):
+    start, end = (datetime.datetime.strptime(d, '%Y-%m-%d').date() for d in (start, end))
+    assert [p[0] for p in enumerate_periods(period_type, start, end)] == expected
+
+
+def test_load_profile(tmpdir):
+    path = tmpdir.join('profile.json')
+    path.write(json.dumps({
+        'valueTypes': {'INTEGER': {'distribution': 'poisson', 'lam': 3}},
+        'orgUnits': {'skew': 1, 'weights': {'b': 10}},
+        'periods': {'start': '2020-01-01', 'end': '2020-12-31', 'seasonality': [1] * 11 + [0]},
+        'sparsity': 0.5
+    }))
+    profile = load_profile(str(path))
+    assert profile.value_types['INTEGER'] == {'distribution': 'poisson', 'lam': 3}
+    assert profile.start == datetime.date(2020, 1, 1)
+    assert org_unit_weights(profile, ['a', 'b', 'c']) == [1, 10, 1 / 3]
+    assert set(random_periods('Monthly', 100, None, profile)) <= {'2020{:02d}'.format(m) for m in range(1, 12)}
+
+    path.write(json.dumps({'valueTypes': {'TEXT': {'distribution': 'gauss'}}}))
+    with pytest.raises(PKClientException):
+        load_profile(str(path))
+
+
+@pytest.mark.parametrize('distribution', [
+    {'distribution': 'gauss', 'mu': 0, 'sigma': 100},
+    {'distribution': 'uniform', 'low': -10, 'high': 200},
+    {'distribution': 'lognormal', 'mu': 4, 'sigma': 1},
+    {'distribution': 'poisson', 'lam': 5}
+])
+def test_random_numbers_within_bounds(rng, distribution):
+    assert all(1 <= int(v) for v in random_numbers('INTEGER_POSITIVE', distribution, 100, rng))
+    assert all(0 <= int(v) <= 100 for v in random_numbers('PERCENTAGE', distribution, 100, rng))
+    assert all(int(v) <= -1 for v in random_numbers('NEGATIVE_INTEGER', distribution, 100, rng))
+
+
+def test_sparse(rng):
+    o = sparse(['1'] * 1000, 0.3, rng)
+    assert 200 < o.count(None) < 400
+    assert sparse(['1'], 0, rng) == ['1']
+
+
+def test_sample_keys_distinct():
+    dimensions = [list(range(5)), list(range(7)), list(range(3))]
+    keys = sample_keys(100, dimensions, seed=1)
+    assert len(set(keys)) == 100
+    assert keys == sample_keys(100, dimensions, seed=1)
+    items = [tuple(decode_key(k, dimensions)) for k in keys]
+    assert len(set(items)) == 100
+    assert decode_key(0, dimensions) == [0, 0, 0]
+    assert decode_key(104, dimensions) == [4, 6, 2]
+
+
+def test_sample_keys_weighted():
+    dimensions = [['a', 'b'], list(range(100))]
+    keys = sample_keys(50, dimensions, weights=[[1, 0], None], seed=1)
+    assert len(set(keys)) == 50
+    assert {decode_key(k, dimensions)[0] for k in keys} == {'a'}
+    with pytest.raises(ValueError):
+        sample_keys(201, dimensions)
+    # draws follow the weights
+    dimensions = [['a', 'b', 'c'], list(range(2000))]
+    keys = sample_keys(400, dimensions, weights=[[3, 0, 1], None], seed=1)
+    counts = Counter(decode_key(k, dimensions)[0] for k in keys)
+    assert counts['b'] == 0 and 250 < counts['a'] < 350
+
+
+@pytest.fixture
+def dataset_export():
+    # normalized like api/dataSets/{uid}/metadata.json: objects only reference each other by id
+    return {
+        'dataSets': [{
+            'id': 'BfMAe6Itzgt', 'name': 'Child Health', 'periodType': 'Monthly',
+            'organisationUnits': [{'id': 'DiszpKrYNg8'}, {'id': 'ImspTQPwCqd'}],
+            'categoryCombo': {'id': 'bjDvmb4bfuf'},
+            'dataSetElements': [
+                {'dataElement': {'id': 'qrur9Dvnyt5'}},
+                {'dataElement': {'id': 'UXz7xuGCEhU'}, 'categoryCombo': {'id': 'bjDvmb4bfuf'}}
+            ]
+        }],
+        'dataElements': [
+            {'id': 'qrur9Dvnyt5', 'valueType': 'INTEGER', 'categoryCombo': {'id': 't3aNCvHsoSn'}},
+            {'id': 'UXz7xuGCEhU', 'valueType': 'TEXT', 'categoryCombo': {'id': 't3aNCvHsoSn'}}
+        ],
+        'categoryCombos': [{'id': 'bjDvmb4bfuf'}, {'id': 't3aNCvHsoSn'}],
+        'categoryOptionCombos': [
+            {'id': 'HllvX50cXC0', 'categoryCombo': {'id': 'bjDvmb4bfuf'}},
+            {'id': 'Prlt0C1RF0s', 'categoryCombo': {'id': 't3aNCvHsoSn'}},
+            {'id': 'psbwp3CQEhs', 'categoryCombo': {'id': 't3aNCvHsoSn'}}
+        ]
+    }
+
+
+def test_program_metadata_from_export():
+    export = {
+        'programs': [{
+            'id': 'IpHINAT79UW', 'name': 'Child Programme', 'programType': 'WITH_REGISTRATION',
+            'trackedEntityType': {'id': 'nEenWmSyUEp'},
+            'organisationUnits': [{'id': 'DiszpKrYNg8'}],
+            'categoryCombo': {'id': 'bjDvmb4bfuf'},
+            'programTrackedEntityAttributes': [{'trackedEntityAttribute': {'id': 'cejWyOfXge6'}}],
+            'programStages': [{'id': 'A03MvHHogjR'}]
+        }],
+        'programStages': [{
+            'id': 'A03MvHHogjR', 'repeatable': True,
+            'programStageDataElements': [{'dataElement': {'id': 'UXz7xuGCEhU'}}]
+        }],
+        'dataElements': [{'id': 'UXz7xuGCEhU', 'valueType': 'TEXT', 'optionSet': {'id': 'pC3N9N77UmT'}}],
+        'trackedEntityAttributes': [{'id': 'cejWyOfXge6', 'valueType': 'TEXT', 'optionSet': {'id': 'pC3N9N77UmT'}}],
+        'optionSets': [{'id': 'pC3N9N77UmT', 'options': [{'id': 'rBvjJYbMCVx'}, {'id': 'Mnp3oXrpAbK'}]}],
+        'options': [{'id': 'rBvjJYbMCVx', 'code': 'Male'}, {'id': 'Mnp3oXrpAbK', 'code': 'Female'}],
+        'categoryOptionCombos': [
+            {'id': 'HllvX50cXC0', 'categoryCombo': {'id': 'bjDvmb4bfuf'}, 'categoryOptions': [{'id': 'xYerKDKCefk'}]}
+        ]
+    }
+    o = program_metadata(export, 'IpHINAT79UW')
+    assert o['program_type'] == 'WITH_REGISTRATION'
+    assert o['tracked_entity_type'] == 'nEenWmSyUEp'
+    assert o['attribute_options'] == ['xYerKDKCefk']
+    assert o['attributes'] == {'cejWyOfXge6': ('TEXT', ['Male', 'Female'], False)}
+    assert o['stages'] == [{'id': 'A03MvHHogjR', 'repeatable': True, 'value_types': {'UXz7xuGCEhU': 'TEXT'},
+                            'options': {'UXz7xuGCEhU': ['Male', 'Female']}}]
+    with pytest.raises(PKClientException):
+        program_metadata(export, 'eBAyeGv0exc')
+
+
+def test_read_metadata_file_dataset(tmpdir, dataset_export):
+    path = tmpdir.join('metadata.json')
+    path.write(json.dumps(dataset_export))
+    data_type, o = read_metadata_file(str(path), 'BfMAe6Itzgt')
+    assert data_type == 'dataSets'
+    assert o['period_type'] == 'Monthly'
+    assert o['attribute_option_combos'] == ['HllvX50cXC0']
+    assert o['template'] == [
+        {'dataElement': 'qrur9Dvnyt5', 'categoryOptionCombo': 'Prlt0C1RF0s'},
+        {'dataElement': 'qrur9Dvnyt5', 'categoryOptionCombo': 'psbwp3CQEhs'},
+        {'dataElement': 'UXz7xuGCEhU', 'categoryOptionCombo': 'HllvX50cXC0'}
+    ]
+    with pytest.raises(PKClientException):
+        read_metadata_file(str(path), 'eBAyeGv0exc')
+
+
+def test_fake_data_dataset_offline(tmpdir, monkeypatch, dataset_export):
+    monkeypatch.chdir(tmpdir)
+    path = tmpdir.join('metadata.json')
+    path.write(json.dumps(dataset_export))
+    _, metadata = read_metadata_file(str(path), 'BfMAe6Itzgt')
+    fake_data_dataset('BfMAe6Itzgt', 5, metadata, seed=1, chunk_size=6)
+    files = sorted(f for f in tmpdir.listdir() if f.basename.startswith('fake_data_dataset'))
+    assert len(files) == 3
+    data_values = [dv for f in files for dv in json.loads(f.read())['dataValues']]
+    assert len(data_values) == 15
+    assert {dv['orgUnit'] for dv in data_values} <= {'DiszpKrYNg8', 'ImspTQPwCqd'}
+
+
+@pytest.mark.parametrize('option', ['--chunk-size', '--jobs', '--processes', '--enrollments', '--events'])
+def test_parse_args_fake_data_positive_options(option):
+    with pytest.raises(SystemExit):
+        parse_args_fake_data(['--metadata', 'program.json', '-i', 'IpHINAT79UW', '-n', '10', option, '0'])
+
+
+def test_parse_args_fake_data_offline():
+    args, password = parse_args_fake_data(['--metadata', 'program.json', '-i', 'IpHINAT79UW', '-n', '10'])
+    assert args.metadata == 'program.json' and args.server is None and password is None
+    with pytest.raises(PKClientException):
+        parse_args_fake_data(['-i', 'IpHINAT79UW', '-n', '10'])
+    with pytest.raises(PKClientException):
+        parse_args_fake_data(['--metadata', 'program.json', '-s', 'play.dhis2.org/demo', '-i', 'IpHINAT79UW',
+                              '-n', '10'])
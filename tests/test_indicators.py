@@ -0,0 +1,128 @@
+import json
+
+import pytest
+import requests
+from dhis2 import RequestException
+from requests.adapters import HTTPAdapter
+
+from fakes import Api, Response
+from src.common import utils
+from src.common.cache import JsonCache, cache_key
+from src import indicators
+from src.cmdline_parser import parse_args_indicators
+from src.indicators import collect_expressions, validate_all, validate_expression
+
+
+@pytest.fixture
+def program_indicators():
+    return {
+        'programIndicators': [
+            {'id': 'a', 'expression': '#{abc.def}', 'filter': 'V{x} > 1'},
+            {'id': 'b', 'expression': '#{abc.def}', 'filter': ''},
+            {'id': 'c', 'expression': 'V{event_count}'}
+        ]
+    }
+
+
+def test_collect_expressions_deduplicates(program_indicators):
+    o = collect_expressions('programIndicators', program_indicators)
+    assert o == {('expression', '#{abc.def}'), ('expression', 'V{event_count}'), ('filter', 'V{x} > 1')}
+
+
+def test_collect_expressions_indicators():
+    data = {'indicators': [{'numerator': '1', 'denominator': '1'}, {'numerator': '#{x}', 'denominator': '1'}]}
+    assert collect_expressions('indicators', data) == {('indicator', '1'), ('indicator', '#{x}')}
+
+
+def test_validate_all_uses_cache(tmpdir, monkeypatch, program_indicators):
+    calls = []
+
+    def fake_validator(api, expression):
+        calls.append(expression)
+        return 'Valid'
+
+    monkeypatch.setitem(indicators.validators, 'expression', fake_validator)
+    monkeypatch.setitem(indicators.validators, 'filter', fake_validator)
+
+    cache = JsonCache('expressions', 'play.dhis2.org/demo', directory=str(tmpdir))
+    cache.set(cache_key('filter', 'V{x} > 1'), 'Cached')
+
+    o = validate_all(None, 'programIndicators', program_indicators, workers=2, cache=cache)
+    assert sorted(calls) == ['#{abc.def}', 'V{event_count}']
+    assert o[('filter', 'V{x} > 1')] == 'Cached'
+    assert o[('expression', '#{abc.def}')] == 'Valid'
+
+    reloaded = JsonCache('expressions', 'play.dhis2.org/demo', directory=str(tmpdir))
+    assert reloaded.get(cache_key('expression', 'V{event_count}')) == 'Valid'
+
+
+def test_validate_expression_server_error():
+    api = Api(post=lambda url, data=None: Response(status_code=502, text='<html>Bad Gateway</html>'))
+    with pytest.raises(RequestException) as e:
+        validate_expression(api, '#{abc.def}')
+    assert e.value.code == 502
+
+
+def test_validate_all_saves_cache_on_error(tmpdir, monkeypatch, program_indicators):
+    def failing_validator(api, expression):
+        raise RequestException(502, 'https://play.dhis2.org/demo/api', 'Bad Gateway')
+
+    monkeypatch.setitem(indicators.validators, 'expression', failing_validator)
+    cache = JsonCache('expressions', 'play.dhis2.org/demo', directory=str(tmpdir))
+    cache.set(cache_key('filter', 'V{x} > 1'), 'Valid')
+
+    with pytest.raises(RequestException):
+        validate_all(None, 'programIndicators', program_indicators, workers=2, cache=cache)
+    reloaded = JsonCache('expressions', 'play.dhis2.org/demo', directory=str(tmpdir))
+    assert reloaded.get(cache_key('filter', 'V{x} > 1')) == 'Valid'
+
+
+def test_replace_definitions():
+    object_mapping = {'fbfJHSPpUQD': {'desc': 'ANC 1st visit'}, 'pq2XI5kz2BY': {'desc': 'Fixed'}}
+    o = indicators.replace_definitions('#{fbfJHSPpUQD.pq2XI5kz2BY}+#{s46m5MS0hxu}', object_mapping)
+    assert o == '#{ANC 1st visit.Fixed}+#{s46m5MS0hxu}'
+
+
+def test_format_indicator_records_are_independent():
+    object_mapping = {'bWuNrMHEoZ0': {'desc': 'Percent'}}
+    data = {'indicators': [
+        {
+            'id': uid,
+            'name': uid,
+            'shortName': uid,
+            'numerator': '1',
+            'denominator': '1',
+            'indicatorType': {'id': 'bWuNrMHEoZ0'},
+            'lastUpdated': '2020-01-01'
+        } for uid in ('Uvn6LCg7dVU', 'ReUHfIn0pTQ')
+    ]}
+    records = list(indicators.format_indicator('indicators', data, object_mapping))
+    assert [r.uid for r in records] == ['Uvn6LCg7dVU', 'ReUHfIn0pTQ']
+    assert records[0].indicator_type == 'Percent'
+    assert records[0].numerator_valid == indicators.NOT_VALIDATED
+    assert len(records[0]) == len(indicators.indicator_fields)
+
+
+def test_validate_all_retries_throttled_requests(monkeypatch, program_indicators):
+    statuses = [503, 429]
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = statuses.pop(0) if statuses else 200
+        response.url = request.url
+        response.request = request
+        response._content = json.dumps({'message': 'Valid'}).encode('utf-8')
+        return response
+
+    monkeypatch.setattr(HTTPAdapter, 'send', send)
+    monkeypatch.setattr(utils.time, 'sleep', lambda seconds: None)
+    api = utils.create_api('play.dhis2.org/demo', 'admin', 'district', retries=2)
+    o = validate_all(api, 'programIndicators', program_indicators, workers=1)
+    assert set(o.values()) == {'Valid'}
+    assert not statuses
+
+
+def test_parse_args_indicators_workers():
+    with pytest.raises(SystemExit):
+        parse_args_indicators(['-s', 'play.dhis2.org/demo', '-u', 'admin', '-p', 'district', '-t', 'indicators',
+                               '--workers', '0'])
@@ -0,0 +1,97 @@
+import pytest
+
+from fakes import Response
+from src.common import jobs
+from src.common.jobs import JobMonitor
+
+
+class Clock(object):
+    """Fake time module: sleeping advances the clock"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(jobs, 'time', clock)
+    return clock
+
+
+class Api(object):
+    """Jobs complete after `polls` polls, every poll adds a task entry"""
+
+    def __init__(self, polls, error=False):
+        self.polls = polls
+        self.error = error
+        self.entries = {}
+        self.requests = []
+
+    def get(self, endpoint, params=None):
+        self.requests.append(endpoint)
+        uid = endpoint.split('/')[-1]
+        if endpoint.startswith('system/taskSummaries'):
+            return Response({'status': 'SUCCESS'})
+        entries = self.entries.setdefault(uid, [])
+        completed = len(entries) + 1 >= self.polls[uid]
+        entries.insert(0, {
+            'uid': '{}-{}'.format(uid, len(entries)),
+            'completed': completed,
+            'level': 'ERROR' if completed and self.error else 'INFO',
+            'message': 'Import done' if completed else 'Importing'
+        })
+        return Response(list(entries))
+
+
+def test_job_monitor_backoff(clock):
+    api = Api({'a': 4})
+    monitor = JobMonitor(api, initial_delay=1, max_delay=3)
+    monitor.add('DATAVALUE_IMPORT', 'a', data='file.json')
+    finished = list(monitor.wait())
+    assert [(j.uid, j.data, j.error, j.summary) for j in finished] == [('a', 'file.json', None, {'status': 'SUCCESS'})]
+    # polls at 1, 3 (+2), 6 (+3, capped), 9
+    assert clock.sleeps == [1, 2, 3, 3]
+    assert len(monitor) == 0
+
+
+def test_job_monitor_many_jobs(clock):
+    api = Api({'a': 3, 'b': 1})
+    monitor = JobMonitor(api, initial_delay=1)
+    monitor.add('EVENT_IMPORT', 'a')
+    monitor.add('EVENT_IMPORT', 'b')
+    assert [j.uid for j in monitor.wait(max_pending=1)] == ['b']
+    assert [j.uid for j in monitor.wait()] == ['a']
+
+
+def test_job_monitor_new_entries(clock):
+    api = Api({'a': 10})
+    monitor = JobMonitor(api)
+    monitor.add('EVENT_IMPORT', 'a')
+    job = monitor._jobs['a']
+    assert len(monitor.new_entries(job)) == 1
+    assert len(monitor.new_entries(job)) == 1
+    assert [e['uid'] for e in monitor.new_entries(job)] == ['a-2']
+
+
+def test_job_monitor_error(clock):
+    monitor = JobMonitor(Api({'a': 1}, error=True))
+    monitor.add('EVENT_IMPORT', 'a')
+    assert next(monitor.wait()).error == 'Import done'
+
+
+def test_job_monitor_timeout(clock):
+    monitor = JobMonitor(Api({'a': 100}), max_delay=5, timeout=20)
+    monitor.add('EVENT_IMPORT', 'a')
+    job = next(monitor.wait())
+    assert job.error == 'timed out'
+    assert job.summary is None
+    assert 20 < job.seconds <= 25
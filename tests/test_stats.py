@@ -0,0 +1,125 @@
+import io
+import json
+
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
+
+from src import main
+from src.common import stats
+from src.common.stats import endpoint_name, percentile, busy_seconds, split_argument, Stats
+from src.common.utils import create_api, API_HOOKS
+
+
+@pytest.fixture
+def recorder():
+    recorder = stats.enable()
+    yield recorder
+    stats.disable()
+
+
+@pytest.mark.parametrize('url,expected', [
+    ('https://play.dhis2.org/demo/api/dataElements/fbfJHSPpUQD?fields=id', 'dataElements/{uid}'),
+    ('https://play.dhis2.org/demo/api/33/dataElements/fbfJHSPpUQD.json', 'dataElements/{uid}.json'),
+    ('https://play.dhis2.org/demo/api/system/tasks/EVENT_IMPORT/Xb9QEjKRSJa', 'system/tasks/EVENT_IMPORT/{uid}'),
+    ('https://play.dhis2.org/demo/api/programRules', 'programRules'),
+    ('https://play.dhis2.org/demo/api/sqlViews/123/data', 'sqlViews/{id}/data')
+])
+def test_endpoint_name(url, expected):
+    assert endpoint_name(url) == expected
+
+
+def test_percentile_and_busy_seconds():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile([], 50) == 0
+    # overlapping requests only count once
+    assert busy_seconds([(0, 2), (1, 3), (5, 6)]) == 4
+
+
+def test_split_argument():
+    assert split_argument(['dhis2-pk', 'userinfo', '--stats', '-s', 'x']) == (['dhis2-pk', 'userinfo', '-s', 'x'],
+                                                                               True, None)
+    assert split_argument(['dhis2-pk', 'userinfo', '--stats=run.json']) == (['dhis2-pk', 'userinfo'], True, 'run.json')
+    assert split_argument(['dhis2-pk', 'userinfo']) == (['dhis2-pk', 'userinfo'], False, None)
+
+
+def test_summary():
+    s = Stats()
+    s.started = 0
+    s.record('GET', 'https://x.org/api/dataElements/fbfJHSPpUQD', 200, 0, 100, 1.0, 1.5)
+    s.record('GET', 'https://x.org/api/dataElements/Xb9QEjKRSJa', 404, 0, 10, 1.2, 1.3)
+    s.record('POST', 'https://x.org/api/metadata', 200, 5000, 50, 2.0, 4.0)
+    s.add_phase('load', 0, 5)
+    s.add_phase('import', 5, 6)
+    s.add_phase('load', 6, 7)
+    o = s.summary(now=10)
+    assert o['requests'] == 3
+    assert o['bytes_out'] == 5000 and o['bytes_in'] == 160
+    assert o['http_seconds'] == 2.5 and o['local_seconds'] == 7.5
+    get = o['endpoints'][0]
+    assert (get['method'], get['endpoint'], get['count'], get['errors']) == ('GET', 'dataElements/{uid}', 2, 1)
+    assert get['p50_ms'] == 100.0 and get['max_ms'] == 500.0
+    assert o['phases'] == [{'name': 'load', 'seconds': 6}, {'name': 'import', 'seconds': 1}]
+
+
+def test_create_api_records_requests(monkeypatch, recorder):
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = request.url
+        response.request = request
+        response.headers['Content-Length'] = '42'
+        response._content = b'x' * 42
+        return response
+
+    monkeypatch.setattr(HTTPAdapter, 'send', send)
+    api = create_api('play.dhis2.org/demo', 'admin', 'district')
+    api.session.post('{}/metadata'.format(api.api_url), json={'x': 1})
+    with stats.phase('check'):
+        pass
+    request = recorder.requests[0]
+    assert (request.method, request.endpoint, request.status) == ('POST', 'metadata', 200)
+    assert request.bytes_out == len(json.dumps({'x': 1})) and request.bytes_in == 42
+    assert [p.name for p in recorder.phases] == ['check']
+
+    stats.disable()
+    assert not API_HOOKS
+
+
+def test_bytes_received_without_content_length(monkeypatch, recorder):
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = request.url
+        response.request = request
+        response.raw = HTTPResponse(body=io.BytesIO(b'x' * 100), preload_content=False)
+        return response
+
+    monkeypatch.setattr(HTTPAdapter, 'send', send)
+    api = create_api('play.dhis2.org/demo', 'admin', 'district')
+    assert len(api.session.get('{}/dataElements'.format(api.api_url)).content) == 100
+    assert recorder.requests[0].bytes_in == 100
+
+
+def test_timed(recorder):
+    assert list(stats.timed(iter([1, 2, 3]), 'generate')) == [1, 2, 3]
+    assert [p.name for p in recorder.phases] == ['generate'] * 4
+    assert len(recorder.summary()['phases']) == 1
+
+
+def test_pocketknife_run_stats(monkeypatch, tmpdir):
+    calls = []
+    monkeypatch.setitem(main.scripts, 'post-css',
+                        (lambda argv: (argv, None), lambda args, password: calls.append(args)))
+    filename = str(tmpdir.join('stats.json'))
+    monkeypatch.setattr('sys.argv', ['dhis2-pk', 'post-css', '--stats={}'.format(filename), '-c', 'style.css'])
+    try:
+        main.pocketknife_run()
+    finally:
+        stats.disable()
+    assert calls == [['-c', 'style.css']]
+    with open(filename) as f:
+        assert json.load(f)['requests'] == 0
@@ -0,0 +1,149 @@
+import os
+
+import pytest
+
+from fakes import Api
+from src.cmdline_parser import parse_args_userinfo
+from src.common.cache import JsonCache
+from src.common.exceptions import PKClientException
+from src.common.utils import write_rows
+from src.userinfo import replace_path, format_user, path_uids, resolve_org_unit_names, user_params, \
+    incremental_records, header_row, list_fields
+
+
+OU_MAP = {
+    'ImspTQPwCqd': 'Sierra Leone',
+    'O6uvpzGd5pu': 'Bo',
+    'YuQRtpLP10I': 'Badjia'
+}
+
+
+def test_replace_path():
+    assert replace_path(OU_MAP, '/ImspTQPwCqd/O6uvpzGd5pu/YuQRtpLP10I') == '/Sierra Leone/Bo/Badjia'
+
+
+def test_replace_path_unknown_uid():
+    assert replace_path(OU_MAP, '/ImspTQPwCqd/fdc6uOvgoji') == '/Sierra Leone/fdc6uOvgoji'
+
+
+def test_replace_path_memo():
+    memo = {}
+    path = '/ImspTQPwCqd/O6uvpzGd5pu'
+    assert replace_path(OU_MAP, path, memo) == '/Sierra Leone/Bo'
+    assert memo == {path: '/Sierra Leone/Bo'}
+    memo[path] = 'cached'
+    assert replace_path(OU_MAP, path, memo) == 'cached'
+
+
+def test_format_user():
+    users = [{
+        'id': 'xE7jOejl9FI',
+        'name': 'John Traore',
+        'userCredentials': {
+            'username': 'admin',
+            'userInfo': {'firstName': 'John', 'surname': 'Traore'},
+            'userRoles': [{'id': 'yrB6vc5Ip3r', 'name': 'Superuser'}]
+        },
+        'userGroups': [{'id': 'wl5cDMuUhmF', 'name': 'Administrators'}],
+        'organisationUnits': [{'path': '/ImspTQPwCqd'}],
+        'dataViewOrganisationUnits': [{'path': '/ImspTQPwCqd/O6uvpzGd5pu'}],
+        'teiSearchOrganisationUnits': []
+    }]
+    user = next(format_user(users, OU_MAP, uid_export=True))
+    assert user.org_units == ['/Sierra Leone']
+    assert user.dv_org_units_uid == ['/ImspTQPwCqd/O6uvpzGd5pu']
+    assert user.dv_org_units == ['/Sierra Leone/Bo']
+    assert user.user_roles_uid == ['yrB6vc5Ip3r']
+    assert user.email == '-'
+
+
+def test_path_uids():
+    users = [{
+        'organisationUnits': [{'path': '/ImspTQPwCqd/O6uvpzGd5pu'}],
+        'dataViewOrganisationUnits': [{'path': '/ImspTQPwCqd'}],
+        'teiSearchOrganisationUnits': [{'path': '/ImspTQPwCqd/O6uvpzGd5pu/YuQRtpLP10I'}]
+    }]
+    assert path_uids(users) == {'ImspTQPwCqd', 'O6uvpzGd5pu', 'YuQRtpLP10I'}
+
+
+def test_resolve_org_unit_names(tmpdir):
+    api = Api(get=lambda endpoint, params: {'organisationUnits': [{'id': 'O6uvpzGd5pu', 'name': 'Bo'}]})
+    cache = JsonCache('orgunit-names', 'play.dhis2.org/demo', directory=str(tmpdir))
+    cache.set('ImspTQPwCqd', 'Sierra Leone')
+    ou_map = {'YuQRtpLP10I': 'Badjia'}
+
+    resolve_org_unit_names(api, {'ImspTQPwCqd', 'O6uvpzGd5pu', 'YuQRtpLP10I', 'fdc6uOvgoji'}, ou_map, cache)
+    assert ou_map == {'ImspTQPwCqd': 'Sierra Leone', 'O6uvpzGd5pu': 'Bo', 'YuQRtpLP10I': 'Badjia',
+                      'fdc6uOvgoji': 'fdc6uOvgoji'}
+    assert len(api.requests) == 1
+    assert cache.get('O6uvpzGd5pu') == 'Bo'
+
+
+def test_user_params():
+    args = parse_args_userinfo(['-s', 'play.dhis2.org/demo', '-u', 'admin', '-p', 'district',
+                                '--user-group', 'wl5cDMuUhmF', '--org-unit', 'ImspTQPwCqd',
+                                '--updated-since', '2021-01-31', '--login-since', '2021-02-01'])[0]
+    params = user_params(args)
+    assert params['filter'] == ['userGroups.id:eq:wl5cDMuUhmF', 'lastUpdated:ge:2021-01-31']
+    assert params['ou'] == 'ImspTQPwCqd'
+    assert params['includeChildren'] == 'true'
+    assert params['lastLogin'] == '2021-02-01'
+    assert 'lastLoginSince' not in params
+
+
+def test_user_filter_invalid_date():
+    with pytest.raises(SystemExit):
+        parse_args_userinfo(['-s', 'play.dhis2.org/demo', '-u', 'admin', '-p', 'district',
+                             '--updated-since', '31.01.2021'])
+
+
+@pytest.mark.parametrize('option', ['--page-size', '--workers'])
+def test_userinfo_positive_options(option):
+    with pytest.raises(SystemExit):
+        parse_args_userinfo(['-s', 'play.dhis2.org/demo', '-u', 'admin', '-p', 'district', option, '0'])
+
+
+def test_incremental_records(tmpdir):
+    def user(uid, name):
+        return {
+            'id': uid, 'name': name,
+            'userCredentials': {'username': name, 'userInfo': {'firstName': name, 'surname': name}, 'userRoles': []},
+            'userGroups': [], 'organisationUnits': [], 'dataViewOrganisationUnits': [], 'teiSearchOrganisationUnits': []
+        }
+
+    def get_users(endpoint, params):
+        if params['fields'] == 'id':
+            users = [{'id': 'xE7jOejl9FI'}, {'id': 'GOLswS44mh8'}]
+        elif params.get('lastLogin') == '2021-01-01':
+            users = [user('GOLswS44mh8', 'changed')]
+        else:
+            users = []
+        return {'pager': {'page': 1, 'pageCount': 1, 'total': len(users)}, 'users': users}
+
+    previous = os.path.join(str(tmpdir), 'previous.csv')
+    write_rows(
+        format_user([user('xE7jOejl9FI', 'kept'), user('GOLswS44mh8', 'old'), user('DXyJmlo9rge', 'deleted')], {}),
+        previous, header_row, list_fields=list_fields
+    )
+    argv = ['-s', 'play.dhis2.org/demo', '-u', 'admin', '-p', 'district',
+            '--previous', previous, '--since', '2021-01-01']
+    args = parse_args_userinfo(argv + ['--remove-deleted'])[0]
+    records = incremental_records(Api(get=get_users), args, user_params(args), header_row, {}, None)
+    assert sorted((r[0], r[1]) for r in records) == [('GOLswS44mh8', 'changed'), ('xE7jOejl9FI', 'kept')]
+
+    # without --remove-deleted, all user UIDs are not downloaded and deleted users are kept
+    args = parse_args_userinfo(argv)[0]
+    records = incremental_records(Api(get=get_users), args, user_params(args), header_row, {}, None)
+    assert sorted((r[0], r[1]) for r in records) == [
+        ('DXyJmlo9rge', 'deleted'), ('GOLswS44mh8', 'changed'), ('xE7jOejl9FI', 'kept')
+    ]
+
+
+def test_incremental_records_other_columns(tmpdir):
+    previous = os.path.join(str(tmpdir), 'previous.csv')
+    write_rows([], previous, ['id', 'name'])
+    args = parse_args_userinfo(['-s', 'play.dhis2.org/demo', '-u', 'admin', '-p', 'district',
+                                '--previous', previous])[0]
+    # fails before the first request
+    with pytest.raises(PKClientException):
+        incremental_records(None, args, user_params(args), header_row, {}, None)
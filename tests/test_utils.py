@@ -0,0 +1,213 @@
+import csv
+import gzip
+import json
+import os
+
+import pytest
+import requests
+from dhis2 import RequestException
+from requests.adapters import HTTPAdapter
+
+from fakes import Response
+from src.cmdline_parser import parse_args_userinfo
+from src.common.exceptions import PKClientException
+from src.common.utils import write_csv, write_rows, read_rows, check_columns, export_filename, get_pages, \
+    JsonPayloadWriter, create_api, connection_options, gzip_body, is_import_endpoint, retry_idempotent
+
+
+def rows(amount):
+    for i in range(amount):
+        yield [i, u'name {}'.format(i), [u'/a/b', u'/a/c']]
+
+
+def test_write_csv_from_generator(tmpdir):
+    filename = os.path.join(str(tmpdir), 'out.csv')
+    assert write_csv(([i, 'x'] for i in range(3)), filename, ['id', 'name']) == 3
+    with open(filename, newline='') as f:
+        data = list(csv.reader(f))
+    assert data[0] == ['id', 'name']
+    assert data[3] == ['2', 'x']
+
+
+def test_write_rows_csv_joins_lists(tmpdir):
+    filename = os.path.join(str(tmpdir), export_filename('out', 'csv', compress=True))
+    assert filename.endswith('.csv.gz')
+    write_rows(rows(2), filename, ['id', 'name', 'paths'], compress=True, list_fields={'paths': '\n'})
+    with gzip.open(filename, 'rt', newline='') as f:
+        data = list(csv.reader(f))
+    assert len(data) == 3
+    assert data[1] == ['0', 'name 0', '/a/b\n/a/c']
+
+
+def test_write_rows_jsonl_keeps_lists(tmpdir):
+    filename = os.path.join(str(tmpdir), export_filename('out', 'jsonl'))
+    assert filename.endswith('.jsonl')
+    write_rows(rows(2), filename, ['id', 'name', 'paths'], fmt='jsonl', list_fields={'paths': '\n'})
+    with open(filename) as f:
+        data = [json.loads(line) for line in f]
+    assert data[1] == {'id': 1, 'name': 'name 1', 'paths': ['/a/b', '/a/c']}
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'jsonl'])
+def test_read_rows_round_trip(tmpdir, fmt):
+    filename = os.path.join(str(tmpdir), export_filename('out', fmt, compress=True))
+    header = ['id', 'name', 'paths']
+    data = [['a', 'x', ['/a/b', '/a/c']], ['b', 'y', []]]
+    write_rows(data, filename, header, fmt=fmt, compress=True, list_fields={'paths': '\n'})
+    assert list(read_rows(filename, header, list_fields={'paths': '\n'})) == data
+
+
+def test_read_rows_other_columns(tmpdir):
+    filename = os.path.join(str(tmpdir), 'out.csv')
+    write_csv([['a']], filename, ['id'])
+    with pytest.raises(PKClientException):
+        list(read_rows(filename, ['id', 'name']))
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'jsonl'])
+def test_check_columns(tmpdir, fmt):
+    filename = os.path.join(str(tmpdir), export_filename('out', fmt, compress=True))
+    write_rows([['a', 'b']], filename, ['id', 'name'], fmt=fmt, compress=True)
+    check_columns(filename, ['id', 'name'])
+    with pytest.raises(PKClientException):
+        check_columns(filename, ['id'])
+
+
+def test_write_rows_parquet(tmpdir):
+    pq = pytest.importorskip('pyarrow.parquet')
+    filename = os.path.join(str(tmpdir), export_filename('out', 'parquet', compress=True))
+    assert filename.endswith('.parquet')
+    data = ([str(i), u'name', [u'/a/b']] for i in range(3))
+    write_rows(data, filename, ['id', 'name', 'paths'], fmt='parquet', list_fields={'paths': '\n'})
+    table = pq.read_table(filename)
+    assert table.num_rows == 3
+    assert table.column('paths').to_pylist()[0] == ['/a/b']
+
+
+def test_write_rows_unknown_format(tmpdir):
+    with pytest.raises(PKClientException):
+        write_rows([], os.path.join(str(tmpdir), 'out.xml'), ['id'], fmt='xml')
+
+
+class PagedApi(object):
+    """Serves a collection of `total` objects in pages"""
+
+    def __init__(self, total):
+        self.total = total
+        self.requested = []
+        self.orders = set()
+
+    def get(self, endpoint, params=None):
+        page, page_size = params['page'], params['pageSize']
+        self.requested.append(page)
+        self.orders.add(params.get('order'))
+        page_count = (self.total + page_size - 1) // page_size
+        objects = [{'id': i} for i in range((page - 1) * page_size, min(page * page_size, self.total))]
+        return Response({'pager': {'page': page, 'pageCount': page_count, 'total': self.total}, endpoint: objects})
+
+
+def test_get_pages_in_order():
+    api = PagedApi(total=95)
+    pages = list(get_pages(api, 'users', params={'fields': 'id'}, page_size=10, workers=3))
+    assert len(pages) == 10
+    assert [u['id'] for page in pages for u in page['users']] == list(range(95))
+    assert sorted(api.requested) == list(range(1, 11))
+    assert api.orders == {'id:asc'}
+
+    api = PagedApi(total=5)
+    list(get_pages(api, 'users', params={'order': 'name:asc'}))
+    assert api.orders == {'name:asc'}
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_json_payload_writer(tmpdir, compress):
+    filename = str(tmpdir.join('payload.json'))
+    with JsonPayloadWriter(filename, 'events', compress) as writer:
+        writer.write_all({'event': i} for i in range(3))
+    opener = gzip.open if compress else open
+    with opener(filename, 'rt') as f:
+        assert json.load(f) == {'events': [{'event': 0}, {'event': 1}, {'event': 2}]}
+    assert writer.count == 3
+
+
+def test_json_payload_writer_empty(tmpdir):
+    filename = str(tmpdir.join('payload.json'))
+    with JsonPayloadWriter(filename, 'dataValues'):
+        pass
+    with open(filename) as f:
+        assert json.load(f) == {'dataValues': []}
+
+
+def test_create_api_connection_options(monkeypatch):
+    args, _ = parse_args_userinfo(['-s', 'play.dhis2.org/demo', '-u', 'admin', '-p', 'district', '--pool-size', '32',
+                                   '--timeout', '60', '--retries', '5', '--no-keep-alive'])
+    with pytest.raises(SystemExit):
+        parse_args_userinfo(['-s', 'play.dhis2.org/demo', '-u', 'admin', '-p', 'district', '--retries', '-1'])
+    api = create_api(server=args.server, username=args.username, password='district', **connection_options(args))
+    adapter = api.session.get_adapter(api.api_url)
+    assert adapter._pool_maxsize == 32
+    assert adapter.max_retries.total == 5
+    assert 503 in adapter.max_retries.status_forcelist
+    assert api.session.headers['Connection'] == 'close'
+
+    sent = {}
+
+    def send(self, request, **kwargs):
+        sent.update(kwargs)
+        response = requests.Response()
+        response.status_code = 200
+        return response
+
+    monkeypatch.setattr(HTTPAdapter, 'send', send)
+    api.session.get(api.api_url, timeout=None)
+    assert sent['timeout'] == 60
+
+
+def test_gzip_body():
+    request = requests.Request('POST', 'https://play.dhis2.org/demo/api/metadata', json={'x': 'y' * 2000}).prepare()
+    gzip_body(request)
+    assert request.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(request.body))['x'] == 'y' * 2000
+    assert request.headers['Content-Length'] == str(len(request.body))
+
+    small = requests.Request('POST', 'https://play.dhis2.org/demo/api/metadata', json={'x': 'y'}).prepare()
+    gzip_body(small)
+    assert 'Content-Encoding' not in small.headers
+
+
+@pytest.mark.parametrize('url,expected', [
+    ('https://play.dhis2.org/demo/api/metadata', True),
+    ('https://play.dhis2.org/demo/api/37/dataValueSets?async=true', True),
+    ('https://play.dhis2.org/demo/api/events.json', True),
+    ('https://play.dhis2.org/demo/api/dataElements/fbfJHSPpUQD', False),
+    ('https://play.dhis2.org/demo/api/sharing?type=dataElement', False),
+    ('https://play.dhis2.org/demo/metadata', False)
+])
+def test_is_import_endpoint(url, expected):
+    assert is_import_endpoint(url) is expected
+
+
+def test_retry_idempotent(monkeypatch):
+    monkeypatch.setattr('src.common.utils.time.sleep', lambda seconds: None)
+    api = create_api('play.dhis2.org/demo', 'admin', 'district', retries=2)
+
+    def failing(codes):
+        calls = []
+
+        def call(api):
+            calls.append(1)
+            if codes:
+                raise RequestException(codes.pop(0), api.api_url, 'error')
+            return 'ok'
+        return call, calls
+
+    call, calls = failing([503, 429])
+    assert retry_idempotent(api, call) == 'ok'
+    assert len(calls) == 3
+
+    # other errors are not retried, throttling only as often as the Api retries
+    for codes, attempts in (([409], 1), ([504, 504, 504], 3)):
+        call, calls = failing(codes)
+        with pytest.raises(RequestException):
+            retry_idempotent(api, call)
+        assert len(calls) == attempts